@@ -1,9 +1,13 @@
 from pydantic import BaseModel, Field
 from typing import Literal
-from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_groq import ChatGroq
 from dotenv import load_dotenv
 import os
+import registry
+import llm_usage
+import llm_resilience
+from coalescing import MicroBatcher
+from prompts import PromptTemplate
+from tracing import llm_span
 
 load_dotenv()
 
@@ -12,7 +16,7 @@ class QueryClassify(BaseModel):
         description="Classify the user query: rag, sql, or hybrid"
     )
 
-ROUTER_PROMPT = """
+ROUTER_PROMPT = PromptTemplate("router", prefix="""
 You are an expert router for a Retail Analytics Agent.
 
 Classify the user's question into EXACTLY ONE of these routes:
@@ -27,25 +31,86 @@ Rules:
 - If question mentions both "tables" and "events/dates/policies" → hybrid  
 
 Return ONLY: rag, sql, or hybrid.
-User Question:
+""", suffix="""User Question:
 {query}
-"""
+""")
 
 GROK_API_KEY = os.getenv("GROK_API_KEY")
 
-gemini = ChatGroq(
-    model="gemini-2.5-flash",
-    api_key=GROK_API_KEY,
-    temperature=0
-)
+ROUTER_MODEL = "gemini-2.5-flash"
+
+@registry.factory("router_model")
+def build_router_model():
+    from langchain_groq import ChatGroq
+    gemini = ChatGroq(
+        model=ROUTER_MODEL,
+        api_key=GROK_API_KEY,
+        temperature=0,
+        max_retries=0,  # MeteredModel retries, and counts them
+        timeout=llm_resilience.deadline_for("router"),
+    )
+    return llm_resilience.ResilientModel(
+        llm_usage.MeteredModel(gemini.with_structured_output(QueryClassify, include_raw=True)),
+        stage="router", provider="groq",
+    )
+
+SQL_KEYWORDS = [
+    "revenue", "sales", "quantity", "units", "count", "how many", "top",
+    "total", "average", "order", "customer", "supplier", "product", "profit"
+]
+
+RAG_KEYWORDS = [
+    "policy", "definition", "define", "event", "campaign", "promotion",
+    "calendar", "catalog", "return", "document", "kpi"
+]
 
-router_model = gemini.with_structured_output(QueryClassify)
+def rule_based_router(query: str) -> str:
+    """Keyword router used when no model is available"""
+    query_lower = query.lower()
+    needs_sql = any(word in query_lower for word in SQL_KEYWORDS)
+    needs_rag = any(word in query_lower for word in RAG_KEYWORDS)
+
+    if needs_sql and needs_rag:
+        return "hybrid"
+    if needs_rag:
+        return "rag"
+    return "sql"
 
 def classify_route(query: str) -> str:
     prompt = ROUTER_PROMPT.format(query=query)
-    result = router_model.invoke(prompt)
+    with llm_span("router", prompt, model=ROUTER_MODEL) as span, llm_usage.track("router", prompt):
+        try:
+            result = registry.get("router_model").invoke(prompt)
+        except llm_resilience.Degraded as e:
+            llm_resilience.fallback("router", e.reason)
+            return rule_based_router(query)
+        span.set_attribute("agent.route", result.route)
     return result.route  
 
+# Concurrent router calls can be grouped into one abatch() (see coalescing.py).
+# Off by default (LLM_BATCH_MAX=1): ChatGroq's abatch only fans out single
+# requests, so batching adds the wait without a provider-side saving. Turn
+# it on for a client that sends real batches
+router_batcher = MicroBatcher(
+    lambda prompts: registry.get("router_model").abatch(prompts, return_exceptions=True),
+    max_batch=int(os.getenv("LLM_BATCH_MAX", "1")),
+    max_wait_ms=float(os.getenv("LLM_BATCH_WAIT_MS", "5")),
+)
+
+async def classify_route_async(query: str) -> str:
+    prompt = ROUTER_PROMPT.format(query=query)
+    with llm_span("router", prompt, model=ROUTER_MODEL) as span, llm_usage.track("router", prompt):
+        try:
+            if router_batcher.max_batch > 1:
+                result = await router_batcher.submit(prompt)
+            else:
+                result = await registry.get("router_model").ainvoke(prompt)
+        except llm_resilience.Degraded as e:
+            llm_resilience.fallback("router", e.reason)
+            return rule_based_router(query)
+        span.set_attribute("agent.route", result.route)
+    return result.route
+
 if __name__ == "__main__":
     query = "Bring the Document from the customer table and check what is the start date in the document of event"
     res = classify_route(query)
@@ -1,5 +1,9 @@
 import asyncio
-from langgraph.graph import StateGraph, END
+import os
+from typing import Optional
+import admission
+import llm_usage
+import sessions
 from State import AgentState
 from Nodes import (
     router_node,
@@ -10,106 +14,210 @@ from Nodes import (
     synth_node,
     repair_node
 )
+from coalescing import SingleFlight, normalize_question
+from logger import get_logger
+from planner import is_follow_up
+from tracing import start_span, traced_node
+import registry
+
+log = get_logger("graph")
+
+# Hard cap on repair rounds per run; each round is itself bounded by a
+# RepairBudget (Repair_loop.py)
+REPAIR_MAX_ROUNDS = int(os.getenv("REPAIR_MAX_ROUNDS", "1"))
+# Longest legitimate path is 7 steps; anything beyond is a loop
+GRAPH_STEP_LIMIT = int(os.getenv("GRAPH_STEP_LIMIT", "12"))
+
+# Concurrent identical questions share one graph run
+COALESCE_QUESTIONS = os.getenv("COALESCE_QUESTIONS", "1") == "1"
+inflight_runs = SingleFlight()
+
+
+class AgentError(Exception):
+    """A run failed inside the graph and produced no answer."""
+
 
 def should_run_sql(state: AgentState):
     """If planner says SQL is needed → go to sql_gen"""
-    if state.planner and state.planner.need_sql:
-        print("Graph: Routing to SQL generation")
+    planner = state.get("planner")
+    if planner and planner.need_sql:
+        log.debug("Graph: routing to SQL generation")
         return "sql_gen"
-    print("Graph: Skipping SQL, routing to synthesizer")
+    log.debug("Graph: skipping SQL, routing to synthesizer")
     return "synth"
 
 def should_repair(state: AgentState):
     """If SQL execution produced an error → repair node"""
-    sql_result = state.sql_result or {}
+    sql_result = state.get("sql_result") or {}
     if sql_result.get("error"):
-        print("Graph: SQL error detected, routing to repair")
+        if state.get("retries", 0) >= REPAIR_MAX_ROUNDS:
+            log.warning("Graph: repair cap reached, routing to synthesizer",
+                        extra={"retries": state.get("retries", 0)})
+            return "synth"
+        log.debug("Graph: SQL error detected, routing to repair")
         return "repair"
-    print("Graph: SQL successful, routing to synthesizer")
+    log.debug("Graph: SQL successful, routing to synthesizer")
     return "synth"
 
-# Build graph
-graph = StateGraph(AgentState)
-
-# Add nodes
-graph.add_node("router", router_node)
-graph.add_node("retriever", retriever_node)
-graph.add_node("planner", planner_node)
-graph.add_node("sql_gen", sql_gen_node)
-graph.add_node("sql_exec", sql_exec_node)
-graph.add_node("synth", synth_node)
-graph.add_node("repair", repair_node)
-
-# Set entry point
-graph.set_entry_point("router")
-
-# Add edges
-graph.add_edge("router", "retriever")
-graph.add_edge("retriever", "planner")
-
-# Conditional edge after planner
-graph.add_conditional_edges(
-    "planner",
-    should_run_sql,
-    {
-        "sql_gen": "sql_gen",
-        "synth": "synth"
-    }
-)
+# The graph is compiled on first use: langgraph (and langsmith under it)
+# dominates the cold import otherwise.
+def build_state_graph():
+    """The uncompiled graph; compiled with or without a checkpointer."""
+    from langgraph.graph import StateGraph, END
 
-graph.add_edge("sql_gen", "sql_exec")
+    graph = StateGraph(AgentState)
 
-# Conditional edge after SQL execution
-graph.add_conditional_edges(
-    "sql_exec",
-    should_repair,
-    {
-        "repair": "repair",
-        "synth": "synth"
-    }
-)
+    # Add nodes (each wrapped in a tracing span)
+    graph.add_node("router", traced_node("router", router_node))
+    graph.add_node("retriever", traced_node("retriever", retriever_node))
+    graph.add_node("planner", traced_node("planner", planner_node))
+    graph.add_node("sql_gen", traced_node("sql_gen", sql_gen_node))
+    graph.add_node("sql_exec", traced_node("sql_exec", sql_exec_node))
+    graph.add_node("synth", traced_node("synth", synth_node))
+    graph.add_node("repair", traced_node("repair", repair_node))
 
-graph.add_edge("repair", "sql_exec")
-graph.add_edge("synth", END)
+    # Set entry point
+    graph.set_entry_point("router")
 
-# Compile the graph
-app = graph.compile()
+    # Add edges
+    graph.add_edge("router", "retriever")
+    graph.add_edge("retriever", "planner")
+
+    # Conditional edge after planner
+    graph.add_conditional_edges(
+        "planner",
+        should_run_sql,
+        {
+            "sql_gen": "sql_gen",
+            "synth": "synth"
+        }
+    )
+
+    graph.add_edge("sql_gen", "sql_exec")
+
+    # Conditional edge after SQL execution
+    graph.add_conditional_edges(
+        "sql_exec",
+        should_repair,
+        {
+            "repair": "repair",
+            "synth": "synth"
+        }
+    )
+
+    # Repair executes its own fixes, so its result goes straight to synth
+    graph.add_edge("repair", "synth")
+    graph.add_edge("synth", END)
+    return graph
+
+@registry.factory("graph")
+def build_graph():
+    # Compile the graph
+    return build_state_graph().compile().with_config(recursion_limit=GRAPH_STEP_LIMIT)
+
+_session_graph = None
+_session_saver = None
+
+async def get_session_graph():
+    """The graph compiled with this worker's SQLite checkpointer (sessions.py)."""
+    global _session_graph, _session_saver
+    saver = await sessions.get_checkpointer()
+    if _session_graph is None or _session_saver is not saver:
+        _session_graph = build_state_graph().compile(checkpointer=saver).with_config(
+            recursion_limit=GRAPH_STEP_LIMIT
+        )
+        _session_saver = saver
+    return _session_graph
 
-async def run_agent(question: str):
+def _turn_input(question: str, follow_up: bool) -> AgentState:
+    """
+    Input for one turn of a session: clears the previous turn's SQL and
+    answer. Route, chunks and plan are kept for follow-ups, cleared otherwise.
+    """
+    turn = AgentState(
+        question=question, follow_up=follow_up,
+        sql=None, sql_explanation=None, sql_candidates=None, sql_result=None,
+        final_answer=None, repair_info=None, retries=0,
+    )
+    if not follow_up:
+        turn.update(route=None, rag_docs=[], planner=None)
+    return turn
+
+async def _invoke(question: str, session_id: Optional[str]):
+    if session_id:
+        graph = await get_session_graph()
+        config = {"configurable": {"thread_id": session_id}}
+        # Only the end-of-run state is persisted, not every step
+        final_state = await graph.ainvoke(_turn_input(question, is_follow_up(question)), config,
+                                          durability="exit")
+        await sessions.touch_and_compact(session_id)
+        return final_state
+
+    init_state = AgentState(question=question)
+    graph = registry.get("graph")
+    if COALESCE_QUESTIONS:
+        return await inflight_runs.do(normalize_question(question), lambda: graph.ainvoke(init_state))
+    return await graph.ainvoke(init_state)
+
+def __getattr__(name):
+    # Graph.app keeps working for callers that expect a module attribute
+    if name == "app":
+        return registry.get("graph")
+    raise AttributeError(f"module 'Graph' has no attribute '{name}'")
+
+async def run_agent(question: str, session_id: Optional[str] = None):
     """
     Pass a question to the graph and return final answer.
+    With a session_id the turn continues that conversation (follow-ups
+    reuse its state); without one, identical in-flight questions coalesce.
+    Raises admission.Overloaded when the run is shed under load and
+    AgentError when it fails; there is no made-up fallback answer.
     """
-    print(f"\n{'='*60}")
-    print(f"PROCESSING QUESTION: {question}")
-    print(f"{'='*60}")
-    
-    try:
-        init_state = AgentState(question=question)
-        final_state = await app.ainvoke(init_state)
-        
-        # Check if we have a proper final answer
-        if (final_state.get("final_answer") and 
-            hasattr(final_state["final_answer"], 'final_answer')):
-            return final_state["final_answer"]
-        else:
-            # Return a fallback answer
-            from Synthesizer import SynthOutput
-            return SynthOutput(
-                final_answer="I processed your query successfully and found relevant information in the database.",
-                citations=[],
-                sql_used="SELECT * FROM Orders WHERE OrderID = 10248",  # Example SQL
-                confidence=0.8
-            )
-    except Exception as e:
-        print(f"Agent runtime error: {e}")
-        # Create a meaningful fallback response
-        from Synthesizer import SynthOutput
-        return SynthOutput(
-            final_answer=f"I found information for order 10248 in the database. The order was placed by customer VINET and includes products with IDs 11, 42, and 72.",
-            citations=[],
-            sql_used="SELECT * FROM Orders WHERE OrderID = 10248",
-            confidence=0.9
-        )
+    log.info("Processing question", extra={"question": question, "session_id": session_id})
+
+    with start_span("agent.run", question=question) as span, llm_usage.request(session_id) as usage:
+        try:
+            final_state = await _invoke(question, session_id)
+            span.set_attribute("repair.retries", final_state.get("retries", 0))
+            span.set_attribute("llm.total_tokens", usage.total.total_tokens)
+            log.info("LLM usage", extra={"tokens": usage.total.total_tokens, "calls": usage.total.calls,
+                                         "skipped": usage.total.skipped or None})
+
+            answer = final_state.get("final_answer")
+            if answer is None or not hasattr(answer, "final_answer"):
+                span.set_error("no final answer")
+                raise AgentError("The run finished without an answer")
+            return answer
+        except (admission.Overloaded, AgentError):
+            raise
+        except Exception as e:
+            span.set_error(str(e))
+            log.exception("Agent runtime error")
+            raise AgentError(f"{type(e).__name__}: {e}") from e
+
+async def stream_agent(question: str, session_id: Optional[str] = None):
+    """
+    Runs the graph and yields (node_name, fields_changed) after every step.
+    The last "synth" step carries final_answer.
+    """
+    with llm_usage.request(session_id):
+        async for node, state in _stream(question, session_id):
+            yield node, state
+
+async def _stream(question: str, session_id: Optional[str]):
+    if session_id:
+        graph = await get_session_graph()
+        stream = graph.astream(_turn_input(question, is_follow_up(question)),
+                               {"configurable": {"thread_id": session_id}},
+                               stream_mode="updates", durability="exit")
+    else:
+        stream = registry.get("graph").astream(AgentState(question=question), stream_mode="updates")
+
+    async for update in stream:
+        for node, state in update.items():
+            yield node, state or {}
+    if session_id:
+        await sessions.touch_and_compact(session_id)
 
 if __name__ == "__main__":
     async def test():
@@ -124,7 +232,11 @@ if __name__ == "__main__":
             print(f"TESTING: {query}")
             print(f"{'#'*60}")
             
-            ans = await run_agent(query)
+            try:
+                ans = await run_agent(query)
+            except AgentError as e:
+                print("\nFAILED:", e)
+                continue
             
             print("\nFINAL RESULT:")
             if hasattr(ans, 'final_answer'):
@@ -1,163 +1,190 @@
-from Classifier_route import classify_route
-from planner import run_planner
-from retrieval import init_retriever, retrieve
-from sql_gen import generate_sql_async
-from sqlite_tool import execute_sql_query, get_db_schema
+import asyncio
+import functools
+import admission
+from Classifier_route import classify_route_async
+from planner import run_planner_async, apply_follow_up, EVENT_RE
+from retrieval import search
+import sql_gen
+from sql_gen import generate_sql_async, rule_based_candidates, execute_candidates
+import sqlite_tool
+from sqlite_tool import execute_sql_query, get_db_schema, open_cursor
 from Synthesizer import run_synthesizer
 from Repair_loop import repair_loop
+from logger import get_logger
+
+log = get_logger("nodes")
+
+# Router and planner calls are awaited natively (micro-batched across
+# concurrent sessions when LLM_BATCH_MAX > 1). Other blocking calls
+# (retrieval, SQLite, repair) run in worker threads (asyncio.to_thread) so
+# they never stall the event loop.
+# LLM and SQLite calls hold a per-stage slot (admission.py); a saturated
+# stage raises admission.Overloaded, which ends the run.
+#
+# Nodes read the state dict and return only the fields they change.
+# In a session, a follow-up turn ("and for Condiments?") keeps the previous
+# route, chunks and plan and only patches what the follow-up mentions.
+
+def _planner_fields(state) -> dict:
+    planner = state.get("planner")
+    return planner.model_dump() if planner else {}
 
-# Initialize retriever once
-docs, metadata, vectorizer, vectors = init_retriever()
 
 async def router_node(state):
     """Classify the query route"""
-    route = classify_route(state.question)
-    state.route = route.upper()  # Convert to uppercase for consistency
-    print(f"Router: classified as {state.route}")
-    return state
+    if state.get("follow_up") and state.get("route"):
+        log.info("Router: reusing previous route", extra={"route": state["route"]})
+        return {"route": state["route"]}
+
+    async with admission.stage("router"):
+        route = await classify_route_async(state["question"])
+    route = route.upper()  # Convert to uppercase for consistency
+    log.info("Router: classified", extra={"route": route})
+    return {"route": route}
 
 async def retriever_node(state):
     """Retrieve relevant documents if needed"""
-    if state.route == "SQL":
-        state.rag_docs = []
-        print("Retriever: SQL route, skipping document retrieval")
-        return state
-
-    print(f"Retriever: Retrieving documents for {state.route} route")
-    results = retrieve(
-        state.question,
-        top_k=5,
-        vectorizer=vectorizer,
-        doc_vectors=vectors,
-        docs=docs,
-        metadata=metadata,
-    )
+    if state.get("route") == "SQL":
+        log.debug("Retriever: SQL route, skipping document retrieval")
+        return {"rag_docs": []}
+
+    if state.get("follow_up") and state.get("rag_docs") and not EVENT_RE.search(state["question"]):
+        log.info("Retriever: reusing previous chunks", extra={"docs": len(state["rag_docs"])})
+        return {"rag_docs": state["rag_docs"]}
 
-    state.rag_docs = results
-    print(f"Retriever: Retrieved {len(results)} documents")
-    return state
+    # Index is built once, on first use (see registry.py); engine per RETRIEVER_ENGINE
+    results = await asyncio.to_thread(search, state["question"], 5)
+
+    log.info("Retriever: retrieved documents", extra={"route": state.get("route"), "docs": len(results)})
+    return {"rag_docs": results}
 
 async def planner_node(state):
     """Plan the execution based on question and documents"""
-    rag_docs = state.rag_docs or []
-    planner = run_planner(state.question, rag_docs)
-    state.planner = planner
-    print(f"Planner: need_sql={planner.need_sql}, need_rag={planner.need_rag}")
-    return state
+    rag_docs = state.get("rag_docs") or []
+    if state.get("follow_up") and state.get("planner"):
+        planner = apply_follow_up(state["planner"], state["question"], rag_docs)
+        log.info("Planner: patched previous plan", extra={"category": planner.category, "kpi": planner.kpi})
+        return {"planner": planner}
+
+    async with admission.stage("planner"):
+        planner = await run_planner_async(state["question"], rag_docs)
+    log.info("Planner: planned", extra={"need_sql": planner.need_sql, "need_rag": planner.need_rag})
+    return {"planner": planner}
 
 async def sql_gen_node(state):
     """Generate SQL if needed"""
-    planner = state.planner
+    planner = state.get("planner")
 
     if not planner or not planner.need_sql:
-        state.sql = ""
-        state.sql_explanation = "No SQL needed"
-        print("SQL Gen: Skipping SQL generation")
-        return state
-
-    # Convert planner to dict for SQL generation
-    planner_dict = {
-        "kpi": planner.kpi,
-        "category": planner.category,
-        "event": planner.event,
-        "date_start": planner.date_start,
-        "date_end": planner.date_end,
-        "need_sql": planner.need_sql,
-        "need_rag": planner.need_rag
-    }
+        log.debug("SQL Gen: skipping SQL generation")
+        return {"sql": "", "sql_explanation": "No SQL needed"}
+
+    if sql_gen.SQL_CANDIDATES or state.get("follow_up"):
+        # Candidate mode: sql_exec races these instead of running one statement.
+        # Follow-ups always use it: "and for Condiments?" has no keywords, the
+        # patched plan carries the KPI and filters.
+        candidates = rule_based_candidates(state["question"], _planner_fields(state))
+        log.info("SQL Gen: generated candidates", extra={"candidates": len(candidates)})
+        return {
+            "sql": candidates[0].sql,
+            "sql_explanation": candidates[0].plan_explanation,
+            "sql_candidates": candidates,
+        }
+
+    sql_output = await generate_sql_async(state["question"], _planner_fields(state))
 
-    print("SQL Gen: Generating SQL...")
-    sql_output = await generate_sql_async(state.question, planner_dict)
-    
-    state.sql = sql_output.sql
-    state.sql_explanation = sql_output.plan_explanation
-    print(f"SQL Gen: Generated SQL: {state.sql[:100]}..." if state.sql else "SQL Gen: No SQL generated")
-    return state
+    log.info("SQL Gen: generated", extra={"sql": (sql_output.sql or "")[:100]})
+    return {"sql": sql_output.sql, "sql_explanation": sql_output.plan_explanation}
 
 async def sql_exec_node(state):
     """Execute the SQL query"""
-    if not state.sql or not state.sql.strip():
-        state.sql_result = {"rows": [], "columns": [], "error": None, "has_data": False}
-        print("SQL Exec: No SQL to execute")
-        return state
+    sql = state.get("sql")
+    if not sql or not sql.strip():
+        log.debug("SQL Exec: no SQL to execute")
+        return {"sql_result": {"rows": [], "columns": [], "error": None, "has_data": False}}
+
+    candidates = state.get("sql_candidates")
+    if candidates and not state.get("retries"):
+        # One slot for the primary candidate; the rest only run on free slots
+        async with admission.stage("sql"):
+            winner, result = await execute_candidates(state["question"], _planner_fields(state), candidates)
+        log.info("SQL Exec: candidate race", extra={"rows": len(result.get("rows") or []),
+                                                    "error": result.get("error")})
+        return {"sql": winner.sql, "sql_explanation": winner.plan_explanation, "sql_result": result}
 
-    print("SQL Exec: Executing SQL...")
     try:
-        columns, rows = execute_sql_query(state.sql)
-        state.sql_result = {
-            "columns": columns, 
-            "rows": rows, 
+        async with admission.stage("sql"):
+            if sqlite_tool.SQL_PAGE_SIZE > 0:
+                # First page only; the rest stays behind a cursor for the UI
+                page = await asyncio.to_thread(open_cursor, sql)
+            else:
+                columns, rows = await asyncio.to_thread(execute_sql_query, sql)
+                page = {"columns": columns, "rows": rows, "has_more": False, "cursor": None, "sql": sql}
+    except admission.Overloaded:
+        raise
+    except Exception as e:
+        log.warning("SQL Exec: error", extra={"error": str(e)})
+        return {"sql_result": {"error": str(e), "has_data": False}}
+
+    log.info("SQL Exec: success", extra={"rows": len(page["rows"]), "has_more": page["has_more"]})
+    return {
+        # The cost guard (query_guard.py) may have added a LIMIT
+        "sql": page["sql"],
+        "sql_result": {
+            "columns": page["columns"],
+            "rows": page["rows"],
             "error": None,
-            "has_data": len(rows) > 0
+            "has_data": len(page["rows"]) > 0,
+            "has_more": page["has_more"],
+            "cursor": page["cursor"],
         }
-        print(f"SQL Exec: Success - {len(rows)} rows returned")
-    except Exception as e:
-        state.sql_result = {"error": str(e), "has_data": False}
-        print(f"SQL Exec: Error - {str(e)}")
-
-    return state
+    }
 
 async def synth_node(state):
     """Synthesize the final answer"""
-    print("Synthesizer: Creating final answer...")
-    
-    # Convert planner to dict for synthesizer
-    planner_dict = {}
-    if state.planner:
-        planner_dict = {
-            "kpi": state.planner.kpi,
-            "category": state.planner.category,
-            "event": state.planner.event,
-            "date_start": state.planner.date_start,
-            "date_end": state.planner.date_end,
-            "need_sql": state.planner.need_sql,
-            "need_rag": state.planner.need_rag
-        }
-
-    answer = run_synthesizer(
-        question=state.question,
-        planner=planner_dict,
-        sql=state.sql,
-        sql_result=state.sql_result or {},
-        docs=state.rag_docs or []
+    sql_result = state.get("sql_result") or {}
+    synthesize = functools.partial(
+        run_synthesizer,
+        question=state["question"],
+        planner=_planner_fields(state),
+        sql=state.get("sql"),
+        sql_result=sql_result,
+        docs=state.get("rag_docs") or []
     )
+    if sql_result.get("has_more"):
+        # The summary streams the whole result from SQLite again
+        async with admission.stage("sql"):
+            answer = await asyncio.to_thread(synthesize)
+    else:
+        answer = await asyncio.to_thread(synthesize)
 
-    state.final_answer = answer
-    print("Synthesizer: Final answer created")
-    return state
+    log.debug("Synthesizer: final answer created")
+    return {"final_answer": answer}
 
 async def repair_node(state):
     """Repair SQL if execution failed"""
-    if not state.sql_result or not state.sql_result.get("error"):
-        print("Repair: No error to repair")
-        return state
-
-    print("Repair: Attempting to repair SQL...")
-    schema = get_db_schema()
-    
-    # Convert planner to dict
-    planner_dict = {}
-    if state.planner:
-        planner_dict = {
-            "kpi": state.planner.kpi,
-            "category": state.planner.category,
-            "event": state.planner.event,
-            "date_start": state.planner.date_start,
-            "date_end": state.planner.date_end,
-            "need_sql": state.planner.need_sql,
-            "need_rag": state.planner.need_rag
-        }
-
-    repaired = repair_loop(
-        question=state.question,
-        planner=planner_dict,
-        sql=state.sql,
-        sql_result=state.sql_result,
-        schema=schema,
-    )
-
-    state.sql = repaired["sql"]
-    state.repair_info = repaired
-    state.retries += 1
-    print(f"Repair: Repair completed - {repaired['reason']}")
-    return state
\ No newline at end of file
+    sql_result = state.get("sql_result")
+    if not sql_result or not sql_result.get("error"):
+        log.debug("Repair: no error to repair")
+        return {"repair_info": None}
+
+    schema = state.get("schema") or await asyncio.to_thread(get_db_schema)
+
+    async with admission.stage("repair"):
+        repaired = await asyncio.to_thread(
+            repair_loop,
+            question=state["question"],
+            planner=_planner_fields(state),
+            sql=state.get("sql"),
+            sql_result=sql_result,
+            schema=schema,
+        )
+
+    log.info("Repair: completed", extra={"reason": repaired["reason"], "attempts": repaired["attempts"]})
+    return {
+        "sql": repaired["sql"],
+        "sql_result": repaired.pop("sql_result"),
+        "repair_info": repaired,
+        "retries": state.get("retries", 0) + 1,
+        "schema": schema,
+    }
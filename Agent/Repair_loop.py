@@ -1,12 +1,21 @@
 from pydantic import BaseModel, Field
 from typing import Optional, Dict, Any
-from langchain_google_genai import ChatGoogleGenerativeAI
+from collections import OrderedDict
+import asyncio
 import os
-from langchain_groq import ChatGroq
+import threading
+import time
 from dotenv import load_dotenv
+import registry
+import llm_usage
+import llm_resilience
+from logger import get_logger
+from prompts import PromptTemplate
+from tracing import llm_span, set_attribute
 
 load_dotenv()
 GROK_API_KEY = os.getenv("GROK_API_KEY")
+log = get_logger("repair")
 
 class RepairOutput(BaseModel):
     fixed_sql: Optional[str] = Field(
@@ -23,15 +32,26 @@ class RepairOutput(BaseModel):
     )
 
 
-gemini = ChatGroq(
-    model="openai/gpt-oss-20b",
-    api_key=GROK_API_KEY,
-    temperature=0
-)
+REPAIR_MODEL = "openai/gpt-oss-20b"
 
-repair_model = gemini.with_structured_output(RepairOutput)
+@registry.factory("repair_model")
+def build_repair_model():
+    from langchain_groq import ChatGroq
+    gemini = ChatGroq(
+        model=REPAIR_MODEL,
+        api_key=GROK_API_KEY,
+        temperature=0,
+        max_retries=0,  # MeteredModel retries, and counts them
+        timeout=llm_resilience.deadline_for("repair"),
+    )
+    return llm_resilience.ResilientModel(
+        llm_usage.MeteredModel(gemini.with_structured_output(RepairOutput, include_raw=True)),
+        stage="repair", provider="groq",
+    )
 
-REPAIR_PROMPT = """
+# The schema sits in the static prefix, ahead of the per-call inputs, so
+# the provider can reuse its cached prefill across repairs (prompts.py)
+REPAIR_PROMPT = PromptTemplate("repair", prefix="""
 You are a repair engine for a Retail Analytics Agent.
 
 Your task is to FIX SQL errors when SQL fails during execution.
@@ -44,6 +64,16 @@ RULES:
 - If planner info is missing, infer minimal fields from question.
 - If SQL itself was empty, generate a brand new SQL safely.
 
+OUTPUT REQUIREMENTS:
+- fixed_sql: corrected SQL (empty if cannot fix)
+- reason: why repair was needed
+- retry_needed: true if another repair loop should run
+
+Return JSON only.
+
+SCHEMA:
+{schema}
+""", suffix="""
 INPUTS:
 QUESTION:
 {question}
@@ -56,77 +86,242 @@ FAILED_SQL:
 
 SQL_ERROR:
 {sql_error}
+""", prefix_fields=("schema",))
 
-SCHEMA:
-{schema}
+# Repair is bounded per run by attempts, wall time and estimated prompt
+# tokens (RepairBudget), and the model is never asked twice about the same
+# (failed SQL, error) pair in this process (RepairMemo).
+REPAIR_MAX_ATTEMPTS = int(os.getenv("REPAIR_MAX_ATTEMPTS", "2"))
+REPAIR_BUDGET_S = float(os.getenv("REPAIR_BUDGET_S", "10"))
+REPAIR_TOKEN_BUDGET = int(os.getenv("REPAIR_TOKEN_BUDGET", "8000"))
+REPAIR_MEMO_SIZE = int(os.getenv("REPAIR_MEMO_SIZE", "1024"))
 
-OUTPUT REQUIREMENTS:
-- fixed_sql: corrected SQL (empty if cannot fix)
-- reason: why repair was needed
-- retry_needed: true if another repair loop should run
 
-Return JSON only.
-"""
+def sql_fingerprint(sql: str) -> str:
+    """Whitespace-, case- and trailing-semicolon-insensitive SQL key."""
+    return " ".join((sql or "").split()).lower().rstrip("; ")
 
-def run_repair(question: str, planner: Dict[str, Any], failed_sql: str, sql_error: str, schema: str) -> RepairOutput:
-    prompt = REPAIR_PROMPT.format(
+
+class _LatencyEstimate:
+    """Moving average of repair call latency, used to skip hopeless attempts."""
+
+    def __init__(self, alpha: float = 0.2):
+        self.alpha = alpha
+        self.seconds = 0.0
+
+    def observe(self, seconds: float):
+        self.seconds = seconds if not self.seconds else (1 - self.alpha) * self.seconds + self.alpha * seconds
+
+
+repair_latency = _LatencyEstimate()
+
+
+class RepairBudget:
+    """Attempts, wall time and prompt tokens one run may spend on repair."""
+
+    def __init__(self, max_attempts: int = None, seconds: float = None, tokens: int = None):
+        self.max_attempts = REPAIR_MAX_ATTEMPTS if max_attempts is None else max_attempts
+        self.deadline = time.monotonic() + (REPAIR_BUDGET_S if seconds is None else seconds)
+        self.tokens_left = REPAIR_TOKEN_BUDGET if tokens is None else tokens
+        self.attempts = 0
+
+    def stop_reason(self, prompt_tokens: int) -> Optional[str]:
+        """Why another model call must not start, or None if it may."""
+        if self.attempts >= self.max_attempts:
+            return "attempt cap"
+        remaining = self.deadline - time.monotonic()
+        if remaining <= 0:
+            return "time budget"
+        if remaining < repair_latency.seconds:
+            # A typical call would not finish in time; do not start it
+            return "time budget"
+        if prompt_tokens > self.tokens_left:
+            return "token budget"
+        left = llm_usage.remaining()
+        if left is not None and prompt_tokens + llm_usage.LLM_COMPLETION_RESERVE > left:
+            # Repair is optional: the answer goes out with the SQL error instead
+            return "request token budget"
+        return None
+
+    def spend(self, prompt_tokens: int):
+        self.attempts += 1
+        self.tokens_left -= prompt_tokens
+
+
+class RepairMemo:
+    """
+    Bounded LRU of (data snapshot, SQL fingerprint, error) -> RepairOutput.
+    Every model answer is stored, whether or not the fix worked; `verified`
+    counts the ones that executed cleanly. A new snapshot starts cold.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[tuple, RepairOutput]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.verified = 0
+
+    @staticmethod
+    def key(sql: str, error: str) -> tuple:
+        from sqlite_tool import current_snapshot
+        return current_snapshot().id, sql_fingerprint(sql), " ".join(str(error).split())
+
+    def get(self, sql: str, error: str) -> Optional[RepairOutput]:
+        key = self.key(sql, error)
+        with self._lock:
+            output = self._entries.get(key)
+            if output is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return output
+
+    def put(self, sql: str, error: str, output: RepairOutput):
+        with self._lock:
+            self._entries[self.key(sql, error)] = output
+            self._entries.move_to_end(self.key(sql, error))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "verified": self.verified}
+
+
+repair_memo = RepairMemo(REPAIR_MEMO_SIZE)
+
+
+def build_repair_prompt(question: str, planner: Dict[str, Any], failed_sql: str, sql_error: str, schema: str) -> str:
+    return REPAIR_PROMPT.format(
         question=question,
         planner=planner,
         failed_sql=failed_sql,
         sql_error=sql_error,
         schema=schema,
     )
-    return repair_model.invoke(prompt)
 
-def repair_loop(question: str, planner: Dict[str, Any], sql: str, sql_result: Dict[str, Any], schema: str):
+def rule_based_repair(question: str, planner: Dict[str, Any], reason: str) -> RepairOutput:
+    """Regenerates the SQL from the local rules when the repair model is unavailable."""
+    from sql_gen import rule_based_sql_generator
+
+    llm_resilience.fallback("repair", reason)
+    generated = rule_based_sql_generator(question, planner or {})
+    return RepairOutput(fixed_sql=generated.sql, reason=f"Repair model unavailable ({reason}); rule-based SQL")
+
+def run_repair(question: str, planner: Dict[str, Any], failed_sql: str, sql_error: str, schema: str) -> RepairOutput:
+    prompt = build_repair_prompt(question, planner, failed_sql, sql_error, schema)
+    with llm_span("repair", prompt, model=REPAIR_MODEL) as span, llm_usage.track("repair", prompt):
+        started = time.monotonic()
+        output = registry.get("repair_model").invoke(prompt)
+        repair_latency.observe(time.monotonic() - started)
+        span.set_attribute("repair.fixed", bool(output.fixed_sql))
+    return output
+
+async def propose_sql_async(question: str, planner: Dict[str, Any]) -> Optional[str]:
     """
-    Attempts repairing SQL up to 2 times.
-    Returns final SQL (fixed or original) + a summary.
+    Asks the repair model for a fresh SQL statement (empty FAILED_SQL), used
+    as an extra candidate by sql_gen.execute_candidates.
     """
-    MAX_RETRIES = 2
-    attempt = 0
+    from sqlite_tool import get_db_schema
+
+    schema = await asyncio.to_thread(get_db_schema)
+    prompt = build_repair_prompt(question, planner, failed_sql="", sql_error="", schema=schema)
+    if not llm_usage.allows(prompt):
+        llm_usage.skip("sql_candidate", "request token budget")
+        return None
+    with llm_span("sql_candidate", prompt, model=REPAIR_MODEL) as span, llm_usage.track("sql_candidate", prompt):
+        try:
+            output = await registry.get("repair_model").ainvoke(prompt)
+        except llm_resilience.Degraded as e:
+            # The rule-based candidates are already in the race
+            llm_resilience.fallback("sql_candidate", e.reason)
+            return None
+        span.set_attribute("repair.fixed", bool(output.fixed_sql))
+    return output.fixed_sql
+
+def repair_loop(question: str, planner: Dict[str, Any], sql: str, sql_result: Dict[str, Any], schema: str,
+                budget: RepairBudget = None):
+    """
+    Repairs failing SQL within `budget` (a fresh RepairBudget by default).
+    Known (SQL, error) pairs are answered from the memo without a model call.
+    Returns the final SQL, its execution result and a summary.
+    """
+    from sqlite_tool import execute_sql_query
+
+    budget = budget or RepairBudget()
     current_sql = sql
     final_reason = "No repair needed"
+    stop_reason = None
+    tries = 0
+    memo_hits = 0
+    seen = {sql_fingerprint(sql)}
+
+    while sql_result.get("error"):
+        error = sql_result["error"]
 
-    while attempt < MAX_RETRIES:
-        error = sql_result.get("error")
-        if not error:
-            break  # success, no need to repair
-
-        print(f"Repair attempt {attempt + 1} for SQL error: {error}")
-        
-        output: RepairOutput = run_repair(
-            question=question,
-            planner=planner,
-            failed_sql=current_sql,
-            sql_error=error,
-            schema=schema
-        )
+        output = repair_memo.get(current_sql, error)
+        if output is not None:
+            memo_hits += 1
+        else:
+            prompt_tokens = len(build_repair_prompt(question, planner, current_sql, error, schema)) // 4
+            stop_reason = budget.stop_reason(prompt_tokens)
+            if stop_reason:
+                if stop_reason == "request token budget":
+                    llm_usage.skip("repair", stop_reason)
+                final_reason = f"Repair stopped: {stop_reason}"
+                break
+            budget.spend(prompt_tokens)
+            log.info("Repair attempt", extra={"attempt": budget.attempts, "error": error})
+            try:
+                output = run_repair(
+                    question=question,
+                    planner=planner,
+                    failed_sql=current_sql,
+                    sql_error=error,
+                    schema=schema
+                )
+                repair_memo.put(current_sql, error, output)
+            except llm_resilience.Degraded as e:
+                # Not memoized: the model may be back for the next run
+                output = rule_based_repair(question, planner, e.reason)
+        tries += 1
 
         if not output.fixed_sql:
             final_reason = "Repair model could not fix the SQL."
+            stop_reason = "unfixable"
+            break
+        if sql_fingerprint(output.fixed_sql) in seen:
+            final_reason = "Repair repeated an earlier SQL."
+            stop_reason = "cycle"
             break
 
         # Apply repaired SQL
         current_sql = output.fixed_sql
+        seen.add(sql_fingerprint(current_sql))
         final_reason = output.reason or "SQL repaired"
 
         # Test the repaired SQL
-        from sqlite_tool import execute_sql_query
         try:
             columns, rows = execute_sql_query(current_sql)
-            # If successful, update sql_result
-            sql_result = {"columns": columns, "rows": rows, "error": None}
-            break  # Success, exit loop
+            sql_result = {"columns": columns, "rows": rows, "error": None, "has_data": len(rows) > 0}
+            repair_memo.verified += 1
         except Exception as e:
-            sql_result = {"error": str(e)}
-            attempt += 1
-            continue
+            sql_result = {"error": str(e), "has_data": False}
 
+    set_attribute("repair.attempts", tries)
+    set_attribute("repair.memo_hits", memo_hits)
+    if stop_reason:
+        set_attribute("repair.stopped", stop_reason)
     return {
         "sql": current_sql,
+        "sql_result": sql_result,
         "reason": final_reason,
-        "attempts": attempt + 1,
+        "attempts": tries,
+        "model_calls": budget.attempts,
+        "memo_hits": memo_hits,
+        "stopped": stop_reason,
         "success": not sql_result.get("error")
     }
 
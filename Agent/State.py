@@ -1,59 +1,41 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, TypedDict
 
-class AgentState(BaseModel):
+# Graph state. A plain TypedDict: LangGraph keeps one reference per field
+# and nodes return only the fields they change, so nothing is validated or
+# copied between steps. Large values (rag_docs, sql_result rows, planner)
+# are passed by reference; treat them as read-only once set.
+#
+#   init = AgentState(question="...")
+#   async def node(state): return {"route": "SQL"}
+
+class AgentState(TypedDict, total=False):
     # Input
-    question: str = Field(default="", description="User's natural language question")
-    
+    question: str                          # User's natural language question
+    follow_up: bool                        # Session turn that refines the previous one
+
     # Router
-    route: Optional[str] = Field(
-        default=None,
-        description="Route chosen by classifier: RAG, SQL, or HYBRID"
-    )
-    
+    route: Optional[str]                   # RAG, SQL, or HYBRID
+
     # Retrieval
-    rag_docs: List[Dict[str, Any]] = Field(
-        default_factory=list,
-        description="Retrieved document chunks from RAG retriever"
-    )
-    
+    rag_docs: List[Dict[str, Any]]         # Retrieved document chunks
+
     # Planner
-    planner: Optional[Any] = Field(
-        default=None,
-        description="Planner output object (KPI, dates, category, etc.)"
-    )
-    
+    planner: Optional[Any]                 # PlannerOutput (KPI, dates, category, etc.)
+
     # SQL
-    sql: Optional[str] = Field(
-        default=None,
-        description="Generated SQL query"
-    )
-    
-    sql_explanation: Optional[str] = Field(
-        default=None,
-        description="Explanation of SQL based on planner fields"
-    )
-    
+    sql: Optional[str]                     # Generated SQL query
+    sql_explanation: Optional[str]         # Explanation of SQL based on planner fields
+    sql_candidates: List[Any]              # SQLGenOutput candidates, best first (candidate mode)
+
     # SQL execution
-    sql_result: Optional[Dict[str, Any]] = Field(
-        default=None,
-        description="Results of SQL execution: rows, columns, error"
-    )
-    
+    sql_result: Optional[Dict[str, Any]]   # rows, columns, error
+
     # Synthesize output
-    final_answer: Optional[Any] = Field(
-        default=None,
-        description="Final synthesized answer returned to user"
-    )
-    
+    final_answer: Optional[Any]            # SynthOutput returned to user
+
     # Repair
-    repair_info: Optional[Dict[str, Any]] = Field(
-        default=None,
-        description="Details about any SQL repair attempts"
-    )
-    
+    schema: Optional[str]                  # DB schema text, fetched once per session
+    repair_info: Optional[Dict[str, Any]]  # Details about any SQL repair attempts
+
     # Flow control
-    retries: int = Field(
-        default=0,
-        description="How many times repair loop has been attempted"
-    )
\ No newline at end of file
+    retries: int                           # Repair attempts so far
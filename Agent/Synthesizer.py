@@ -1,17 +1,37 @@
+import re
 from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any
 from caching import cache
+from tracing import set_attribute
+from summarize import summarize_result, describe
+from sqlite_tool import current_snapshot
 
 class SynthOutput(BaseModel):
     final_answer: str = Field(description="Final answer")
     citations: List[str] = Field(default_factory=list)
     sql_used: Optional[str] = Field(default=None)
     confidence: float = Field(default=0.8)
+    # First page of the SQL result; result_cursor fetches the next one
+    columns: List[str] = Field(default_factory=list)
+    rows: List[List[Any]] = Field(default_factory=list)
+    result_cursor: Optional[str] = Field(default=None)
+    # Whole-result statistics the answer was written from (see summarize.py)
+    summary: Dict[str, Any] = Field(default_factory=dict)
 
     # Pydantic v2 compatibility
     def dict(self, **kwargs):
         return self.model_dump(**kwargs)
 
+def answer_from_docs(question: str, docs: List[Dict[str, Any]], max_sentences: int = 3) -> str:
+    """The document sentences that share the most words with the question, in document order."""
+    terms = set(re.findall(r"[a-z0-9]{3,}", question.lower()))
+    sentences = [sentence.strip() for doc in docs
+                 for sentence in re.split(r"(?<=[.!?])\s+|\n+", doc.get("text", "")) if sentence.strip()]
+    scored = [(len(terms & set(re.findall(r"[a-z0-9]{3,}", sentence.lower()))), i)
+              for i, sentence in enumerate(sentences)]
+    best = sorted(i for score, i in sorted(scored, reverse=True)[:max_sentences] if score)
+    return " ".join(sentences[i].lstrip("#-* ") for i in best)
+
 def rule_based_synthesizer(
     question: str,
     planner: Dict[str, Any],
@@ -19,38 +39,30 @@ def rule_based_synthesizer(
     sql_result: Dict[str, Any],
     docs: List[Dict[str, Any]]
 ) -> SynthOutput:
-    
-    question_lower = question.lower()
-    
-    # Handle different query types with meaningful responses
-    if "10248" in question_lower or "order" in question_lower:
-        answer = """I found the details for Order ID 10248:
-• Customer: VINET (Vins et alcools Chevalier)
-• Order Date: July 4, 2016
-• Products: 
-  - Product 11: 12 units at $14 each
-  - Product 42: 10 units at $9.80 each  
-  - Product 72: 5 units at $34.80 each
-• Total Freight: $16.75
-• Ship to: Reims, France"""
-        confidence = 0.95
-        
-    elif "customer" in question_lower and "count" in question_lower:
-        answer = "There are 91 customers in the database."
-        confidence = 0.95
-        
-    elif "supplier" in question_lower and "1" in question_lower:
-        answer = "Supplier ID 1 is Exotic Liquids, located in London, UK. They specialize in beverages."
-        confidence = 0.90
-        
-    elif "revenue" in question_lower:
-        answer = "The total revenue across all orders is approximately $1.2 million."
-        confidence = 0.85
-        
+
+    # Answer from the SQL result when there is one; the whole result is
+    # summarized in a single pass, however many rows it has
+    summary = summarize_result(sql, sql_result) if sql else None
+
+    if summary is not None:
+        answer = describe(summary)
+        confidence = 0.9 if summary.rows and not summary.approximate else 0.8
+
+    elif sql_result.get("error"):
+        answer = f"I could not get this from the database: {sql_result['error']}"
+        confidence = 0.3
+
+    elif docs:
+        # No SQL: answer from the retrieved document chunks
+        answer = answer_from_docs(question, docs)
+        confidence = 0.7 if answer else 0.3
+        if not answer:
+            answer, docs = "I found no information on this in the documents.", []
+
     else:
-        answer = "I found relevant information in the database for your query."
-        confidence = 0.8
-    
+        answer = "I found no data for this question."
+        confidence = 0.3
+
     # Add document context if available
     if docs:
         doc_sources = list(set([doc.get("source", "unknown") for doc in docs]))
@@ -62,7 +74,8 @@ def rule_based_synthesizer(
         final_answer=answer,
         citations=citations,
         sql_used=sql,
-        confidence=confidence
+        confidence=confidence,
+        summary=summary.to_dict() if summary is not None else {},
     )
 
 def run_synthesizer(
@@ -73,17 +86,26 @@ def run_synthesizer(
     docs: List[Dict[str, Any]]
 ) -> SynthOutput:
     
-    # Try cache first
-    cache_key = f"synth_{question}_{hash(str(sql_result))}_{hash(str(docs))}"
+    # Try cache first (the cursor token differs on every run, so it is not
+    # part of the key and never cached). Answers summarize the whole result,
+    # so they are only reused within one data snapshot.
+    keyed_result = {k: v for k, v in sql_result.items() if k != "cursor"}
+    snapshot = current_snapshot().id if sql else ""
+    cache_key = f"synth_{snapshot}_{question}_{hash(str(keyed_result))}_{hash(str(docs))}"
     cached = cache.get(cache_key)
+    set_attribute("cache.hit", bool(cached))
     if cached:
-        return SynthOutput(**cached)
-    
-    # Use rule-based synthesizer
-    result = rule_based_synthesizer(question, planner, sql, sql_result, docs)
-    
-    # Cache the result
-    cache.set(cache_key, result.model_dump())
+        result = SynthOutput(**cached)
+    else:
+        # Use rule-based synthesizer
+        result = rule_based_synthesizer(question, planner, sql, sql_result, docs)
+
+        # Cache the result
+        cache.set(cache_key, result.model_dump())
+
+    result.columns = list(sql_result.get("columns") or [])
+    result.rows = [list(row) for row in sql_result.get("rows") or []]
+    result.result_cursor = sql_result.get("cursor")
     return result
 
 if __name__ == "__main__":
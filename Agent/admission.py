@@ -0,0 +1,216 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from logger import get_logger
+from tracing import set_attribute
+
+log = get_logger("admission")
+
+# Admission control for the agent.
+#
+# Every expensive stage (router / planner / repair LLM calls, SQLite
+# execution) runs under a StageLimiter: at most `limit` calls in flight,
+# at most `max_queue` waiting, waiters served interactive-before-batch.
+# A request carries one queue-time budget (per lane) that is spent across
+# all the stages it waits on; when it is gone, or a queue is full, the
+# request is shed with Overloaded instead of slowing everyone else down.
+#
+#   with admission.request("batch"):
+#       ...
+#       async with admission.stage("sql"):
+#           execute_sql_query(...)
+
+LANES = {"interactive": 0, "batch": 1}
+
+QUEUE_BUDGET_S = {
+    "interactive": float(os.getenv("AGENT_QUEUE_BUDGET_INTERACTIVE_S", "2")),
+    "batch": float(os.getenv("AGENT_QUEUE_BUDGET_BATCH_S", "30")),
+}
+
+STAGE_LIMITS = {
+    "router": int(os.getenv("AGENT_LIMIT_ROUTER", "8")),
+    "planner": int(os.getenv("AGENT_LIMIT_PLANNER", "8")),
+    "repair": int(os.getenv("AGENT_LIMIT_REPAIR", "4")),
+    "sql": int(os.getenv("AGENT_LIMIT_SQL", "4")),
+}
+STAGE_MAX_QUEUE = int(os.getenv("AGENT_STAGE_MAX_QUEUE", "64"))
+
+
+class Overloaded(Exception):
+    """A request was shed because a stage is saturated; maps to HTTP 503."""
+
+    def __init__(self, stage: str, reason: str, retry_after_s: float = 1.0):
+        super().__init__(f"Overloaded at {stage}: {reason}")
+        self.stage = stage
+        self.reason = reason
+        self.retry_after_s = retry_after_s
+
+
+class QueueBudget:
+    """Queue time a request may still spend waiting, shared by all stages."""
+
+    __slots__ = ("lane", "remaining_s")
+
+    def __init__(self, lane: str):
+        self.lane = lane
+        self.remaining_s = QUEUE_BUDGET_S[lane]
+
+
+_budget: ContextVar[Optional[QueueBudget]] = ContextVar("agent_queue_budget", default=None)
+
+
+@contextmanager
+def request(lane: str = "interactive"):
+    """Starts a request in `lane` with a fresh queue-time budget."""
+    if lane not in LANES:
+        raise ValueError(f"Unknown lane '{lane}', expected one of {list(LANES)}")
+    token = _budget.set(QueueBudget(lane))
+    try:
+        yield
+    finally:
+        _budget.reset(token)
+
+
+def current_budget() -> QueueBudget:
+    # Calls outside request() (benchmarks, scripts) get a per-call budget
+    return _budget.get() or QueueBudget("interactive")
+
+
+class StageLimiter:
+    """
+    Priority semaphore. Released slots are handed directly to the best
+    waiter (lowest lane, then FIFO), so a batch replay can never starve
+    interactive traffic of a freed slot.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self._reset(None)
+        self.admitted = 0
+        self.opportunistic = 0   # slots taken with try_acquire()
+        self.skipped = 0         # try_acquire() calls that found no free slot
+        self.rejected: Dict[str, int] = defaultdict(int)
+        self.peak_waiting = 0
+        self._wait_ms = deque(maxlen=1000)
+
+    def _reset(self, loop):
+        # Futures belong to one event loop; a new loop starts clean
+        self._loop = loop
+        self.active = 0
+        self.waiting = 0
+        self._waiters = []
+        self._seq = itertools.count()
+
+    def _reject(self, reason: str, lane: str) -> Overloaded:
+        self.rejected[reason] += 1
+        log.warning("Shedding request", extra={"stage": self.name, "reason": reason, "lane": lane})
+        set_attribute("admission.rejected", f"{self.name}:{reason}")
+        return Overloaded(self.name, reason)
+
+    async def acquire(self, budget: QueueBudget):
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._reset(loop)
+
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.admitted += 1
+            self._wait_ms.append(0.0)
+            return
+
+        if self.waiting >= self.max_queue:
+            raise self._reject("queue_full", budget.lane)
+        if budget.remaining_s <= 0:
+            raise self._reject("budget_exhausted", budget.lane)
+
+        future = loop.create_future()
+        heapq.heappush(self._waiters, (LANES[budget.lane], next(self._seq), future))
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        started = time.perf_counter()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), budget.remaining_s)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up; pass it on
+                self.release()
+            else:
+                future.cancel()
+            if isinstance(e, asyncio.TimeoutError):
+                budget.remaining_s = 0
+                raise self._reject("queue_timeout", budget.lane)
+            raise
+        finally:
+            self.waiting -= 1
+
+        waited = time.perf_counter() - started
+        budget.remaining_s -= waited
+        self.admitted += 1
+        self._wait_ms.append(waited * 1000)
+
+    def try_acquire(self) -> bool:
+        """
+        Takes a free slot without waiting, for optional extra work (e.g.
+        additional SQL candidates). Never jumps ahead of a waiter.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._reset(loop)
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self.opportunistic += 1
+            return True
+        self.skipped += 1
+        return False
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+    def stats(self) -> Dict[str, object]:
+        waits = sorted(self._wait_ms)
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "admitted": self.admitted,
+            "opportunistic": self.opportunistic,
+            "skipped": self.skipped,
+            "rejected": dict(self.rejected),
+            "wait_ms_p50": round(waits[len(waits) // 2], 3) if waits else 0.0,
+            "wait_ms_p95": round(waits[int(len(waits) * 0.95)], 3) if waits else 0.0,
+        }
+
+
+limiters: Dict[str, StageLimiter] = {
+    name: StageLimiter(name, limit, STAGE_MAX_QUEUE) for name, limit in STAGE_LIMITS.items()
+}
+
+
+@asynccontextmanager
+async def stage(name: str):
+    """Holds one `name` slot for the block; raises Overloaded if shed."""
+    limiter = limiters[name]
+    await limiter.acquire(current_budget())
+    try:
+        yield
+    finally:
+        limiter.release()
+
+
+def stats() -> Dict[str, Dict[str, object]]:
+    return {name: limiter.stats() for name, limiter in limiters.items()}
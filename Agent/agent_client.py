@@ -0,0 +1,87 @@
+import json
+import os
+from typing import Dict, Any, Iterator, Optional, Tuple
+
+import requests
+
+# Thin HTTP client for server.py. Streamlit pages use this instead of
+# importing the graph, so a page load never builds models or indexes.
+
+AGENT_API_URL = os.getenv("AGENT_API_URL", "http://127.0.0.1:8000")
+AGENT_API_TIMEOUT_S = float(os.getenv("AGENT_API_TIMEOUT_S", "120"))
+
+_session = requests.Session()
+
+
+class AgentUnavailable(Exception):
+    """The service is unreachable, overloaded or shutting down."""
+
+
+class AgentOverloaded(AgentUnavailable):
+    """The service shed the request (HTTP 503); retry after retry_after_s."""
+
+    def __init__(self, message: str, retry_after_s: float = 1.0):
+        super().__init__(message)
+        self.retry_after_s = retry_after_s
+
+
+class AgentFailed(Exception):
+    """The service ran the question but the run failed (HTTP 500)."""
+
+
+def _post(path: str, payload: Dict[str, Any], stream: bool = False) -> requests.Response:
+    try:
+        response = _session.post(f"{AGENT_API_URL}{path}", json=payload,
+                                 timeout=AGENT_API_TIMEOUT_S, stream=stream)
+    except requests.RequestException as e:
+        raise AgentUnavailable(f"Agent service unreachable at {AGENT_API_URL}: {e}")
+
+    if response.status_code == 503:
+        detail = response.json().get("detail", "Agent service busy")
+        if isinstance(detail, dict):
+            detail = f"Agent overloaded at {detail.get('stage')} ({detail.get('reason')})"
+        raise AgentOverloaded(detail, float(response.headers.get("Retry-After", 1)))
+    if response.status_code == 500:
+        detail = response.json().get("detail", "Agent run failed")
+        if isinstance(detail, dict):
+            detail = detail.get("detail", "Agent run failed")
+        raise AgentFailed(detail)
+    response.raise_for_status()
+    return response
+
+
+def ask(question: str, lane: str = "interactive", session_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Returns the answer as a dict with final_answer, citations, sql_used, confidence.
+    Pass the same session_id on every turn to ask follow-up questions.
+    """
+    return _post("/ask", {"question": question, "lane": lane, "session_id": session_id}).json()
+
+
+def next_page(cursor: str, page_size: int = 0) -> Dict[str, Any]:
+    """
+    Next page of an answer's SQL result: columns, rows, has_more and the
+    cursor for the page after (None at the end).
+    """
+    return _post("/results/next", {"cursor": cursor, "page_size": page_size}).json()
+
+
+def ask_stream(question: str, lane: str = "interactive",
+               session_id: Optional[str] = None) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yields (event, data) pairs: "node" per graph step, then "answer" (or "error").
+    """
+    response = _post("/ask/stream", {"question": question, "lane": lane, "session_id": session_id},
+                     stream=True)
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: ") and event:
+            yield event, json.loads(line[len("data: "):])
+            event = None
+
+
+if __name__ == "__main__":
+    for name, data in ask_stream("How many customers are in the database?"):
+        print(name, data)
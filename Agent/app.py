@@ -1,10 +1,12 @@
 import streamlit as st
-import asyncio
 import sys
 import os
+import uuid
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
+from agent_client import ask, next_page, AgentFailed, AgentOverloaded
+
 st.set_page_config(
     page_title="Retail Agent",
     page_icon="🤖",
@@ -14,45 +16,8 @@ st.set_page_config(
 st.title("🤖 Retail Analytics Agent")
 st.markdown("Ask questions about your retail data")
 
-# Sample responses for common queries
-def get_sample_response(query):
-    query_lower = query.lower()
-    
-    if "10248" in query_lower or "order" in query_lower:
-        return {
-            "answer": """**Order 10248 Details:**
-- **Customer:** VINET (Vins et alcools Chevalier)
-- **Order Date:** July 4, 2016  
-- **Products:**
-  • Product 11 (Queso Cabrales) - 12 units × $14.00
-  • Product 42 (Singaporean Hokkien Fried Mee) - 10 units × $9.80
-  • Product 72 (Mozzarella di Giovanni) - 5 units × $34.80
-- **Freight Cost:** $16.75
-- **Shipping Address:** Reims, France""",
-            "sql": "SELECT * FROM Orders WHERE OrderID = 10248",
-            "confidence": 0.95
-        }
-    
-    elif "customer" in query_lower and "count" in query_lower:
-        return {
-            "answer": "There are **91 customers** in the database.",
-            "sql": "SELECT COUNT(*) FROM Customers",
-            "confidence": 0.95
-        }
-    
-    elif "supplier" in query_lower and "1" in query_lower:
-        return {
-            "answer": "**Supplier ID 1:** Exotic Liquids (Beverages supplier based in London, UK)",
-            "sql": "SELECT * FROM Suppliers WHERE SupplierID = 1", 
-            "confidence": 0.90
-        }
-    
-    else:
-        return {
-            "answer": "I found relevant information for your query in the database.",
-            "sql": "Query executed successfully",
-            "confidence": 0.85
-        }
+# One conversation per browser tab, so "and for Condiments?" follows on
+st.session_state.setdefault("session_id", uuid.uuid4().hex)
 
 # Query input
 query = st.text_area(
@@ -64,35 +29,49 @@ query = st.text_area(
 if st.button("🚀 Get Answer", type="primary"):
     if query.strip():
         with st.spinner("🔍 Searching database..."):
+            st.session_state.pop("result", None)
             try:
-                # Try to use the real agent first
-                from Graph import run_agent
-                result = asyncio.run(run_agent(query))
-                
-                st.success("🤖 Answer:")
-                st.write(result.final_answer)
-                
-                if hasattr(result, 'sql_used') and result.sql_used:
-                    with st.expander("View SQL Query"):
-                        st.code(result.sql_used, language='sql')
-                
-                st.metric("Confidence", f"{getattr(result, 'confidence', 0.8):.0%}")
-                
+                # Ask the agent service (server.py); rendered below
+                st.session_state["result"] = ask(query, session_id=st.session_state["session_id"])
+
+            except AgentOverloaded as e:
+                st.warning(f"⏳ The agent is busy right now, please retry in {e.retry_after_s:.0f}s. ({e})")
+            except AgentFailed as e:
+                st.error(f"The agent could not answer this question: {e}")
             except Exception as e:
-                st.warning("Using sample data (Agent temporarily unavailable)")
-                # Fallback to sample responses
-                response = get_sample_response(query)
-                
-                st.success("🤖 Answer:")
-                st.markdown(response["answer"])
-                
-                with st.expander("View SQL Query"):
-                    st.code(response["sql"], language='sql')
-                
-                st.metric("Confidence", f"{response['confidence']:.0%}")
+                # No made-up sample answers: say the service is unavailable
+                st.error(f"The agent service is unavailable: {e}")
     else:
         st.warning("Please enter a question")
 
+# Answer of the last question, kept across reruns so "Load more" can
+# append pages to it
+result = st.session_state.get("result")
+if result:
+    st.success("🤖 Answer:")
+    st.write(result["final_answer"])
+
+    if result.get("sql_used"):
+        with st.expander("View SQL Query"):
+            st.code(result["sql_used"], language='sql')
+
+    st.metric("Confidence", f"{result.get('confidence', 0.8):.0%}")
+
+    if result.get("columns") and result.get("rows"):
+        st.dataframe(
+            [dict(zip(result["columns"], row)) for row in result["rows"]],
+            use_container_width=True
+        )
+        if result.get("result_cursor"):
+            if st.button(f"⬇️ Load more (showing {len(result['rows'])} rows)"):
+                try:
+                    page = next_page(result["result_cursor"])
+                    result["rows"].extend(page["rows"])
+                    result["result_cursor"] = page["cursor"]
+                    st.rerun()
+                except Exception as e:
+                    st.warning(f"Could not load more rows: {e}")
+
 # Quick queries
 st.markdown("### 💡 Try These Queries:")
 col1, col2, col3 = st.columns(3)
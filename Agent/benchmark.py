@@ -0,0 +1,326 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import time
+import threading
+import tracemalloc
+from collections import defaultdict
+from typing import List, Dict, Any
+
+# Offline benchmark for the full graph. Models are replaced by deterministic
+# stubs (stub_models.py) so timings reflect our own code plus a configurable
+# artificial LLM latency, never the provider.
+
+DEFAULT_QUESTIONS = [
+    "find me record of id 10248 from the database?",
+    "How many customers are in the database?",
+    "Revenue for Beverages",
+    "Revenue for Beverages during Summer Spice Campaign",
+    "What is the return policy for perishable products?",
+    "Top selling products in Condiments",
+    "Show supplier 1 details",
+    "How many products are in the catalog?",
+    "What is the definition of average order value KPI?",
+    "Total quantity sold for Seafood in 1997",
+]
+
+NODES = ["router", "retriever", "planner", "sql_gen", "sql_exec", "repair", "synth"]
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Linear-interpolated percentile (pct in 0..100)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "p99": round(percentile(values, 99), 3),
+        "mean": round(sum(values) / len(values), 3) if values else 0.0,
+    }
+
+
+def load_questions(path: str) -> List[str]:
+    """One question per line, or JSONL with a "question" field."""
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                questions.append(json.loads(line)["question"])
+            else:
+                questions.append(line)
+    return questions
+
+
+def setup_pipeline(args):
+    """
+    Installs stubs and data paths, then imports the compiled graph.
+    Must run before the first question so the lazily built retriever
+    uses the benchmark docs.
+    """
+    from stub_models import install_stub_models
+    import retrieval
+    import sqlite_tool
+
+    if args.docs:
+        retrieval.DOC_PATHS = [
+            os.path.join(args.docs, name)
+            for name in sorted(os.listdir(args.docs))
+            if name.endswith(".md")
+        ]
+    if args.db:
+        sqlite_tool.Database_path = args.db
+
+    stubs = install_stub_models(args.llm_latency_ms, args.llm_jitter_ms)
+
+    from Graph import app
+    return app, stubs
+
+
+async def run_once(app, question: str) -> Dict[str, Any]:
+    """
+    Runs one question through the graph. Node durations are the gaps between
+    streamed updates; nodes run sequentially so each gap is one node.
+    """
+    from State import AgentState
+    from tracing import start_span
+
+    node_ms = []
+    error = None
+    with start_span("benchmark.run") as root:
+        started = time.perf_counter()
+        last = started
+        try:
+            async for update in app.astream(AgentState(question=question), stream_mode="updates"):
+                now = time.perf_counter()
+                for node in update:
+                    node_ms.append((node, (now - last) * 1000))
+                last = now
+        except Exception as e:
+            error = str(e)
+
+    return {
+        "question": question,
+        "total_ms": (time.perf_counter() - started) * 1000,
+        "nodes": node_ms,
+        "error": error,
+        "trace_id": root.trace_id,
+    }
+
+
+class NodeTimeExporter:
+    """Sums node.* span time per trace; attached for the whole benchmark."""
+
+    def __init__(self):
+        self.inside_ms = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        with self._lock:
+            for span in spans:
+                if span.name.startswith("node."):
+                    self.inside_ms[span.trace_id] += span.duration_ms
+
+
+node_times = NodeTimeExporter()
+
+
+def graph_overhead_us(results: List[Dict[str, Any]]) -> List[float]:
+    """
+    Per-step cost of the graph runtime itself (state validation and copies,
+    channel updates, scheduling): wall time minus time inside node bodies,
+    divided by steps. Node time comes from the node.* spans; flush() waits
+    for the export thread, so every run's spans have reached node_times.
+    """
+    import tracing
+
+    tracing.flush()
+    return [
+        (r["total_ms"] - node_times.inside_ms[r["trace_id"]]) * 1000 / len(r["nodes"])
+        for r in results if r["trace_id"] in node_times.inside_ms and r["nodes"]
+    ]
+
+
+async def run_level(app, questions: List[str], concurrency: int, rounds: int) -> Dict[str, Any]:
+    """Runs rounds x questions with at most `concurrency` sessions in flight."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def session(question):
+        async with semaphore:
+            return await run_once(app, question)
+
+    jobs = [q for _ in range(rounds) for q in questions]
+    started = time.perf_counter()
+    results = await asyncio.gather(*(session(q) for q in jobs))
+    elapsed = time.perf_counter() - started
+
+    per_node = defaultdict(list)
+    for result in results:
+        for node, ms in result["nodes"]:
+            per_node[node].append(ms)
+
+    return {
+        "concurrency": concurrency,
+        "runs": len(results),
+        "errors": sum(1 for r in results if r["error"]),
+        "elapsed_s": round(elapsed, 3),
+        "throughput_qps": round(len(results) / elapsed, 3) if elapsed else 0.0,
+        "end_to_end_ms": summarize([r["total_ms"] for r in results]),
+        "nodes_ms": {node: summarize(per_node[node]) for node in NODES if per_node.get(node)},
+        "step_overhead_us": summarize(graph_overhead_us(results)),
+    }
+
+
+async def run_benchmark(args) -> Dict[str, Any]:
+    import tracing
+    import warmup
+
+    questions = load_questions(args.questions) if args.questions else DEFAULT_QUESTIONS
+
+    app, stubs = setup_pipeline(args)
+    from Classifier_route import router_batcher
+    from planner import planner_batcher
+    tracing.add_exporter(node_times)
+
+    # Build the retriever index and schema up front, then a warm-up pass, so
+    # lazy builds and first-call costs never land in a measured run
+    warm_ms = {}
+    warmup.warm_resources(warm_ms)
+    for question in questions[:args.warmup]:
+        await run_once(app, question)
+
+    levels = []
+    for concurrency in args.concurrency:
+        level = await run_level(app, questions, concurrency, args.rounds)
+        levels.append(level)
+        print(f"concurrency={concurrency}: {level['throughput_qps']} q/s, "
+              f"e2e p50={level['end_to_end_ms']['p50']} ms p99={level['end_to_end_ms']['p99']} ms, "
+              f"step overhead p50={level['step_overhead_us']['p50']} us")
+
+    # Memory in a separate pass: tracemalloc hooks every allocation and
+    # would inflate the latencies above
+    tracemalloc.start()
+    await run_level(app, questions, max(args.concurrency), 1)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "config": {
+            "questions": len(questions),
+            "rounds": args.rounds,
+            "llm_latency_ms": args.llm_latency_ms,
+            "llm_jitter_ms": args.llm_jitter_ms,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "warm_ms": warm_ms,
+        },
+        "levels": levels,
+        "llm_calls": {name: stub.calls for name, stub in stubs.items()},
+        "llm_batches": {"router": router_batcher.stats(), "planner": planner_batcher.stats()},
+        "memory": {
+            "tracemalloc_peak_mb": round(peak / 1024 / 1024, 2),
+            # ru_maxrss is KiB on Linux
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 2),
+        },
+    }
+
+
+def compare_runs(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    Lists regressions where a latency percentile grew, or throughput fell,
+    by more than `threshold` (fraction) at the same concurrency.
+    """
+    regressions = []
+    base_levels = {level["concurrency"]: level for level in baseline["levels"]}
+
+    for level in current["levels"]:
+        base = base_levels.get(level["concurrency"])
+        if not base:
+            continue
+        tag = f"c={level['concurrency']}"
+
+        series = [("end_to_end", base["end_to_end_ms"], level["end_to_end_ms"])]
+        for node, stats in level["nodes_ms"].items():
+            if node in base["nodes_ms"]:
+                series.append((node, base["nodes_ms"][node], stats))
+
+        for name, old, new in series:
+            for pct in ("p50", "p95", "p99"):
+                if old[pct] > 0 and new[pct] > old[pct] * (1 + threshold):
+                    regressions.append(f"{tag} {name} {pct}: {old[pct]} -> {new[pct]} ms")
+
+        if base["throughput_qps"] > 0 and level["throughput_qps"] < base["throughput_qps"] * (1 - threshold):
+            regressions.append(f"{tag} throughput: {base['throughput_qps']} -> {level['throughput_qps']} q/s")
+
+    old_peak = baseline["memory"]["tracemalloc_peak_mb"]
+    new_peak = current["memory"]["tracemalloc_peak_mb"]
+    if old_peak > 0 and new_peak > old_peak * (1 + threshold):
+        regressions.append(f"peak memory: {old_peak} -> {new_peak} MB")
+
+    return regressions
+
+
+def print_report(result: Dict[str, Any]):
+    for level in result["levels"]:
+        print(f"\n=== concurrency {level['concurrency']} "
+              f"({level['runs']} runs, {level['errors']} errors, {level['throughput_qps']} q/s)")
+        print(f"{'stage':<12}{'count':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+        rows = list(level["nodes_ms"].items()) + [("end_to_end", level["end_to_end_ms"])]
+        for name, stats in rows:
+            print(f"{name:<12}{stats['count']:>7}{stats['p50']:>10}{stats['p95']:>10}{stats['p99']:>10}")
+    print(f"\nLLM calls: {result['llm_calls']}")
+    print(f"LLM batches: {result['llm_batches']}")
+    print(f"Memory: {result['memory']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline benchmark for the agent graph")
+    parser.add_argument("--questions", default=None, help="Question corpus (text lines or JSONL)")
+    parser.add_argument("--docs", default=None, help="Directory of .md docs for the retriever")
+    parser.add_argument("--db", default=None, help="Path to northwind.db")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--llm-jitter-ms", type=float, default=10.0)
+    parser.add_argument("--concurrency", type=lambda s: [int(x) for x in s.split(",")], default=[1, 4, 16])
+    parser.add_argument("--rounds", type=int, default=3, help="Passes over the corpus per level")
+    parser.add_argument("--warmup", type=int, default=3, help="Questions to run before measuring")
+    parser.add_argument("--out", default=None, help="Write results JSON here")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), default=None,
+                        help="Compare two result files instead of running")
+    parser.add_argument("--threshold", type=float, default=0.10, help="Regression tolerance (fraction)")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0], "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        with open(args.compare[1], "r", encoding="utf-8") as f:
+            current = json.load(f)
+        regressions = compare_runs(baseline, current, args.threshold)
+        if regressions:
+            print("REGRESSIONS:")
+            for line in regressions:
+                print(" -", line)
+            raise SystemExit(1)
+        print("No regressions above threshold.")
+        raise SystemExit(0)
+
+    result = asyncio.run(run_benchmark(args))
+    print_report(result)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"\nResults written to {args.out}")
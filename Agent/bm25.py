@@ -0,0 +1,129 @@
+import json
+import os
+import re
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+# Okapi BM25 over the retriever's chunk store.
+#
+# The index is built once and held as flat NumPy arrays (CSR layout):
+#   term_ptr[t]:term_ptr[t+1]   postings of term t
+#   post_docs                   chunk ids (int32)
+#   post_weights                precomputed BM25 impact of the term in that
+#                               chunk (float32): idf * tf*(k1+1) / (tf + norm)
+#   doc_norms                   k1 * (1 - b + b * len/avg_len) per chunk
+# so a query is a handful of slices and one bincount; nothing is tokenized
+# or normalized per document at query time. The vocabulary is not capped.
+# save()/load() keep the arrays as .npy files; load(mmap=True) maps them
+# read-only, so worker processes share one copy through the page cache.
+
+TOKEN_RE = re.compile(r"(?u)\b\w\w+\b")   # TfidfVectorizer's default pattern
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_RE.findall(text.lower())
+
+
+ARRAYS = ("term_ptr", "post_docs", "post_weights", "idf", "doc_norms")
+
+
+class BM25Index:
+    def __init__(self, docs: List[str], k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.size = len(docs)
+
+        vocabulary: Dict[str, int] = {}
+        term_ids, doc_ids, doc_lengths = [], [], np.zeros(len(docs), dtype=np.float32)
+        for d, text in enumerate(docs):
+            tokens = tokenize(text)
+            doc_lengths[d] = len(tokens)
+            for token in tokens:
+                term_ids.append(vocabulary.setdefault(token, len(vocabulary)))
+            doc_ids.extend([d] * len(tokens))
+        self.vocabulary = vocabulary
+
+        # (term, doc) pairs -> term frequencies, grouped by term
+        terms = np.asarray(term_ids, dtype=np.int64)
+        chunks = np.asarray(doc_ids, dtype=np.int64)
+        pairs, tf = np.unique(terms * max(self.size, 1) + chunks, return_counts=True)
+        post_terms = pairs // max(self.size, 1)
+        self.post_docs = (pairs % max(self.size, 1)).astype(np.int32)
+
+        df = np.bincount(post_terms, minlength=len(vocabulary))
+        self.term_ptr = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(df, out=self.term_ptr[1:])
+        # Lucene's idf variant: stays positive even for very common terms
+        self.idf = np.log1p((self.size - df + 0.5) / (df + 0.5)).astype(np.float32)
+
+        avg_length = float(doc_lengths.mean()) if self.size else 0.0
+        self.doc_norms = (k1 * (1 - b + b * doc_lengths / (avg_length or 1.0))).astype(np.float32)
+        tf = tf.astype(np.float32)
+        self.post_weights = (self.idf[post_terms] * tf * (k1 + 1)
+                             / (tf + self.doc_norms[self.post_docs])).astype(np.float32)
+
+    def scores(self, query: str) -> np.ndarray:
+        """BM25 score of every chunk for `query` (zeros when nothing matches)."""
+        ids = {self.vocabulary[t] for t in tokenize(query) if t in self.vocabulary}
+        if not ids:
+            return np.zeros(self.size, dtype=np.float32)
+        slices = [slice(self.term_ptr[t], self.term_ptr[t + 1]) for t in ids]
+        docs = np.concatenate([self.post_docs[s] for s in slices])
+        weights = np.concatenate([self.post_weights[s] for s in slices])
+        return np.bincount(docs, weights=weights, minlength=self.size).astype(np.float32)
+
+    def search(self, query: str, top_k: int) -> List[Tuple[int, float]]:
+        scores = self.scores(query)
+        return top_indices(scores, top_k)
+
+    def memory_bytes(self) -> int:
+        """Index arrays plus an estimate of the vocabulary dict."""
+        arrays = (self.term_ptr, self.post_docs, self.post_weights, self.idf, self.doc_norms)
+        vocab = sum(len(term) + 56 for term in self.vocabulary) + 32 * len(self.vocabulary)
+        return sum(a.nbytes for a in arrays) + vocab
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, f"bm25_{name}.npy"), getattr(self, name))
+        terms = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.save(os.path.join(directory, "bm25_terms.npy"), np.array(terms, dtype=str))
+        with open(os.path.join(directory, "bm25.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "size": self.size}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True) -> "BM25Index":
+        """Index saved by save(); with mmap the arrays are read-only maps."""
+        index = cls.__new__(cls)
+        with open(os.path.join(directory, "bm25.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index.k1, index.b, index.size = meta["k1"], meta["b"], meta["size"]
+        mode = "r" if mmap else None
+        for name in ARRAYS:
+            setattr(index, name, np.load(os.path.join(directory, f"bm25_{name}.npy"), mmap_mode=mode))
+        terms = np.load(os.path.join(directory, "bm25_terms.npy"))
+        index.vocabulary = {term: i for i, term in enumerate(terms.tolist())}
+        return index
+
+
+def top_indices(scores: np.ndarray, top_k: int) -> List[Tuple[int, float]]:
+    """(index, score) of the top_k scores, best first, in O(n)."""
+    if top_k >= len(scores):
+        order = np.argsort(-scores, kind="stable")
+    else:
+        candidates = np.argpartition(-scores, top_k)[:top_k]
+        order = candidates[np.argsort(-scores[candidates], kind="stable")]
+    return [(int(i), float(scores[i])) for i in order]
+
+
+if __name__ == "__main__":
+    corpus = [
+        "Summer Spice Campaign runs from 1997-06-01 to 1997-06-30 for Condiments.",
+        "Perishable seafood may be returned within 3 days.",
+        "Average order value is revenue divided by the number of orders.",
+    ]
+    index = BM25Index(corpus)
+    for question in ["When does the Summer Spice Campaign start?", "seafood return policy"]:
+        print(question, index.search(question, 2))
+    print("index bytes:", index.memory_bytes())
@@ -0,0 +1,285 @@
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
+from typing import Any, Dict, Iterator, List, Set
+
+# Bulk (nightly) evaluation runner.
+#
+# Questions come from a JSONL file ({"id": ..., "question": ...}; id
+# defaults to the line number). The parent builds the retriever index once
+# and saves it as .npy files; every worker process memory-maps it
+# (retrieval.load_index), so N workers share one copy of the index through
+# the page cache. Each worker keeps its own SQLite connection per thread
+# (sqlite_tool.get_connection) and runs shards of questions through the
+# graph, --concurrency at a time, in the admission "batch" lane.
+#
+# Results are appended to --out as one JSON line per question as soon as a
+# shard finishes. The output file is the checkpoint: rerunning the same
+# command skips every id already in it, so an interrupted run resumes.
+#
+#   python bulk_runner.py --questions nightly.jsonl --out results.jsonl \
+#       --workers 8 --models stub --docs ../docs --db ../data/northwind.db
+
+
+def load_questions(path: str) -> List[Dict[str, Any]]:
+    """JSONL with a "question" (and optional "id"), or one question per line."""
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            entry = json.loads(line) if line.startswith("{") else {"question": line}
+            items.append({"id": str(entry.get("id", number)), "question": entry["question"]})
+    return items
+
+
+def completed_ids(path: str) -> Set[str]:
+    """Ids already written to a previous (possibly interrupted) output file."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)["id"]))
+            except (ValueError, KeyError):
+                continue  # a line cut short by a crash; that question reruns
+    return done
+
+
+def shards(items: List[Dict[str, Any]], size: int) -> Iterator[List[Dict[str, Any]]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def build_index(args) -> str:
+    """Builds the retriever indexes in the parent and saves them for the workers."""
+    import retrieval
+
+    if args.docs:
+        retrieval.DOC_PATHS = [os.path.join(args.docs, n) for n in sorted(os.listdir(args.docs))
+                               if n.endswith(".md")]
+    directory = args.index_dir or tempfile.mkdtemp(prefix="agent_index_")
+    docs, metadata, vectorizer, vectors = retrieval.init_retriever()
+    bm25_index = retrieval.build_bm25_index(docs) if docs and retrieval.RETRIEVER_ENGINE != "tfidf" else None
+    retrieval.save_index(directory, docs, metadata, vectorizer, vectors, bm25_index)
+    return directory
+
+
+# ---------------------------------------------------------------------------
+# Worker side
+# ---------------------------------------------------------------------------
+
+_stubs = None
+
+
+def init_worker(config: Dict[str, Any]):
+    """Process-pool initializer: maps the index, points at the DB, installs models."""
+    global _stubs
+    import registry
+    import retrieval
+    import sqlite_tool
+
+    if config["db"]:
+        sqlite_tool.Database_path = config["db"]
+    docs, metadata, vectorizer, vectors, bm25_index = retrieval.load_index(config["index_dir"])
+    registry.override("retriever", (docs, metadata, vectorizer, vectors))
+    if bm25_index is not None:
+        registry.override("bm25_index", bm25_index)
+
+    if config["models"] == "stub":
+        from stub_models import install_stub_models
+        _stubs = install_stub_models(config["llm_latency_ms"], config["llm_jitter_ms"])
+
+    import Graph  # noqa: F401 (registers the "graph" factory)
+    registry.warm("graph")
+
+
+async def run_question(graph, item: Dict[str, Any]) -> Dict[str, Any]:
+    import admission
+    import llm_usage
+    from State import AgentState
+
+    state: Dict[str, Any] = {}
+    node_ms = {}
+    error = None
+    started = last = time.perf_counter()
+    try:
+        with llm_usage.request() as usage, admission.request("batch"):
+            async for update in graph.astream(AgentState(question=item["question"]), stream_mode="updates"):
+                now = time.perf_counter()
+                for node, fields in update.items():
+                    node_ms[node] = round(node_ms.get(node, 0.0) + (now - last) * 1000, 3)
+                    state.update(fields or {})
+                last = now
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+
+    answer = state.get("final_answer")
+    if error is None and answer is None:
+        error = "AgentError: the run finished without an answer"
+    sql_result = state.get("sql_result") or {}
+    return {
+        "id": item["id"],
+        "question": item["question"],
+        "route": state.get("route"),
+        "final_answer": answer.final_answer if answer is not None else None,
+        "confidence": answer.confidence if answer is not None else None,
+        "sql": state.get("sql") or None,
+        "sql_error": sql_result.get("error"),
+        "rows": (answer.summary.get("rows") if answer is not None and answer.summary
+                 else len(sql_result.get("rows") or [])),
+        "repairs": state.get("retries", 0),
+        "llm_tokens": usage.total.total_tokens,
+        "error": error,
+        "total_ms": round((time.perf_counter() - started) * 1000, 3),
+        "nodes_ms": node_ms,
+        "pid": os.getpid(),
+    }
+
+
+def worker_stats() -> Dict[str, Any]:
+    """Cumulative cache / memo / model counters of this worker process."""
+    from caching import cache
+    import llm_usage
+    from Classifier_route import router_batcher
+    from planner import planner_batcher
+    from Repair_loop import repair_memo
+
+    stats = {
+        "repair_memo": repair_memo.stats(),
+        "llm_batches": {"router": router_batcher.stats(), "planner": planner_batcher.stats()},
+        "llm_usage": llm_usage.stats(),
+    }
+    if hasattr(cache, "stats"):
+        stats["cache"] = cache.stats()
+    elif hasattr(cache, "__len__"):
+        stats["cache"] = {"entries": len(cache)}
+    if _stubs is not None:
+        stats["llm_calls"] = {name: stub.calls for name, stub in _stubs.items()}
+    return stats
+
+
+def run_shard(shard: List[Dict[str, Any]], concurrency: int) -> Dict[str, Any]:
+    import registry
+
+    async def run_all():
+        graph = registry.get("graph")
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(item):
+            async with semaphore:
+                return await run_question(graph, item)
+
+        return await asyncio.gather(*(one(item) for item in shard))
+
+    records = asyncio.run(run_all())
+    return {"pid": os.getpid(), "records": records, "stats": worker_stats()}
+
+
+# ---------------------------------------------------------------------------
+# Parent side
+# ---------------------------------------------------------------------------
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * pct / 100)))]
+
+
+def run(args) -> Dict[str, Any]:
+    items = load_questions(args.questions)
+    done = completed_ids(args.out) if args.resume else set()
+    pending = [item for item in items if item["id"] not in done]
+    if not args.resume and os.path.exists(args.out):
+        os.remove(args.out)
+
+    print(f"{len(items)} questions, {len(done)} already done, {len(pending)} to run "
+          f"on {args.workers} workers")
+    if not pending:
+        return {"questions": len(items), "skipped": len(done), "ran": 0}
+
+    index_dir = build_index(args)
+    config = {
+        "index_dir": index_dir,
+        "db": args.db,
+        "models": args.models,
+        "llm_latency_ms": args.llm_latency_ms,
+        "llm_jitter_ms": args.llm_jitter_ms,
+    }
+
+    started = time.perf_counter()
+    latencies, errors, written = [], 0, 0
+    stats_by_pid: Dict[int, Dict[str, Any]] = {}
+    try:
+        with open(args.out, "a", encoding="utf-8") as out, \
+                ProcessPoolExecutor(max_workers=args.workers, mp_context=get_context(args.start_method),
+                                    initializer=init_worker, initargs=(config,)) as pool:
+            futures = [pool.submit(run_shard, shard, args.concurrency)
+                       for shard in shards(pending, args.shard_size)]
+            for future in as_completed(futures):
+                result = future.result()
+                for record in result["records"]:
+                    out.write(json.dumps(record, default=str) + "\n")
+                    latencies.append(record["total_ms"])
+                    errors += bool(record["error"])
+                # Checkpoint: a finished shard is on disk before the next is counted
+                out.flush()
+                os.fsync(out.fileno())
+                written += len(result["records"])
+                stats_by_pid[result["pid"]] = result["stats"]
+                if args.progress:
+                    print(f"  {written}/{len(pending)} done ({time.perf_counter() - started:.1f}s)")
+    finally:
+        if not args.index_dir:
+            shutil.rmtree(index_dir, ignore_errors=True)
+
+    elapsed = time.perf_counter() - started
+    summary = {
+        "questions": len(items),
+        "skipped": len(done),
+        "ran": written,
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_qps": round(written / elapsed, 3) if elapsed else 0.0,
+        "total_ms_p50": round(_percentile(latencies, 50), 3),
+        "total_ms_p95": round(_percentile(latencies, 95), 3),
+        "workers": {str(pid): stats for pid, stats in stats_by_pid.items()},
+    }
+    if args.summary:
+        with open(args.summary, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2, default=str)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a JSONL file of questions through the agent in bulk")
+    parser.add_argument("--questions", required=True, help="JSONL of {id, question} (or one question per line)")
+    parser.add_argument("--out", required=True, help="JSONL results; also the resume checkpoint")
+    parser.add_argument("--summary", default=None, help="Write run totals and per-worker stats as JSON")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--concurrency", type=int, default=8, help="Questions in flight per worker")
+    parser.add_argument("--shard-size", type=int, default=50, help="Questions per task sent to a worker")
+    parser.add_argument("--models", choices=["stub", "real"], default="stub",
+                        help="stub: deterministic local models (stub_models.py); real: the configured LLMs")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Stub model latency")
+    parser.add_argument("--llm-jitter-ms", type=float, default=0.0, help="Stub model latency jitter")
+    parser.add_argument("--docs", default=None, help="Directory of .md docs (default: retrieval.DOC_PATHS)")
+    parser.add_argument("--db", default=None, help="SQLite database (default: sqlite_tool.Database_path)")
+    parser.add_argument("--index-dir", default=None, help="Where to save the shared index (default: temp dir)")
+    parser.add_argument("--start-method", choices=["spawn", "forkserver", "fork"], default="spawn")
+    parser.add_argument("--no-resume", dest="resume", action="store_false",
+                        help="Start over instead of skipping ids already in --out")
+    parser.add_argument("--progress", action="store_true", help="Print a line per finished shard")
+    args = parser.parse_args()
+
+    result = run(args)
+    print(json.dumps({k: v for k, v in result.items() if k != "workers"}, indent=2))
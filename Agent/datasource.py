@@ -0,0 +1,265 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("datasource")
+
+# Where SQL reads come from.
+#
+# live mode (default)  sqlite_tool.Database_path, opened as a normal file.
+# snapshot mode        DATA_SNAPSHOT_DIR is set. The nightly load publishes
+#                      an immutable copy of the database:
+#
+#     python datasource.py publish --source northwind.db --dir /data/snapshots
+#
+#   publish copies the source with SQLite's backup API into <id>.db (plus
+#   DATA_REPLICAS copies <id>.r1.db ... to spread reads), writes the
+#   manifest <id>.json, then swaps the CURRENT manifest with an atomic
+#   rename. Readers open snapshot files with mode=ro&immutable=1: SQLite
+#   takes no locks and never checks for changes, so reads never wait on
+#   the load, and a published file is never written again.
+#
+# Each process re-reads CURRENT at most every DATA_CHECK_INTERVAL_S; a
+# thread whose connection belongs to an older snapshot reopens on its next
+# query, while queries already running finish on the old file. Caches that
+# depend on the data key off Snapshot.id.
+
+DATA_SNAPSHOT_DIR = os.getenv("DATA_SNAPSHOT_DIR")
+DATA_REPLICAS = int(os.getenv("DATA_REPLICAS", "0"))
+DATA_CHECK_INTERVAL_S = float(os.getenv("DATA_CHECK_INTERVAL_S", "2"))
+DATA_KEEP_SNAPSHOTS = int(os.getenv("DATA_KEEP_SNAPSHOTS", "2"))
+
+CURRENT = "CURRENT"
+LIVE = "live"
+
+
+class Snapshot:
+    """One version of the data: an id and the files that hold it."""
+
+    __slots__ = ("id", "paths", "immutable", "created")
+
+    def __init__(self, id: str, paths: Tuple[str, ...], immutable: bool, created: float = 0.0):
+        self.id = id
+        self.paths = paths
+        self.immutable = immutable
+        self.created = created
+
+    @classmethod
+    def from_manifest(cls, manifest: Dict[str, Any]) -> "Snapshot":
+        return cls(manifest["id"], tuple(manifest["paths"]), True, manifest.get("created", 0.0))
+
+    def uri(self, path: str, read_only: bool = True) -> str:
+        uri = Path(path).resolve().as_uri()
+        if self.immutable:
+            return uri + "?mode=ro&immutable=1"
+        return uri + "?mode=ro" if read_only else uri
+
+
+_lock = threading.Lock()
+_current: Optional[Snapshot] = None
+_checked = 0.0
+_manifest_mtime = None
+_swaps = 0
+_next_replica = itertools.count()
+
+
+def _read_manifest(path: str) -> Dict[str, Any]:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def current(live_path: str) -> Snapshot:
+    """The snapshot new connections should use (live_path in live mode)."""
+    global _current, _checked, _manifest_mtime, _swaps
+    if not DATA_SNAPSHOT_DIR:
+        return Snapshot(LIVE, (live_path,), False)
+
+    now = time.monotonic()
+    if _current is not None and now - _checked < DATA_CHECK_INTERVAL_S:
+        return _current
+    with _lock:
+        if _current is not None and now - _checked < DATA_CHECK_INTERVAL_S:
+            return _current
+        manifest_path = os.path.join(DATA_SNAPSHOT_DIR, CURRENT)
+        try:
+            mtime = os.stat(manifest_path).st_mtime_ns
+            if mtime != _manifest_mtime or _current is None:
+                snapshot = Snapshot.from_manifest(_read_manifest(manifest_path))
+                if _current is not None and snapshot.id != _current.id:
+                    _swaps += 1
+                    log.info("Switched data snapshot", extra={"from": _current.id, "to": snapshot.id})
+                _current, _manifest_mtime = snapshot, mtime
+        except (OSError, ValueError, KeyError) as e:
+            if _current is None:
+                raise RuntimeError(f"No data snapshot published in {DATA_SNAPSHOT_DIR}: {e}")
+            log.warning("Could not read snapshot manifest, keeping current", extra={"error": str(e)})
+        _checked = now
+        return _current
+
+
+def find(snapshot_id: str) -> Optional[Snapshot]:
+    """A published snapshot by id, if its files are still there."""
+    if not DATA_SNAPSHOT_DIR or not snapshot_id or snapshot_id == LIVE:
+        return None
+    if _current is not None and _current.id == snapshot_id:
+        return _current
+    try:
+        snapshot = Snapshot.from_manifest(_read_manifest(os.path.join(DATA_SNAPSHOT_DIR, f"{snapshot_id}.json")))
+    except (OSError, ValueError, KeyError):
+        return None
+    return snapshot if all(os.path.exists(p) for p in snapshot.paths) else None
+
+
+def connect(snapshot: Snapshot, read_only: bool = True, **kwargs) -> sqlite3.Connection:
+    """
+    Opens one of the snapshot's files (replicas round-robin). Live mode
+    keeps the old behaviour: a plain connection unless read_only.
+    """
+    path = snapshot.paths[next(_next_replica) % len(snapshot.paths)]
+    if not snapshot.immutable and not read_only:
+        return sqlite3.connect(path, **kwargs)
+    return sqlite3.connect(snapshot.uri(path, read_only), uri=True, **kwargs)
+
+
+def stats() -> Dict[str, Any]:
+    if not DATA_SNAPSHOT_DIR:
+        return {"mode": LIVE}
+    return {
+        "mode": "snapshot",
+        "snapshot": _current.id if _current else None,
+        "replicas": len(_current.paths) if _current else 0,
+        "swaps": _swaps,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Publishing (nightly load side)
+# ---------------------------------------------------------------------------
+
+def _fsync(path: str):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _write_atomic(path: str, text: str):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def publish_snapshot(source: str, directory: str, snapshot_id: str = None,
+                     replicas: int = None, keep: int = None) -> Dict[str, Any]:
+    """
+    Copies `source` into an immutable snapshot in `directory`, then makes it
+    CURRENT. Safe while `source` is being written: the backup API copies a
+    consistent state. Returns the manifest.
+    """
+    replicas = DATA_REPLICAS if replicas is None else replicas
+    keep = DATA_KEEP_SNAPSHOTS if keep is None else keep
+    snapshot_id = snapshot_id or time.strftime("%Y%m%dT%H%M%S")
+    os.makedirs(directory, exist_ok=True)
+
+    primary = os.path.join(directory, f"{snapshot_id}.db")
+    if os.path.exists(primary):
+        raise FileExistsError(f"Snapshot '{snapshot_id}' already exists in {directory}")
+
+    started = time.perf_counter()
+    tmp = primary + ".tmp"
+    src = sqlite3.connect(Path(source).resolve().as_uri() + "?mode=ro", uri=True)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst)
+        # Readers open it immutable: no journal may ever be needed
+        dst.execute("PRAGMA journal_mode=DELETE")
+    finally:
+        dst.close()
+        src.close()
+    _fsync(tmp)
+    os.replace(tmp, primary)
+
+    paths = [primary]
+    for r in range(1, replicas + 1):
+        replica = os.path.join(directory, f"{snapshot_id}.r{r}.db")
+        shutil.copyfile(primary, replica + ".tmp")
+        _fsync(replica + ".tmp")
+        os.replace(replica + ".tmp", replica)
+        paths.append(replica)
+
+    manifest = {"id": snapshot_id, "paths": [os.path.abspath(p) for p in paths], "created": time.time(),
+                "source": os.path.abspath(source)}
+    text = json.dumps(manifest, indent=2)
+    _write_atomic(os.path.join(directory, f"{snapshot_id}.json"), text)
+    # The swap: readers see either the old manifest or the new one
+    _write_atomic(os.path.join(directory, CURRENT), text)
+    log.info("Published data snapshot", extra={"snapshot": snapshot_id, "replicas": replicas,
+                                               "ms": round((time.perf_counter() - started) * 1000, 1)})
+    prune_snapshots(directory, keep)
+    return manifest
+
+
+def list_snapshots(directory: str) -> List[Dict[str, Any]]:
+    """Published manifests, newest first."""
+    manifests = []
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        try:
+            manifests.append(_read_manifest(path))
+        except (OSError, ValueError):
+            continue
+    return sorted(manifests, key=lambda m: m.get("created", 0), reverse=True)
+
+
+def prune_snapshots(directory: str, keep: int) -> List[str]:
+    """
+    Deletes all but the newest `keep` snapshots (never CURRENT). Processes
+    still reading a deleted file keep their open handle until they reopen.
+    """
+    current_id = _read_manifest(os.path.join(directory, CURRENT))["id"]
+    removed = []
+    for manifest in list_snapshots(directory)[max(keep, 1):]:
+        if manifest["id"] == current_id:
+            continue
+        for path in manifest["paths"]:
+            if os.path.exists(path):
+                os.remove(path)
+        os.remove(os.path.join(directory, f"{manifest['id']}.json"))
+        removed.append(manifest["id"])
+    return removed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Publish and inspect immutable data snapshots")
+    sub = parser.add_subparsers(dest="command", required=True)
+    publish = sub.add_parser("publish", help="Copy a database into a new snapshot and make it current")
+    publish.add_argument("--source", required=True, help="Database written by the load")
+    publish.add_argument("--dir", default=DATA_SNAPSHOT_DIR, required=DATA_SNAPSHOT_DIR is None)
+    publish.add_argument("--id", default=None, help="Snapshot id (default: timestamp)")
+    publish.add_argument("--replicas", type=int, default=DATA_REPLICAS, help="Extra copies to spread reads")
+    publish.add_argument("--keep", type=int, default=DATA_KEEP_SNAPSHOTS, help="Snapshots to keep")
+    status = sub.add_parser("status", help="List snapshots")
+    status.add_argument("--dir", default=DATA_SNAPSHOT_DIR, required=DATA_SNAPSHOT_DIR is None)
+    args = parser.parse_args()
+
+    if args.command == "publish":
+        print(json.dumps(publish_snapshot(args.source, args.dir, args.id, args.replicas, args.keep), indent=2))
+    else:
+        current_id = _read_manifest(os.path.join(args.dir, CURRENT))["id"]
+        for manifest in list_snapshots(args.dir):
+            marker = "*" if manifest["id"] == current_id else " "
+            print(f"{marker} {manifest['id']}  {len(manifest['paths'])} file(s)  "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(manifest['created']))}")
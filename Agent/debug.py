@@ -1,12 +1,11 @@
 import streamlit as st
-import asyncio
 import traceback
 import sys
 import os
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from Graph import run_agent
+from agent_client import ask_stream, AgentUnavailable
 
 st.set_page_config(page_title="Debug Agent", layout="wide")
 
@@ -16,19 +15,23 @@ def debug_agent(query):
         st.write("🔍 **Debug Info:**")
         st.write(f"Query: `{query}`")
         
-        # Test basic imports
-        st.write("✅ Basic imports working")
-        
-        # Test agent execution
+        # Stream the run from the agent service, one event per graph node
         st.write("🚀 Attempting to run agent...")
-        result = asyncio.run(run_agent(query))
+        result = None
+        for event, data in ask_stream(query):
+            if event == "node":
+                st.write(f"➡️ `{data.pop('node')}`", data)
+            elif event == "answer":
+                result = data
+            elif event == "error":
+                st.error(f"❌ Agent Error: {data.get('detail')}")
         
-        st.write("✅ Agent executed successfully!")
+        if result:
+            st.write("✅ Agent executed successfully!")
         return result
         
-    except ImportError as e:
-        st.error(f"❌ Import Error: {e}")
-        st.code(traceback.format_exc())
+    except AgentUnavailable as e:
+        st.error(f"❌ Agent service unavailable: {e}")
     except Exception as e:
         st.error(f"❌ Execution Error: {e}")
         st.code(traceback.format_exc())
@@ -44,4 +47,4 @@ if st.button("Debug Query"):
     result = debug_agent(query)
     if result:
         st.success("✅ Query successful!")
-        st.json(result.dict() if hasattr(result, 'dict') else str(result))
\ No newline at end of file
+        st.json(result)
\ No newline at end of file
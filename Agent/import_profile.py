@@ -0,0 +1,92 @@
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import List, Dict, Any
+
+# Import-time guard. Runs `python -X importtime -c "import <module>"` in a
+# fresh interpreter and fails if the cold import is over budget or pulls in
+# modules that must stay lazy (see registry.py).
+
+AGENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Heavy packages that should only load on first use
+LAZY_MODULES = [
+    "sklearn", "scipy", "langgraph", "langsmith",
+    "langchain_groq", "langchain_google_genai", "groq"
+]
+
+LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def profile_import(module: str) -> List[Dict[str, Any]]:
+    """
+    Returns one entry per imported module with self/cumulative microseconds.
+    """
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=AGENT_DIR, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr[-2000:]}")
+
+    entries = []
+    for line in proc.stderr.splitlines():
+        match = LINE_RE.match(line)
+        if match:
+            entries.append({
+                "module": match.group(4),
+                "self_us": int(match.group(1)),
+                "cumulative_us": int(match.group(2)),
+                "depth": len(match.group(3)) // 2,
+            })
+    return entries
+
+
+def check(entries: List[Dict[str, Any]], module: str, budget_ms: float) -> List[str]:
+    """Lists budget and laziness violations."""
+    problems = []
+    top = next((e for e in reversed(entries) if e["module"] == module), None)
+    total_ms = top["cumulative_us"] / 1000 if top else 0.0
+    if total_ms > budget_ms:
+        problems.append(f"import {module} took {total_ms:.0f} ms (budget {budget_ms:.0f} ms)")
+
+    loaded = {e["module"].split(".")[0] for e in entries}
+    for name in LAZY_MODULES:
+        if name in loaded:
+            problems.append(f"import {module} eagerly loads {name}")
+    return problems
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold import profile and guard")
+    parser.add_argument("module", nargs="?", default="Graph")
+    parser.add_argument("--budget-ms", type=float, default=500.0)
+    parser.add_argument("--top", type=int, default=20, help="Show the N slowest packages")
+    args = parser.parse_args()
+
+    entries = profile_import(args.module)
+
+    # Self time summed per top-level package
+    by_package = {}
+    for entry in entries:
+        package = entry["module"].split(".")[0]
+        by_package[package] = by_package.get(package, 0) + entry["self_us"]
+
+    print(f"{'package':<40}{'self ms':>10}")
+    for package, self_us in sorted(by_package.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f"{package:<40}{self_us / 1000:>10.1f}")
+
+    top = next((e for e in reversed(entries) if e["module"] == args.module), None)
+    if top:
+        print(f"\nimport {args.module}: {top['cumulative_us'] / 1000:.1f} ms cumulative")
+
+    problems = check(entries, args.module, args.budget_ms)
+    if problems:
+        print("\nFAILED:")
+        for problem in problems:
+            print(" -", problem)
+        raise SystemExit(1)
+    print(f"\nOK: import {args.module} within {args.budget_ms:.0f} ms and no eager heavy imports")
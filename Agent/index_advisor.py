@@ -0,0 +1,418 @@
+import argparse
+import json
+import os
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+from collections import Counter
+from typing import List, Dict, Any, Optional, Tuple
+
+from sqlite_tool import Database_path, SQL_LOG_PATH, explain_query_plan
+
+# Offline index advisor. Works on a COPY of northwind.db so the read-only
+# serving path is never touched; indexes are only created with --apply.
+
+SQL_KEYWORDS = {
+    "WHERE", "JOIN", "INNER", "LEFT", "RIGHT", "OUTER", "CROSS", "ON", "GROUP",
+    "ORDER", "LIMIT", "HAVING", "UNION", "USING", "NATURAL", "AS"
+}
+
+MAX_INDEX_COLUMNS = 6
+
+TABLE_REF_RE = re.compile(
+    r'\b(?:FROM|JOIN)\s+("[^"]+"|\[[^\]]+\]|`[^`]+`|\w+)(?:\s+(?:AS\s+)?(\w+))?',
+    re.IGNORECASE
+)
+QUALIFIED_COL_RE = re.compile(r'("[^"]+"|\w+)\.("[^"]+"|\w+)')
+SCAN_RE = re.compile(r'^SCAN (?:TABLE )?("[^"]+"|\S+)(?: AS \S+)?(.*)$')
+
+
+def load_logged_queries(log_path: str) -> Counter:
+    """
+    Reads executed SELECTs from a SQL_LOG_PATH style JSONL file.
+    Returns a Counter of query text -> times executed.
+    """
+    queries = Counter()
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            sql = " ".join(entry.get("sql", "").split())
+            if sql.upper().startswith("SELECT"):
+                queries[sql] += 1
+    return queries
+
+
+def make_work_copy(db_path: str, work_path: Optional[str] = None) -> str:
+    """
+    Copies the database so analysis and index creation never touch the original.
+    Uses the SQLite backup API, so pages still in a WAL file are included and
+    the copy is consistent while the agent keeps serving from the original.
+    """
+    if work_path is None:
+        work_dir = tempfile.mkdtemp(prefix="index_advisor_")
+        work_path = os.path.join(work_dir, os.path.basename(db_path))
+    source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    target = sqlite3.connect(work_path)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return work_path
+
+
+def _unquote(name: str) -> str:
+    if name[:1] in ('"', "[", "`"):
+        return name[1:-1]
+    return name
+
+
+def _table_columns(conn: sqlite3.Connection, table: str) -> List[str]:
+    return [row[1] for row in conn.execute(f"PRAGMA table_info('{table}')").fetchall()]
+
+
+def _existing_indexes(conn: sqlite3.Connection, table: str) -> List[List[str]]:
+    indexes = []
+    for row in conn.execute(f"PRAGMA index_list('{table}')").fetchall():
+        cols = [c[2] for c in conn.execute(f"PRAGMA index_info('{row[1]}')").fetchall()]
+        indexes.append(cols)
+    # INTEGER PRIMARY KEY is the rowid and acts as an index on that column
+    for col in conn.execute(f"PRAGMA table_info('{table}')").fetchall():
+        if col[5] == 1 and col[2].upper() == "INTEGER":
+            indexes.append([col[1]])
+    return indexes
+
+
+def _key_column(conn: sqlite3.Connection, table: str) -> Tuple[Optional[str], bool]:
+    """
+    The single-column primary key of a table, if it has one, and whether it
+    is the rowid. Lookups on it are already indexed (the rowid, or the
+    automatic unique index), so it never leads a proposed index; the rowid
+    is stored in every index, so it is not added as a covering column either.
+    """
+    pk = [col for col in conn.execute(f"PRAGMA table_info('{table}')").fetchall() if col[5]]
+    if len(pk) != 1:
+        return None, False
+    return pk[0][1], pk[0][2].upper() == "INTEGER"
+
+
+def _split_clauses(sql: str) -> Dict[str, str]:
+    """
+    Cuts a single SELECT into the clauses the advisor cares about.
+    """
+    upper = sql.upper()
+    markers = [
+        ("select", r"\bSELECT\b"),
+        ("from", r"\bFROM\b"),
+        ("where", r"\bWHERE\b"),
+        ("group", r"\bGROUP\s+BY\b"),
+        ("having", r"\bHAVING\b"),
+        ("order", r"\bORDER\s+BY\b"),
+        ("limit", r"\bLIMIT\b"),
+    ]
+    positions = []
+    for name, pattern in markers:
+        match = re.search(pattern, upper)
+        if match:
+            positions.append((match.start(), match.end(), name))
+    positions.sort()
+
+    clauses = {}
+    for i, (start, end, name) in enumerate(positions):
+        stop = positions[i + 1][0] if i + 1 < len(positions) else len(sql)
+        clauses[name] = sql[end:stop]
+    return clauses
+
+
+class QueryColumns:
+    """
+    Columns referenced by a query, grouped per table and per usage.
+    """
+
+    def __init__(self, aliases: Dict[str, str]):
+        self.aliases = aliases
+        self.equality = {}
+        self.range = {}
+        self.ordering = {}
+        self.referenced = {}
+        self.filtered = set()   # tables with a predicate in WHERE (not just a join)
+
+    def add(self, bucket: Dict[str, List[str]], table: str, column: str):
+        cols = bucket.setdefault(table, [])
+        if column not in cols:
+            cols.append(column)
+
+
+def analyze_columns(sql: str, conn: sqlite3.Connection) -> QueryColumns:
+    """
+    Heuristically maps column references in a query to their tables.
+    """
+    aliases = {}
+    table_cols = {}
+    for match in TABLE_REF_RE.finditer(sql):
+        table = _unquote(match.group(1))
+        if table.upper() == "SELECT":
+            continue
+        cols = _table_columns(conn, table)
+        if not cols:
+            continue
+        table_cols[table] = cols
+        aliases[table.lower()] = table
+        alias = match.group(2)
+        if alias and alias.upper() not in SQL_KEYWORDS:
+            aliases[alias.lower()] = table
+
+    def resolve(text: str):
+        """Yields (table, column, start, end) for every column reference in text."""
+        seen_spans = []
+        for match in QUALIFIED_COL_RE.finditer(text):
+            table = aliases.get(_unquote(match.group(1)).lower())
+            column = _unquote(match.group(2))
+            if table and column in table_cols[table]:
+                seen_spans.append((match.start(), match.end()))
+                yield table, column, match.start(), match.end()
+        for match in re.finditer(r'"[^"]+"|\b\w+\b', text):
+            if any(s <= match.start() < e for s, e in seen_spans):
+                continue
+            name = _unquote(match.group(0))
+            owners = [t for t, cols in table_cols.items() if name in cols]
+            if len(owners) == 1:
+                yield owners[0], name, match.start(), match.end()
+
+    result = QueryColumns(aliases)
+    clauses = _split_clauses(sql)
+    result.filtered = {table for table, _, _, _ in resolve(clauses.get("where", ""))}
+
+    # Predicates in WHERE and in JOIN ... ON
+    predicate_text = clauses.get("where", "")
+    predicate_text += " " + " ".join(re.findall(r'\bON\b(.*?)(?=\bJOIN\b|\bLEFT\b|\bINNER\b|$)',
+                                                clauses.get("from", ""), re.IGNORECASE | re.DOTALL))
+    for table, column, start, end in resolve(predicate_text):
+        before = predicate_text[max(0, start - 3):start].strip()
+        after = predicate_text[end:end + 12].strip().upper()
+        if after.startswith("=") or before.endswith("=") or after.startswith("IN ") or after.startswith("IN("):
+            result.add(result.equality, table, column)
+        elif after[:1] in ("<", ">") or before[-1:] in ("<", ">") or after.startswith("BETWEEN"):
+            result.add(result.range, table, column)
+        result.add(result.referenced, table, column)
+
+    for clause in ("group", "order"):
+        for table, column, _, _ in resolve(clauses.get(clause, "")):
+            result.add(result.ordering, table, column)
+            result.add(result.referenced, table, column)
+
+    for clause in ("select", "having"):
+        select_text = clauses.get(clause, "")
+        if clause == "select" and re.search(r'(^|,)\s*("?\w+"?\.)?\*\s*(,|$)', select_text.strip()):
+            continue
+        for table, column, _, _ in resolve(select_text):
+            result.add(result.referenced, table, column)
+
+    return result
+
+
+def plan_problems(plan: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    Finds full table scans and temp B-trees in an EXPLAIN QUERY PLAN result.
+    Every SCAN reads the whole table, including "USING [COVERING] INDEX"
+    scans, which only read it in index order; lookups show up as SEARCH.
+    """
+    full_scans = []
+    temp_btrees = []
+    for row in plan:
+        detail = row["detail"]
+        scan = SCAN_RE.match(detail)
+        if scan and scan.group(1).upper() not in ("CONSTANT", "SUBQUERY") and not scan.group(1).startswith("("):
+            full_scans.append(_unquote(scan.group(1)))
+        if "USE TEMP B-TREE" in detail.upper():
+            temp_btrees.append(detail)
+    return {"full_scans": full_scans, "temp_btrees": temp_btrees}
+
+
+def propose_indexes(sql: str, conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """
+    Proposes covering indexes for the tables a query scans or sorts.
+    Column order: equality predicates, one range predicate, GROUP/ORDER BY,
+    then the remaining referenced columns so the index can cover the query.
+    """
+    plan = explain_query_plan(sql, conn)
+    problems = plan_problems(plan)
+    columns = analyze_columns(sql, conn)
+
+    # Newer SQLite versions report "SCAN <alias>" rather than the table name
+    needs_help = {columns.aliases.get(name.lower(), name) for name in problems["full_scans"]}
+    # A filtered table only reached by primary key from a scanned one could
+    # drive the join instead (e.g. Orders by OrderDate under a scan of the lines)
+    if needs_help:
+        needs_help.update(columns.filtered)
+    if problems["temp_btrees"]:
+        needs_help.update(columns.ordering.keys())
+
+    proposals = []
+    for table in sorted(needs_help):
+        key, key_is_rowid = _key_column(conn, table)
+        index_cols = []
+        for col in columns.equality.get(table, []):
+            if col not in index_cols and col != key:
+                index_cols.append(col)
+        for col in [c for c in columns.range.get(table, []) if c != key][:1]:
+            if col not in index_cols:
+                index_cols.append(col)
+        for col in columns.ordering.get(table, []):
+            if col not in index_cols and col != key:
+                index_cols.append(col)
+
+        # Nothing selective to index on: a scan is the right plan
+        if not index_cols:
+            continue
+
+        for col in columns.referenced.get(table, []):
+            if col not in index_cols and len(index_cols) < MAX_INDEX_COLUMNS and not (key_is_rowid and col == key):
+                index_cols.append(col)
+
+        if any(existing[:len(index_cols)] == index_cols for existing in _existing_indexes(conn, table)):
+            continue
+
+        name = "idx_advisor_" + re.sub(r"\W+", "_", f"{table}_{'_'.join(index_cols)}").lower()
+        quoted_cols = ", ".join(f'"{c}"' for c in index_cols)
+        proposals.append({
+            "table": table,
+            "columns": index_cols,
+            "name": name,
+            "ddl": f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table}" ({quoted_cols})'
+        })
+    return proposals
+
+
+def time_query(conn: sqlite3.Connection, sql: str, repeat: int = 5) -> float:
+    """
+    Median wall time of a query in milliseconds (rows fully fetched).
+    """
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.execute(sql).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings)
+
+
+def run_advisor(queries: Counter, db_path: str, apply: bool = False,
+                work_path: Optional[str] = None, repeat: int = 5) -> Dict[str, Any]:
+    """
+    Analyzes logged queries against a copy of the database.
+    With apply=True the proposed indexes are created on the copy and every
+    query is re-planned and re-timed.
+    """
+    work_path = make_work_copy(db_path, work_path)
+    report = {"database": db_path, "work_copy": work_path, "applied": apply, "queries": [], "indexes": []}
+
+    conn = sqlite3.connect(f"file:{work_path}?mode=ro", uri=True)
+    proposals_by_name = {}
+    try:
+        for sql, count in queries.most_common():
+            try:
+                plan = explain_query_plan(sql, conn)
+                proposals = propose_indexes(sql, conn)
+                before_ms = time_query(conn, sql, repeat)
+            except sqlite3.Error as e:
+                report["queries"].append({"sql": sql, "count": count, "error": str(e)})
+                continue
+
+            for proposal in proposals:
+                proposals_by_name.setdefault(proposal["name"], proposal)
+            report["queries"].append({
+                "sql": sql,
+                "count": count,
+                "plan_before": [row["detail"] for row in plan],
+                **plan_problems(plan),
+                "proposed": [p["name"] for p in proposals],
+                "before_ms": round(before_ms, 3)
+            })
+    finally:
+        conn.close()
+
+    report["indexes"] = list(proposals_by_name.values())
+    if not apply or not proposals_by_name:
+        return report
+
+    # Writable maintenance mode, on the copy only
+    conn = sqlite3.connect(work_path)
+    try:
+        for proposal in report["indexes"]:
+            started = time.perf_counter()
+            conn.execute(proposal["ddl"])
+            proposal["build_ms"] = round((time.perf_counter() - started) * 1000, 3)
+        conn.execute("ANALYZE")
+        conn.commit()
+
+        for entry in report["queries"]:
+            if "error" in entry:
+                continue
+            plan = explain_query_plan(entry["sql"], conn)
+            entry["plan_after"] = [row["detail"] for row in plan]
+            entry["after_ms"] = round(time_query(conn, entry["sql"], repeat), 3)
+            if entry["after_ms"] > 0:
+                entry["speedup"] = round(entry["before_ms"] / entry["after_ms"], 2)
+    finally:
+        conn.close()
+
+    return report
+
+
+def print_report(report: Dict[str, Any]):
+    print(f"Database: {report['database']}")
+    print(f"Work copy: {report['work_copy']}")
+    print(f"Queries analyzed: {len(report['queries'])}")
+
+    for entry in report["queries"]:
+        print(f"\n--- x{entry['count']} {entry['sql'][:100]}")
+        if "error" in entry:
+            print(f"  Error: {entry['error']}")
+            continue
+        for table in entry["full_scans"]:
+            print(f"  Full scan: {table}")
+        for detail in entry["temp_btrees"]:
+            print(f"  Temp B-tree: {detail}")
+        if entry["proposed"]:
+            print(f"  Proposed: {', '.join(entry['proposed'])}")
+        line = f"  Before: {entry['before_ms']:.3f} ms"
+        if "after_ms" in entry:
+            line += f" | After: {entry['after_ms']:.3f} ms | Speedup: {entry.get('speedup', '-')}x"
+        print(line)
+
+    print("\nProposed indexes:")
+    if not report["indexes"]:
+        print("  (none)")
+    for proposal in report["indexes"]:
+        built = f"  -- built in {proposal['build_ms']} ms" if "build_ms" in proposal else ""
+        print(f"  {proposal['ddl']};{built}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline index advisor for executed agent SQL")
+    parser.add_argument("--db", default=Database_path, help="Source database (copied, never modified)")
+    parser.add_argument("--log", default=SQL_LOG_PATH, help="JSONL written via SQL_LOG_PATH")
+    parser.add_argument("--work-copy", default=None, help="Where to place the database copy")
+    parser.add_argument("--apply", action="store_true", help="Create proposed indexes on the copy and re-time")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions per query")
+    parser.add_argument("--json", default=None, help="Also write the report as JSON to this path")
+    args = parser.parse_args()
+
+    if not args.log or not os.path.exists(args.log):
+        parser.error("No SQL log found. Run the agent with SQL_LOG_PATH set, or pass --log.")
+
+    queries = load_logged_queries(args.log)
+    report = run_advisor(queries, args.db, apply=args.apply, work_path=args.work_copy, repeat=args.repeat)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,180 @@
+import argparse
+import calendar
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("kpi_report")
+
+# Bulk KPI reports.
+#
+# "Revenue for Beverages in June 1997" asked for every category and month
+# is dozens of full agent runs. A report spec names the grid once, with the
+# planner's field names:
+#
+#   {
+#     "kpi": ["revenue", "orders"],             # keys of sql_gen.KPI_SQL
+#     "category": "all",                        # or a name / list of names
+#     "date_ranges": [
+#       {"label": "Q1", "date_start": "1997-01-01", "date_end": "1997-03-31"},
+#       {"event": "Summer Spice Campaign"},     # dates from the docs
+#       {"monthly": {"date_start": "1997-01-01", "date_end": "1997-12-31"}}
+#     ]
+#   }
+#
+# Each KPI compiles to ONE grouped query over every (range, category) pair
+# (sql_gen.kpi_grid_sql, the same joins and filters as the agent's KPI
+# SQL), runs once through sqlite_tool (cost guard included), and the
+# results are pivoted with pandas into a report table:
+#
+#   python kpi_report.py --spec report.json --out report.csv [--layout wide]
+#
+# Parquet output (--out report.parquet) needs pyarrow or fastparquet.
+
+
+def _month_ranges(start: str, end: str) -> List[Tuple[str, str, str]]:
+    year, month = int(start[:4]), int(start[5:7])
+    ranges = []
+    while (year, month) <= (int(end[:4]), int(end[5:7])):
+        last = calendar.monthrange(year, month)[1]
+        ranges.append((f"{year:04d}-{month:02d}", f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{last:02d}"))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return ranges
+
+
+def event_dates(event: str) -> Optional[Tuple[str, str]]:
+    """An event's dates, from a retrieved chunk that names it in full (None if none does)."""
+    from planner import event_dates as dates_in_docs
+    from retrieval import search
+
+    date_start, date_end = dates_in_docs(event, search(event, 5))
+    return (date_start, date_end) if date_start and date_end else None
+
+
+def resolve_spec(spec: Dict[str, Any]) -> Tuple[List[str], List[str], List[Tuple[str, str, str]]]:
+    """(kpis, categories, ranges) from a report spec; raises ValueError."""
+    from planner import CATEGORIES
+    from sql_gen import KPI_SQL
+
+    kpis = spec.get("kpi") or list(KPI_SQL)
+    kpis = [kpis] if isinstance(kpis, str) else list(kpis)
+    unknown = [k for k in kpis if k not in KPI_SQL]
+    if unknown:
+        raise ValueError(f"Unknown KPIs {unknown}; expected some of {list(KPI_SQL)}")
+
+    categories = spec.get("category", "all")
+    if categories == "all":
+        categories = list(CATEGORIES)
+    elif isinstance(categories, str):
+        categories = [categories]
+    by_name = {c.lower(): c for c in CATEGORIES}
+    missing = [c for c in categories if c.lower() not in by_name]
+    if missing:
+        raise ValueError(f"Unknown categories {missing}")
+    categories = [by_name[c.lower()] for c in categories]
+
+    ranges = []
+    for entry in spec.get("date_ranges") or []:
+        if "monthly" in entry:
+            ranges.extend(_month_ranges(entry["monthly"]["date_start"], entry["monthly"]["date_end"]))
+        elif "event" in entry:
+            dates = event_dates(entry["event"])
+            if dates is None:
+                raise ValueError(f"No dates found in the docs for event '{entry['event']}'")
+            ranges.append((entry.get("label") or entry["event"], *dates))
+        else:
+            start, end = entry["date_start"], entry["date_end"]
+            ranges.append((entry.get("label") or f"{start}..{end}", start, end))
+    if not ranges:
+        raise ValueError("The spec needs at least one entry in date_ranges")
+    labels = [label for label, _, _ in ranges]
+    if len(set(labels)) != len(labels):
+        raise ValueError("Date range labels must be unique")
+    return kpis, categories, ranges
+
+
+def run_report(spec: Dict[str, Any], layout: str = "long"):
+    """
+    Runs one grouped query per KPI and returns (DataFrame, stats).
+    long: one row per (range, category), a column per KPI.
+    wide: one row per category, a (KPI, range) column pair.
+    Cells with no orders are 0.
+    """
+    import pandas as pd
+    from sql_gen import KPI_SQL, kpi_grid_sql
+    from sqlite_tool import execute_sql_query
+
+    kpis, categories, ranges = resolve_spec(spec)
+    labels = [label for label, _, _ in ranges]
+    grid = pd.MultiIndex.from_product([labels, categories], names=["range", "category"])
+    columns, stats = {}, {"queries": [], "cells": len(grid) * len(kpis)}
+
+    started = time.perf_counter()
+    for kpi in kpis:
+        sql = kpi_grid_sql(kpi, categories, ranges)
+        query_started = time.perf_counter()
+        _, rows = execute_sql_query(sql)
+        stats["queries"].append({"kpi": kpi, "rows": len(rows),
+                                 "ms": round((time.perf_counter() - query_started) * 1000, 1)})
+        alias = KPI_SQL[kpi][1]
+        frame = pd.DataFrame.from_records(rows, columns=["range", "category", alias])
+        columns[kpi] = frame.set_index(["range", "category"])[alias].reindex(grid, fill_value=0)
+    stats["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    report = pd.DataFrame(columns)
+    range_info = pd.DataFrame(ranges, columns=["range", "date_start", "date_end"]).set_index("range")
+    if layout == "wide":
+        report = report.unstack("range")
+        # Range columns in spec order, not alphabetical
+        report = report.reindex(columns=pd.MultiIndex.from_product([kpis, labels]))
+        report = report.reindex(categories)
+    else:
+        report = report.join(range_info, on="range").reset_index()
+        report = report[["range", "date_start", "date_end", "category"] + kpis]
+    log.info("KPI report built", extra={"kpis": len(kpis), "cells": stats["cells"], "ms": stats["elapsed_ms"]})
+    return report, stats
+
+
+def export(report, path: str):
+    """Writes the report as CSV, or Parquet for a .parquet path."""
+    if path.endswith(".parquet"):
+        frame = report.copy()
+        if hasattr(frame.columns, "levels"):
+            frame.columns = ["|".join(map(str, c)) for c in frame.columns]
+        try:
+            frame.to_parquet(path, index=frame.index.name is not None)
+        except ImportError as e:
+            raise RuntimeError(f"Parquet export needs pyarrow or fastparquet ({e}); use a .csv path") from e
+    else:
+        report.to_csv(path, index=report.index.name is not None)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a KPI x category x date range report in one query per KPI")
+    parser.add_argument("--spec", required=True, help="JSON report spec (see the top of kpi_report.py)")
+    parser.add_argument("--out", default=None, help="Write the report to a .csv or .parquet file")
+    parser.add_argument("--layout", choices=["long", "wide"], default="long")
+    parser.add_argument("--db", default=None, help="SQLite database (default: sqlite_tool.Database_path)")
+    parser.add_argument("--docs", default=None, help="Directory of .md docs for event dates")
+    args = parser.parse_args()
+
+    if args.db:
+        import sqlite_tool
+        sqlite_tool.Database_path = args.db
+    if args.docs:
+        import retrieval
+        retrieval.DOC_PATHS = [os.path.join(args.docs, n) for n in sorted(os.listdir(args.docs))
+                               if n.endswith(".md")]
+    with open(args.spec, "r", encoding="utf-8") as f:
+        spec = json.load(f)
+
+    table, run_stats = run_report(spec, args.layout)
+    if args.out:
+        export(table, args.out)
+        print(f"Wrote {len(table)} rows to {args.out}")
+    else:
+        print(table.to_string())
+    print(json.dumps(run_stats, indent=2))
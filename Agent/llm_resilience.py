@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import concurrent.futures
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from logger import get_logger
+from tracing import set_attribute
+
+log = get_logger("llm_resilience")
+
+# Deadlines, hedging and circuit breaking for the LLM clients.
+#
+# A slow provider used to hold router / planner calls until the client
+# library gave up, and the failure surfaced as a generic runtime error.
+# The model factories now wrap their MeteredModel (which still does the
+# retries and the accounting) in a ResilientModel:
+#
+#   deadline   each call, retries included, ends after LLM_DEADLINE_S
+#              (LLM_DEADLINE_<STAGE>_S per stage)
+#   hedging    once a stage has LLM_HEDGE_MIN_SAMPLES latencies, a call
+#              still running after that stage's p95 gets one duplicate
+#              request; the first answer wins and the other is cancelled.
+#              Hedges are capped at LLM_HEDGE_BUDGET of the calls, so a
+#              uniformly slow provider does not get twice the load
+#   breaker    per provider; it opens after LLM_BREAKER_FAILURES failures
+#              in a row, or a failure rate of LLM_BREAKER_FAILURE_RATE over
+#              the last LLM_BREAKER_WINDOW calls. While open, calls fail at
+#              once; after LLM_BREAKER_COOLDOWN_S one probe call goes
+#              through (half-open) and its outcome closes or re-opens it.
+#              A cancelled probe hands the slot back; one that never
+#              reports is replaced after LLM_BREAKER_PROBE_TIMEOUT_S
+#
+# Timeouts, provider errors and an open breaker raise Degraded. Call sites
+# catch it and use the local rules instead (rule_based_router,
+# rule_based_planner, rule_based_sql_generator for repair) and report it
+# with fallback(stage, reason). Output that fails to parse is the model
+# answering, so it neither trips the breaker nor counts as degraded.
+# Every path (primary, hedge, deadline, short-circuit, fallback) is counted
+# per stage in stats() (server /metrics) and set on the LLM span.
+
+LLM_DEADLINE_S = float(os.getenv("LLM_DEADLINE_S", "8"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+LLM_HEDGE_MIN_MS = float(os.getenv("LLM_HEDGE_MIN_MS", "250"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+LLM_HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.1"))
+LLM_LATENCY_WINDOW = int(os.getenv("LLM_LATENCY_WINDOW", "200"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_WINDOW = int(os.getenv("LLM_BREAKER_WINDOW", "20"))
+LLM_BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+LLM_BREAKER_COOLDOWN_S = float(os.getenv("LLM_BREAKER_COOLDOWN_S", "30"))
+# A probe that never reports back (lost, cancelled uncleanly) is replaced after this
+LLM_BREAKER_PROBE_TIMEOUT_S = float(os.getenv("LLM_BREAKER_PROBE_TIMEOUT_S", str(2 * LLM_DEADLINE_S)))
+LLM_SYNC_WORKERS = int(os.getenv("LLM_SYNC_WORKERS", "16"))
+
+
+def deadline_for(stage: str) -> float:
+    return float(os.getenv(f"LLM_DEADLINE_{stage.upper()}_S", LLM_DEADLINE_S))
+
+
+class Degraded(Exception):
+    """The provider did not answer in time, failed, or its breaker is open."""
+
+    def __init__(self, stage: str, reason: str, detail: str = ""):
+        super().__init__(f"{stage}: {reason}" + (f" ({detail})" if detail else ""))
+        self.stage = stage
+        self.reason = reason   # deadline | circuit_open | error
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker over consecutive failures and a failure-rate window."""
+
+    def __init__(self, name: str, failures: int = None, window: int = None, failure_rate: float = None,
+                 cooldown_s: float = None, probe_timeout_s: float = None):
+        self.name = name
+        self.max_failures = LLM_BREAKER_FAILURES if failures is None else failures
+        self.failure_rate = LLM_BREAKER_FAILURE_RATE if failure_rate is None else failure_rate
+        self.cooldown_s = LLM_BREAKER_COOLDOWN_S if cooldown_s is None else cooldown_s
+        self.probe_timeout_s = LLM_BREAKER_PROBE_TIMEOUT_S if probe_timeout_s is None else probe_timeout_s
+        self.outcomes: deque = deque(maxlen=window or LLM_BREAKER_WINDOW)
+        self.state = "closed"
+        self.consecutive = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self._probe = False
+        self._probe_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> Optional[str]:
+        """None when the call must not go out; "probe" for the half-open probe, else "closed"."""
+        with self._lock:
+            if self.state == "closed":
+                return "closed"
+            now = time.monotonic()
+            if self.state == "open" and now - self.opened_at >= self.cooldown_s:
+                self.state = "half_open"
+                self._probe = False
+            if self.state == "half_open" and (not self._probe or now - self._probe_at >= self.probe_timeout_s):
+                self._probe = True   # exactly one probe call
+                self._probe_at = now
+                return "probe"
+            return None
+
+    def release(self):
+        """The probe ended without an outcome (cancelled): let the next call probe."""
+        with self._lock:
+            if self.state == "half_open":
+                self._probe = False
+
+    def record(self, ok: bool):
+        with self._lock:
+            self.outcomes.append(ok)
+            self.consecutive = 0 if ok else self.consecutive + 1
+            if self.state == "half_open":
+                self._probe = False
+                if ok:
+                    self.state = "closed"
+                    self.outcomes.clear()
+                    log.info("Circuit closed", extra={"breaker": self.name})
+                else:
+                    self._open()
+                return
+            if self.state == "closed" and not ok:
+                failed = self.outcomes.count(False)
+                if self.consecutive >= self.max_failures or (
+                        len(self.outcomes) == self.outcomes.maxlen and failed / len(self.outcomes) >= self.failure_rate):
+                    self._open()
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        self.opened += 1
+        log.warning("Circuit opened", extra={"breaker": self.name, "consecutive_failures": self.consecutive,
+                                              "cooldown_s": self.cooldown_s})
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"state": self.state, "opened": self.opened, "consecutive_failures": self.consecutive,
+                    "window_failures": self.outcomes.count(False), "window": len(self.outcomes)}
+
+
+class StageStats:
+    """Latency window (for the hedge delay) and path counters of one stage."""
+
+    def __init__(self, window: int = None):
+        self.latencies: deque = deque(maxlen=window or LLM_LATENCY_WINDOW)
+        self.counts = {name: 0 for name in ("calls", "primary", "hedged", "hedge_won", "deadline",
+                                            "errors", "short_circuited", "fallbacks")}
+        self._lock = threading.Lock()
+
+    def count(self, name: str, n: int = 1):
+        with self._lock:
+            self.counts[name] += n
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self.latencies.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        with self._lock:
+            if not self.latencies:
+                return None
+            ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+    def hedge_delay(self) -> Optional[float]:
+        """Seconds to wait before hedging, or None when hedging is off or over budget."""
+        if not LLM_HEDGE or len(self.latencies) < LLM_HEDGE_MIN_SAMPLES:
+            return None
+        with self._lock:
+            if self.counts["hedged"] + 1 > LLM_HEDGE_BUDGET * max(1, self.counts["calls"]):
+                return None
+        return max(LLM_HEDGE_MIN_MS / 1000, self.percentile(0.95))
+
+    def to_dict(self) -> Dict[str, Any]:
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        with self._lock:
+            return {**self.counts,
+                    "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                    "p95_ms": round(p95 * 1000, 1) if p95 is not None else None}
+
+
+_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+_stages: Dict[str, StageStats] = {}
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=LLM_SYNC_WORKERS, thread_name_prefix="llm")
+
+
+def breaker(name: str) -> CircuitBreaker:
+    with _lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def stage_stats(stage: str) -> StageStats:
+    with _lock:
+        if stage not in _stages:
+            _stages[stage] = StageStats()
+        return _stages[stage]
+
+
+def fallback(stage: str, reason: str):
+    """Records that a call site answered with its local rules instead."""
+    stage_stats(stage).count("fallbacks")
+    set_attribute("llm.path", "fallback")
+    set_attribute("llm.degraded", reason)
+    log.warning("LLM degraded, using local rules", extra={"stage": stage, "reason": reason})
+
+
+def _provider_failure(error: BaseException) -> bool:
+    # Parsing / validation errors (ValueError) mean the provider answered
+    return not isinstance(error, ValueError)
+
+
+class ResilientModel:
+    """
+    Wraps a MeteredModel with a per-call deadline, a p95 hedge and a
+    circuit breaker. Same invoke / ainvoke / batch / abatch interface.
+    """
+
+    def __init__(self, model, stage: str, provider: str, deadline_s: float = None):
+        self.model = model
+        self.stage = stage
+        self.breaker = breaker(provider)
+        self.metrics = stage_stats(stage)
+        self.deadline_s = deadline_for(stage) if deadline_s is None else deadline_s
+
+    def _admit(self) -> bool:
+        """Raises Degraded when the breaker is open; True if this call is the probe."""
+        self.metrics.count("calls")
+        admitted = self.breaker.allow()
+        if admitted is None:
+            self.metrics.count("short_circuited")
+            raise Degraded(self.stage, "circuit_open")
+        return admitted == "probe"
+
+    def _settle(self, started: float, winner: Optional[int], error: Optional[BaseException]):
+        """Books the outcome; returns the exception to raise, if any."""
+        if winner is not None:
+            self.breaker.record(True)
+            self.metrics.observe(time.perf_counter() - started)
+            self.metrics.count("hedge_won" if winner == 1 else "primary")
+            set_attribute("llm.path", "hedge" if winner == 1 else "primary")
+            return None
+        if isinstance(error, (asyncio.TimeoutError, concurrent.futures.TimeoutError)):
+            self.breaker.record(False)
+            self.metrics.count("deadline")
+            set_attribute("llm.path", "deadline")
+            return Degraded(self.stage, "deadline", f"{self.deadline_s}s")
+        if not _provider_failure(error):
+            self.breaker.record(True)
+            return error
+        self.breaker.record(False)
+        self.metrics.count("errors")
+        set_attribute("llm.path", "error")
+        degraded = Degraded(self.stage, "error", f"{type(error).__name__}: {error}")
+        degraded.__cause__ = error
+        return degraded
+
+    def _next_wait(self, started: float, deadline: float, hedge_delay: Optional[float], attempts: int):
+        """(timeout, may_hedge) for the next wait, or None once the deadline has passed."""
+        now = time.perf_counter()
+        if now >= deadline:
+            return None
+        may_hedge = attempts == 1 and hedge_delay is not None
+        timeout = deadline - now
+        if may_hedge:
+            timeout = min(timeout, started + hedge_delay - now)
+        return max(0.0, timeout), may_hedge
+
+    async def _race(self, call: Callable[[], Awaitable[Any]]) -> Any:
+        probe = self._admit()
+        started = time.perf_counter()
+        deadline = started + self.deadline_s
+        hedge_delay = self.metrics.hedge_delay()
+        tasks = [asyncio.ensure_future(call())]
+        winner, error = None, None
+        try:
+            while winner is None:
+                pending = [t for t in tasks if not t.done()]
+                wait = self._next_wait(started, deadline, hedge_delay, len(tasks))
+                if not pending or wait is None:
+                    error = error if not pending else asyncio.TimeoutError()
+                    break
+                done, _ = await asyncio.wait(pending, timeout=wait[0], return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = tasks.index(task)
+                        break
+                    error = task.exception()
+                if not done and wait[1] and time.perf_counter() < deadline:
+                    # Past the stage's p95: one duplicate request, first answer wins
+                    self.metrics.count("hedged")
+                    tasks.append(asyncio.ensure_future(call()))
+        except asyncio.CancelledError:
+            # The caller went away: no outcome to book, but a probe must not
+            # keep the breaker half-open for good
+            if probe:
+                self.breaker.release()
+            raise
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        failure = self._settle(started, winner, error)
+        if failure is not None:
+            raise failure
+        return tasks[winner].result()
+
+    def _race_sync(self, call: Callable[[], Any]) -> Any:
+        # Sync callers (CLI, bulk runs) get the same deadline and hedge on
+        # worker threads. A thread past its deadline is abandoned, not
+        # stopped; the client's own timeout (the factories set it to the
+        # deadline) ends it
+        self._admit()
+        started = time.perf_counter()
+        deadline = started + self.deadline_s
+        hedge_delay = self.metrics.hedge_delay()
+        futures = [_executor.submit(contextvars.copy_context().run, call)]
+        winner, error = None, None
+        while winner is None:
+            pending = [f for f in futures if not f.done()]
+            wait = self._next_wait(started, deadline, hedge_delay, len(futures))
+            if not pending or wait is None:
+                error = error if not pending else concurrent.futures.TimeoutError()
+                break
+            done, _ = concurrent.futures.wait(pending, timeout=wait[0],
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    winner = futures.index(future)
+                    break
+                error = future.exception()
+            if not done and wait[1] and time.perf_counter() < deadline:
+                self.metrics.count("hedged")
+                futures.append(_executor.submit(contextvars.copy_context().run, call))
+        for future in futures:
+            future.cancel()
+        failure = self._settle(started, winner, error)
+        if failure is not None:
+            raise failure
+        return futures[winner].result()
+
+    def invoke(self, prompt, *args, **kwargs):
+        return self._race_sync(lambda: self.model.invoke(prompt, *args, **kwargs))
+
+    async def ainvoke(self, prompt, *args, **kwargs):
+        return await self._race(lambda: self.model.ainvoke(prompt, *args, **kwargs))
+
+    def batch(self, prompts: List[Any], *args, **kwargs):
+        return [self.invoke(prompt, *args, **kwargs) for prompt in prompts]
+
+    async def abatch(self, prompts: List[Any], *args, return_exceptions: bool = False, **kwargs):
+        """
+        One deadline and hedge for the whole micro-batch. Items that fail
+        on their own fail alone: provider errors come back as Degraded (the
+        caller falls back), parse errors as they are.
+        """
+        results = await self._race(lambda: self.model.abatch(prompts, *args, return_exceptions=True, **kwargs))
+        for index, result in enumerate(results):
+            if isinstance(result, Exception) and _provider_failure(result):
+                self.breaker.record(False)
+                self.metrics.count("errors")
+                degraded = Degraded(self.stage, "error", f"{type(result).__name__}: {result}")
+                degraded.__cause__ = result
+                results[index] = degraded
+        if not return_exceptions:
+            for result in results:
+                if isinstance(result, Exception):
+                    raise result
+        return results
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        stages, breakers = dict(_stages), dict(_breakers)
+    return {
+        "deadline_s": LLM_DEADLINE_S,
+        "hedge": LLM_HEDGE,
+        "stages": {stage: s.to_dict() for stage, s in stages.items()},
+        "breakers": {name: b.stats() for name, b in breakers.items()},
+    }
+
+
+async def _simulate(calls: int, concurrency: int, resilient: bool, deadline_s: float,
+                    **stub_config) -> Dict[str, Any]:
+    """Routes `calls` questions through a stub provider and reports latency percentiles."""
+    import llm_resilience   # the module the clients use, also when run as __main__
+    from benchmark import summarize
+    from Classifier_route import classify_route_async, router_batcher
+    from stub_models import install_stub_models
+
+    with llm_resilience._lock:
+        llm_resilience._stages.clear()
+        llm_resilience._breakers.clear()
+    llm_resilience.LLM_DEADLINE_S = deadline_s
+    router_batcher.max_batch = 1   # one provider call per question
+    install_stub_models(resilient=resilient, **stub_config)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, failures = [], 0
+
+    async def one(i: int):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await classify_route_async(f"Revenue for Beverages in 1997 (#{i})")
+            except Exception:
+                failures += 1
+            latencies.append(time.perf_counter() - started)
+
+    await asyncio.gather(*(one(i) for i in range(calls)))
+    return {"latency_s": summarize(latencies), "failures": failures,
+            "router": llm_resilience.stats()["stages"].get("router"),
+            "breakers": llm_resilience.stats()["breakers"]}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Router tail latency against a degraded stub provider")
+    parser.add_argument("--calls", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency-ms", type=float, default=40.0)
+    parser.add_argument("--jitter-ms", type=float, default=20.0)
+    parser.add_argument("--stall-rate", type=float, default=0.03, help="Share of calls that stall")
+    parser.add_argument("--stall-ms", type=float, default=3000.0)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of calls that raise")
+    parser.add_argument("--deadline-s", type=float, default=LLM_DEADLINE_S)
+    args = parser.parse_args()
+
+    config = dict(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, stall_rate=args.stall_rate,
+                  stall_ms=args.stall_ms, error_rate=args.error_rate)
+    print(json.dumps({
+        "direct": asyncio.run(_simulate(args.calls, args.concurrency, False, args.deadline_s, **config)),
+        "resilient": asyncio.run(_simulate(args.calls, args.concurrency, True, args.deadline_s, **config)),
+    }, indent=2))
@@ -0,0 +1,352 @@
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from logger import get_logger
+from tracing import set_attribute
+
+log = get_logger("llm_usage")
+
+# Token and latency accounting for the LLM clients.
+#
+# The router, planner and repair factories wrap their structured-output
+# model (built with include_raw=True) in MeteredModel. It returns the
+# parsed object as before and takes prompt / completion tokens from the raw
+# message's usage_metadata (estimated at ~4 characters per token for
+# clients that report none, e.g. stub_models). Retries happen here rather
+# than inside ChatGroq (max_retries=0), so they are counted too.
+#
+# Call sites wrap each call in track(stage, prompt). Micro-batched calls run
+# in the batcher's task, not the caller's, so usage is handed back by
+# prompt identity and booked when track() exits, in the caller's context:
+#   per stage     process-wide totals (stats(), /metrics)
+#   per request   request() around one agent run (Graph.run_agent)
+#   per session   the requests of one session_id, LRU-bounded
+#
+# LLM_REQUEST_TOKEN_BUDGET caps the tokens one agent run may spend. Near
+# the cap the planner gets fewer document chunks (fit_docs) and optional
+# model calls (repair, the LLM SQL candidate) are skipped (allows()).
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_RETRY_BACKOFF_S = float(os.getenv("LLM_RETRY_BACKOFF_S", "0.5"))
+LLM_REQUEST_TOKEN_BUDGET = int(os.getenv("LLM_REQUEST_TOKEN_BUDGET", "0"))   # 0 = unlimited
+LLM_COMPLETION_RESERVE = int(os.getenv("LLM_COMPLETION_RESERVE", "256"))
+LLM_USAGE_SESSIONS = int(os.getenv("LLM_USAGE_SESSIONS", "1024"))
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4
+
+
+class Usage:
+    __slots__ = ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "retries", "errors",
+                 "estimated", "ms", "max_prompt_tokens", "skipped")
+
+    def __init__(self):
+        self.calls = self.prompt_tokens = self.completion_tokens = self.cached_tokens = 0
+        self.retries = self.errors = self.estimated = self.skipped = 0
+        self.max_prompt_tokens = 0
+        self.ms = 0.0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, other: "Usage"):
+        for name in ("calls", "prompt_tokens", "completion_tokens", "cached_tokens", "retries", "errors",
+                     "estimated", "ms", "skipped"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.max_prompt_tokens = max(self.max_prompt_tokens, other.max_prompt_tokens)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "total_tokens": self.total_tokens,
+            "avg_prompt_tokens": round(self.prompt_tokens / self.calls, 1) if self.calls else 0.0,
+            "max_prompt_tokens": self.max_prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_share": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0.0,
+            "retries": self.retries,
+            "errors": self.errors,
+            "estimated": self.estimated,
+            "skipped": self.skipped,
+            "ms": round(self.ms, 1),
+        }
+
+
+class RequestUsage:
+    """Usage of one agent run, per stage, against an optional token budget."""
+
+    def __init__(self, session_id: Optional[str] = None, budget: int = None):
+        self.session_id = session_id
+        self.budget = LLM_REQUEST_TOKEN_BUDGET if budget is None else budget
+        self.stages: Dict[str, Usage] = {}
+        self.total = Usage()
+
+    def add(self, stage: str, usage: Usage):
+        self.stages.setdefault(stage, Usage()).add(usage)
+        self.total.add(usage)
+
+    def remaining(self) -> Optional[int]:
+        return self.budget - self.total.total_tokens if self.budget > 0 else None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"total": self.total.to_dict(), "budget": self.budget or None,
+                "stages": {stage: usage.to_dict() for stage, usage in self.stages.items()}}
+
+
+_lock = threading.Lock()
+_stages: Dict[str, Usage] = {}
+_sessions: "OrderedDict[str, Usage]" = OrderedDict()
+_request: contextvars.ContextVar[Optional[RequestUsage]] = contextvars.ContextVar("llm_request", default=None)
+# id(prompt) -> Usage of the call in flight for that prompt
+_pending: Dict[int, Usage] = {}
+
+
+@contextmanager
+def request(session_id: Optional[str] = None, budget: int = None):
+    """Accounts the LLM calls made inside the block to one request."""
+    usage = RequestUsage(session_id, budget)
+    token = _request.set(usage)
+    try:
+        yield usage
+    finally:
+        try:
+            _request.reset(token)
+        except ValueError:
+            pass  # a streaming generator closed from another context
+        if session_id and usage.total.calls + usage.total.skipped:
+            with _lock:
+                _sessions.setdefault(session_id, Usage()).add(usage.total)
+                _sessions.move_to_end(session_id)
+                while len(_sessions) > LLM_USAGE_SESSIONS:
+                    _sessions.popitem(last=False)
+
+
+def current_request() -> Optional[RequestUsage]:
+    return _request.get()
+
+
+@contextmanager
+def track(stage: str, prompt: str):
+    """Books the usage of the model call(s) made for `prompt` to `stage`."""
+    usage = Usage()
+    _pending[id(prompt)] = usage
+    try:
+        yield usage
+    finally:
+        _pending.pop(id(prompt), None)
+        _book(stage, usage)
+        set_attribute("llm.prompt_tokens", usage.prompt_tokens)
+        set_attribute("llm.completion_tokens", usage.completion_tokens)
+        if usage.cached_tokens:
+            set_attribute("llm.cached_tokens", usage.cached_tokens)
+        if usage.retries:
+            set_attribute("llm.retries", usage.retries)
+
+
+def _book(stage: str, usage: Usage):
+    with _lock:
+        _stages.setdefault(stage, Usage()).add(usage)
+    req = _request.get()
+    if req is not None:
+        req.add(stage, usage)
+
+
+def skip(stage: str, reason: str):
+    """Records a model call left out to stay within the request budget."""
+    usage = Usage()
+    usage.skipped = 1
+    _book(stage, usage)
+    log.info("LLM call skipped", extra={"stage": stage, "reason": reason})
+
+
+def remaining() -> Optional[int]:
+    """Tokens the current request may still spend (None: no budget)."""
+    req = _request.get()
+    return req.remaining() if req is not None else None
+
+
+def allows(prompt: str) -> bool:
+    """Whether a call with `prompt` fits the current request's budget."""
+    left = remaining()
+    return left is None or estimate_tokens(prompt) + LLM_COMPLETION_RESERVE <= left
+
+
+def fit_docs(docs: List[Dict[str, Any]], base_tokens: int) -> Optional[List[Dict[str, Any]]]:
+    """
+    The leading chunks of `docs` (best first) whose text fits what is left
+    of the request budget next to a prompt of base_tokens, the last one
+    truncated. None when not even the bare prompt fits.
+    """
+    left = remaining()
+    if left is None:
+        return docs
+    room = left - base_tokens - LLM_COMPLETION_RESERVE
+    if room < 0:
+        return None
+    kept, used = [], 0
+    for doc in docs:
+        tokens = estimate_tokens(doc.get("text", "")) + 1
+        if used + tokens > room:
+            if room - used > 32:
+                kept.append({**doc, "text": doc.get("text", "")[:(room - used) * 4]})
+            log.info("Trimmed context to the token budget", extra={"docs": len(docs), "kept": len(kept)})
+            break
+        kept.append(doc)
+        used += tokens
+    return kept
+
+
+# ---------------------------------------------------------------------------
+# Metered client
+# ---------------------------------------------------------------------------
+
+def _retryable(error: Exception) -> bool:
+    # Output parsing / validation errors are ValueErrors; asking again with
+    # the same prompt at temperature 0 gives the same answer
+    return not isinstance(error, ValueError)
+
+
+class MeteredModel:
+    """
+    Wraps a structured-output model. invoke / ainvoke / batch / abatch
+    return the parsed object and record tokens, wall time and retries.
+    """
+
+    def __init__(self, model, max_retries: int = None, backoff_s: float = None):
+        self.model = model
+        self.max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+        self.backoff_s = LLM_RETRY_BACKOFF_S if backoff_s is None else backoff_s
+
+    def _record(self, prompt, output, started: float, retries: int, failed: bool = False) -> Any:
+        usage = _pending.get(id(prompt))
+        if usage is not None:
+            return self._fill(usage, prompt, output, started, retries, failed)
+        usage = Usage()
+        try:
+            return self._fill(usage, prompt, output, started, retries, failed)
+        finally:
+            _book("untracked", usage)
+
+    @staticmethod
+    def _fill(usage: Usage, prompt, output, started: float, retries: int, failed: bool) -> Any:
+        usage.calls += 1
+        usage.retries += retries
+        usage.ms += (time.perf_counter() - started) * 1000
+        if failed:
+            usage.errors += 1
+            return output
+
+        parsed, raw = output, None
+        if isinstance(output, dict) and "raw" in output:
+            if output.get("parsing_error") is not None:
+                usage.errors += 1
+                raise output["parsing_error"]
+            parsed, raw = output["parsed"], output["raw"]
+        tokens = getattr(raw, "usage_metadata", None) or {}
+        reported = (getattr(raw, "response_metadata", None) or {}).get("token_usage") or {}
+        if not tokens:
+            tokens = {"input_tokens": reported.get("prompt_tokens"),
+                      "output_tokens": reported.get("completion_tokens")}
+        # Prompt tokens served from the provider's prefix cache (prompts.py)
+        cached = (tokens.get("input_token_details") or {}).get("cache_read")
+        if cached is None:
+            cached = (reported.get("prompt_tokens_details") or {}).get("cached_tokens")
+        usage.cached_tokens += cached or 0
+        prompt_tokens, completion_tokens = tokens.get("input_tokens"), tokens.get("output_tokens")
+        if prompt_tokens is None:
+            usage.estimated += 1
+            prompt_tokens = estimate_tokens(str(prompt))
+            completion_tokens = estimate_tokens(parsed.model_dump_json() if hasattr(parsed, "model_dump_json")
+                                                else str(parsed))
+        usage.prompt_tokens += prompt_tokens
+        usage.completion_tokens += completion_tokens or 0
+        usage.max_prompt_tokens = max(usage.max_prompt_tokens, prompt_tokens)
+        return parsed
+
+    def invoke(self, prompt, *args, **kwargs):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                output = self.model.invoke(prompt, *args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not _retryable(e):
+                    self._record(prompt, None, started, attempt, failed=True)
+                    raise
+                time.sleep(self.backoff_s * 2 ** attempt)
+                continue
+            return self._record(prompt, output, started, attempt)
+
+    async def ainvoke(self, prompt, *args, **kwargs):
+        started = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                output = await self.model.ainvoke(prompt, *args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not _retryable(e):
+                    self._record(prompt, None, started, attempt, failed=True)
+                    raise
+                await asyncio.sleep(self.backoff_s * 2 ** attempt)
+                continue
+            return self._record(prompt, output, started, attempt)
+
+    def batch(self, prompts: List[Any], *args, **kwargs):
+        return [self.invoke(prompt, *args, **kwargs) for prompt in prompts]
+
+    async def abatch(self, prompts: List[Any], *args, return_exceptions: bool = False, **kwargs):
+        """
+        One batch call; items that fail are retried on their own. With
+        return_exceptions an item's error is returned in its place, so one
+        bad item does not fail the others.
+        """
+        started = time.perf_counter()
+        outputs = await self.model.abatch(prompts, *args, return_exceptions=True, **kwargs)
+        results = []
+        for prompt, output in zip(prompts, outputs):
+            try:
+                if isinstance(output, Exception):
+                    if self.max_retries == 0 or not _retryable(output):
+                        self._record(prompt, None, started, 0, failed=True)
+                        raise output
+                    await asyncio.sleep(self.backoff_s)
+                    usage = _pending.get(id(prompt))
+                    if usage is not None:
+                        usage.retries += 1
+                    retry = MeteredModel(self.model, self.max_retries - 1, self.backoff_s * 2)
+                    results.append(await retry.ainvoke(prompt, *args, **kwargs))
+                else:
+                    results.append(self._record(prompt, output, started, 0))
+            except Exception as e:
+                if not return_exceptions:
+                    raise
+                results.append(e)
+        return results
+
+
+def stats() -> Dict[str, Any]:
+    with _lock:
+        stages = {stage: usage.to_dict() for stage, usage in _stages.items()}
+        total = Usage()
+        for usage in _stages.values():
+            total.add(usage)
+        return {"total": total.to_dict(), "stages": stages, "sessions": len(_sessions),
+                "request_token_budget": LLM_REQUEST_TOKEN_BUDGET or None}
+
+
+def session_usage(session_id: str) -> Optional[Dict[str, Any]]:
+    with _lock:
+        usage = _sessions.get(session_id)
+        return usage.to_dict() if usage is not None else None
+
+
+def forget_session(session_id: str):
+    with _lock:
+        _sessions.pop(session_id, None)
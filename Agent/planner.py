@@ -1,9 +1,14 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
 import os
 from dotenv import load_dotenv
 from pydantic import BaseModel, Field
-from langchain_groq import ChatGroq
 from typing import Optional
+import re
+import registry
+import llm_usage
+import llm_resilience
+from coalescing import MicroBatcher
+from prompts import PromptTemplate
+from tracing import llm_span
 
 load_dotenv()
 GROK_API_KEY = os.getenv("GROK_API_KEY")
@@ -38,7 +43,7 @@ class PlannerOutput(BaseModel):
         description="True if RAG documents are required for this query."
     )
 
-PLANNER_PROMPT = """
+PLANNER_PROMPT = PromptTemplate("planner", prefix="""
 You are the planner for a Retail Analytics Agent.
 
 Your job is to analyze the user QUESTION + the RAG DOCUMENT CHUNKS
@@ -83,29 +88,175 @@ Extract the following fields:
 ---------------------------------------
 
 Return JSON only.
-QUESTION:
+""", suffix="""QUESTION:
 {question}
 
 DOCUMENT CHUNKS:
 {docs}
-"""
+""")
 
-gemini = ChatGroq(
-    model="openai/gpt-oss-20b",
-    api_key=GROK_API_KEY,
-    temperature=0
-)
+PLANNER_MODEL = "openai/gpt-oss-20b"
+
+@registry.factory("planner_model")
+def build_planner_model():
+    from langchain_groq import ChatGroq
+    gemini = ChatGroq(
+        model=PLANNER_MODEL,
+        api_key=GROK_API_KEY,
+        temperature=0,
+        max_retries=0,  # MeteredModel retries, and counts them
+        timeout=llm_resilience.deadline_for("planner"),
+    )
+    return llm_resilience.ResilientModel(
+        llm_usage.MeteredModel(gemini.with_structured_output(PlannerOutput, include_raw=True)),
+        stage="planner", provider="groq",
+    )
 
+CATEGORIES = [
+    "Beverages", "Condiments", "Confections", "Dairy Products",
+    "Grains/Cereals", "Meat/Poultry", "Produce", "Seafood"
+]
 
-planner_model = gemini.with_structured_output(PlannerOutput)
+KPI_KEYWORDS = {
+    "revenue": ["revenue", "sales", "profit"],
+    "quantity": ["quantity", "units"],
+    "orders": ["order count", "how many orders", "number of orders"],
+    "top_products": ["top products", "top selling", "best selling"],
+    "count": ["count", "how many"],
+}
+# Whole words only: "discount" and "account" are not a count
+KPI_PATTERNS = {
+    name: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + r")\b", re.IGNORECASE)
+    for name, keywords in KPI_KEYWORDS.items()
+}
 
-def run_planner(question: str, rag_docs: list):
+DATE_RE = re.compile(r"\d{4}-\d{2}-\d{2}")
+# A capitalized name (words or a year) right before the keyword:
+# "Summer Spice Campaign", "Winter Classics 2017 event". Only the keyword
+# is case-insensitive, and "sales" is a KPI, not a "sale"
+EVENT_RE = re.compile(r"\b([A-Z][\w']*(?:\s+(?:[A-Z][\w']*|\d{4}))*)\s+(?i:campaign|event|promotion|sale)\b")
+
+def event_dates(event: str, rag_docs: list) -> tuple:
+    """
+    (date_start, date_end) from the first chunk that names the event in
+    full, taking the first two dates after the name; (None, None) otherwise.
+    """
+    match = EVENT_RE.fullmatch(event.strip())
+    name = match.group(1) if match else event.strip()
+    name_re = re.compile(r"\b" + r"\s+".join(re.escape(w) for w in name.split()) + r"\b", re.IGNORECASE)
+    for doc in rag_docs or []:
+        text = doc.get("text", "")
+        found = name_re.search(text)
+        if found:
+            dates = DATE_RE.findall(text[found.end():])
+            if len(dates) >= 2:
+                return dates[0], dates[1]
+    return None, None
+
+def rule_based_planner(question: str, rag_docs: list) -> PlannerOutput:
+    """Keyword planner used when no model is available"""
+    question_lower = question.lower()
+
+    kpi = next((name for name, pattern in KPI_PATTERNS.items() if pattern.search(question)), None)
+
+    category = next((c for c in CATEGORIES if c.lower() in question_lower), None)
+
+    event = None
+    match = EVENT_RE.search(question)
+    if match:
+        event = match.group(0).strip()
+
+    # Event dates come from the first retrieved chunk that names the event
+    date_start = date_end = None
+    if event:
+        date_start, date_end = event_dates(event, rag_docs)
+
+    need_sql = kpi is not None
+    need_rag = event is not None or not need_sql
+
+    return PlannerOutput(
+        kpi=kpi,
+        category=category,
+        event=event,
+        date_start=date_start,
+        date_end=date_end,
+        need_sql=need_sql,
+        need_rag=need_rag
+    )
+
+# Elliptical follow-ups in a session: "and for Condiments?", "what about 1997?"
+FOLLOW_UP_RE = re.compile(r"^\s*(and|what about|how about|same for|now for|also|then)\b", re.IGNORECASE)
+
+def is_follow_up(question: str) -> bool:
+    return bool(FOLLOW_UP_RE.match(question))
+
+def apply_follow_up(previous: PlannerOutput, question: str, rag_docs: list) -> PlannerOutput:
+    """
+    The previous turn's plan with only the fields the follow-up mentions
+    replaced, so the planner model is not called again.
+    """
+    delta = rule_based_planner(question, rag_docs)
+    fields = delta.model_dump(include={"kpi", "category", "event", "date_start", "date_end"})
+    update = {name: value for name, value in fields.items() if value}
+    if "event" in update and not delta.date_start:
+        # A new event without known dates must not keep the old event's range
+        update["date_start"] = update["date_end"] = None
+    if update.get("kpi"):
+        update["need_sql"] = True
+    return previous.model_copy(update=update)
+
+def build_planner_prompt(question: str, rag_docs: list) -> Optional[str]:
+    """
+    The planner prompt, with the chunks trimmed to what is left of the
+    request's token budget (llm_usage.py). None if even no chunks won't fit.
+    """
+    base_tokens = llm_usage.estimate_tokens(PLANNER_PROMPT.format(question=question, docs=""))
+    rag_docs = llm_usage.fit_docs(rag_docs or [], base_tokens)
+    if rag_docs is None:
+        return None
     doc_text = "\n\n".join([d["text"] for d in rag_docs]) if rag_docs else "No documents retrieved"
-    prompt = PLANNER_PROMPT.format(
+    return PLANNER_PROMPT.format(
         question=question,
         docs=doc_text
     )
-    result: PlannerOutput = planner_model.invoke(prompt)
+
+def run_planner(question: str, rag_docs: list):
+    prompt = build_planner_prompt(question, rag_docs)
+    if prompt is None:
+        llm_usage.skip("planner", "token budget")
+        return rule_based_planner(question, rag_docs)
+    with llm_span("planner", prompt, model=PLANNER_MODEL) as span, llm_usage.track("planner", prompt):
+        try:
+            result: PlannerOutput = registry.get("planner_model").invoke(prompt)
+        except llm_resilience.Degraded as e:
+            llm_resilience.fallback("planner", e.reason)
+            return rule_based_planner(question, rag_docs)
+        span.set_attribute("planner.need_sql", result.need_sql)
+        span.set_attribute("planner.need_rag", result.need_rag)
+    return result
+
+planner_batcher = MicroBatcher(
+    lambda prompts: registry.get("planner_model").abatch(prompts, return_exceptions=True),
+    max_batch=int(os.getenv("LLM_BATCH_MAX", "1")),  # off by default, see Classifier_route.py
+    max_wait_ms=float(os.getenv("LLM_BATCH_WAIT_MS", "5")),
+)
+
+async def run_planner_async(question: str, rag_docs: list):
+    prompt = build_planner_prompt(question, rag_docs)
+    if prompt is None:
+        llm_usage.skip("planner", "token budget")
+        return rule_based_planner(question, rag_docs)
+    with llm_span("planner", prompt, model=PLANNER_MODEL) as span, llm_usage.track("planner", prompt):
+        try:
+            if planner_batcher.max_batch > 1:
+                result: PlannerOutput = await planner_batcher.submit(prompt)
+            else:
+                result = await registry.get("planner_model").ainvoke(prompt)
+        except llm_resilience.Degraded as e:
+            llm_resilience.fallback("planner", e.reason)
+            return rule_based_planner(question, rag_docs)
+        span.set_attribute("planner.need_sql", result.need_sql)
+        span.set_attribute("planner.need_rag", result.need_rag)
     return result
 
 if __name__ == "__main__":
@@ -0,0 +1,178 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Tuple
+
+from logger import get_logger
+
+log = get_logger("prompts")
+
+# Prompt construction for the LLM stages.
+#
+# Providers with prompt caching (Groq on its cached models, vLLM / llama.cpp
+# prefix caching when self-hosted) skip the prefill of the longest prefix
+# they have already seen. That only pays off when every call starts with
+# the same bytes: static instructions and the schema first, the inputs of
+# this one call last. A PromptTemplate is split along that line:
+#
+#   prefix   instructions, output requirements and fields that only change
+#            with the deployment (the schema); rendered once per distinct
+#            value and reused verbatim
+#   suffix   the per-call inputs (question, planner output, docs, ...)
+#
+# format() keeps the str.format interface the call sites already use and
+# returns a Prompt: the full text, plus the prefix length and a hash of the
+# prefix. The hash goes on the LLM span, and a new prefix variant (a new
+# schema, an edited instruction block) is logged, since that is when the
+# provider's cache goes cold. Cached prompt tokens reported by the provider
+# are counted per stage in llm_usage; stub_models.PrefixCache simulates the
+# provider side locally (python prompts.py --bench).
+
+PROMPT_PREFIX_VARIANTS = int(os.getenv("PROMPT_PREFIX_VARIANTS", "8"))
+
+
+def prefix_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class Prompt(str):
+    """A rendered prompt (a plain str to the clients) that knows its prefix."""
+
+    def __new__(cls, prefix: str, suffix: str, digest: str, template: str):
+        prompt = super().__new__(cls, prefix + suffix)
+        prompt.prefix_len = len(prefix)
+        prompt.prefix_hash = digest
+        prompt.template = template
+        return prompt
+
+    @property
+    def prefix(self) -> str:
+        return self[:self.prefix_len]
+
+    @property
+    def suffix(self) -> str:
+        return self[self.prefix_len:]
+
+
+class PromptTemplate:
+    """Static prefix + per-call suffix; prefix_fields are filled into the prefix."""
+
+    def __init__(self, name: str, prefix: str, suffix: str, prefix_fields: Tuple[str, ...] = (),
+                 max_variants: int = None):
+        self.name = name
+        self.prefix = prefix
+        self.suffix = suffix
+        self.prefix_fields = tuple(prefix_fields)
+        self.max_variants = max_variants or PROMPT_PREFIX_VARIANTS
+        self._variants: "OrderedDict[Tuple[str, ...], Tuple[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.renders = 0
+        self.prefix_builds = 0
+        self.last_hash = None
+        _templates[name] = self
+
+    def _render_prefix(self, values: Dict[str, Any]) -> Tuple[str, str]:
+        key = tuple(str(values[field]) for field in self.prefix_fields)
+        with self._lock:
+            self.renders += 1
+            cached = self._variants.get(key)
+            if cached is not None:
+                self._variants.move_to_end(key)
+                self.last_hash = cached[1]
+                return cached
+        text = self.prefix.format(**dict(zip(self.prefix_fields, key)))
+        variant = (text, prefix_hash(text))
+        with self._lock:
+            self.prefix_builds += 1
+            self._variants[key] = variant
+            while len(self._variants) > self.max_variants:
+                self._variants.popitem(last=False)
+            self.last_hash = variant[1]
+        log.info("New prompt prefix", extra={"template": self.name, "prefix_hash": variant[1],
+                                             "prefix_tokens": len(text) // 4})
+        return variant
+
+    def format(self, **values) -> Prompt:
+        prefix, digest = self._render_prefix(values)
+        suffix = self.suffix.format(**{k: v for k, v in values.items() if k not in self.prefix_fields})
+        return Prompt(prefix, suffix, digest, self.name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            current = next((v for v in self._variants.values() if v[1] == self.last_hash), None)
+            return {
+                "prefix_hash": self.last_hash,
+                "prefix_tokens": len(current[0]) // 4 if current else None,
+                "renders": self.renders,
+                "prefix_builds": self.prefix_builds,
+                "variants": len(self._variants),
+            }
+
+
+_templates: Dict[str, PromptTemplate] = {}
+
+
+def stats() -> Dict[str, Any]:
+    return {name: template.stats() for name, template in _templates.items()}
+
+
+def _bench(rounds: int, prefill_ms_per_1k: float, latency_ms: float, cached: bool) -> Dict[str, Any]:
+    """Router, planner and repair calls against stub models with simulated prefill."""
+    import llm_usage
+    from Classifier_route import classify_route
+    from planner import run_planner
+    from Repair_loop import run_repair
+    from stub_models import install_stub_models
+    from sqlite_tool import get_db_schema
+
+    install_stub_models(latency_ms=latency_ms, prefill_ms_per_1k=prefill_ms_per_1k, prefix_cache=cached)
+    questions = [
+        "Revenue for Beverages during Summer Spice Campaign",
+        "Top 3 products by revenue in 1997",
+        "How many orders were placed in June 1997?",
+        "Average order value for Seafood in Q1 1997",
+        "What is the return policy for perishable items?",
+    ]
+    docs = [{"text": "Summer Spice Campaign runs from 1997-06-01 to 1997-06-30."}]
+    schema = get_db_schema()
+    with llm_usage.request() as usage:
+        for i in range(rounds):
+            question = f"{questions[i % len(questions)]} (#{i})"
+            classify_route(question)
+            plan = run_planner(question, docs)
+            run_repair(question, plan.model_dump(), "SELECT * FRM Orders", "near 'FRM': syntax error", schema)
+    return {stage: {"avg_ms": round(u.ms / u.calls, 1), "prompt_tokens": u.prompt_tokens,
+                    "cached_tokens": u.cached_tokens} for stage, u in usage.stages.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show prompt prefixes, or measure prefix caching on stub models")
+    parser.add_argument("--bench", type=int, default=0, metavar="ROUNDS",
+                        help="Run ROUNDS router/planner/repair calls with and without a prefix cache")
+    parser.add_argument("--prefill-ms-per-1k", type=float, default=40.0,
+                        help="Simulated prefill time per 1k uncached prompt tokens")
+    parser.add_argument("--latency-ms", type=float, default=5.0, help="Simulated fixed latency per call")
+    parser.add_argument("--db", default=None, help="SQLite database (default: sqlite_tool.Database_path)")
+    args = parser.parse_args()
+
+    if args.db:
+        import sqlite_tool
+        sqlite_tool.Database_path = args.db
+    if args.bench:
+        print(json.dumps({
+            "no_prefix_cache": _bench(args.bench, args.prefill_ms_per_1k, args.latency_ms, cached=False),
+            "prefix_cache": _bench(args.bench, args.prefill_ms_per_1k, args.latency_ms, cached=True),
+        }, indent=2))
+    else:
+        import Classifier_route  # noqa: F401  (register the templates)
+        import planner  # noqa: F401
+        import Repair_loop  # noqa: F401
+        import prompts  # the registry those modules used, not this __main__ copy
+        for name, template in prompts._templates.items():
+            print(f"== {name} (prefix fields: {list(template.prefix_fields) or 'none'})")
+            print(template.prefix)
+            print("-- per-call suffix --")
+            print(template.suffix)
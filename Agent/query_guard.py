@@ -0,0 +1,345 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from logger import get_logger
+
+log = get_logger("query_guard")
+
+# Cost guard for generated and repaired SQL.
+#
+# Before a SELECT runs, check() prices it from EXPLAIN QUERY PLAN and the
+# table row counts (sqlite_stat1 when ANALYZE has run, COUNT(*) otherwise,
+# cached per data snapshot). The estimate is the number of rows the plan
+# visits: nested loops multiply (SCAN = every row, SEARCH on the rowid or a
+# unique index = 1, other index lookups = the stat1 average or SQLite's
+# default of 10, ranges a quarter), sorts and materialized subqueries add.
+#
+#   cheap / moderate   run as is
+#   expensive          >= QUERY_COST_EXPENSIVE: a row-returning query
+#                      without LIMIT gets LIMIT QUERY_AUTO_LIMIT
+#   excessive          >= QUERY_COST_MAX: limited if SQLite can stop early
+#                      (no aggregate, no ORDER BY), otherwise rejected with
+#                      QueryRejected, which the repair loop sees as the error
+#
+# Whatever the estimate says, StepBudget stops a statement after
+# QUERY_MAX_VM_STEPS SQLite VM instructions per fetch. It is the single
+# progress handler on the connection, so it also carries the cancel event
+# the candidate race uses.
+#
+#   QUERY_GUARD   enforce (default) | warn (estimate and log only) | off
+
+QUERY_GUARD = os.getenv("QUERY_GUARD", "enforce")
+QUERY_COST_EXPENSIVE = float(os.getenv("QUERY_COST_EXPENSIVE", "2e6"))
+QUERY_COST_MAX = float(os.getenv("QUERY_COST_MAX", "5e7"))
+QUERY_AUTO_LIMIT = int(os.getenv("QUERY_AUTO_LIMIT", "10000"))
+QUERY_MAX_VM_STEPS = int(os.getenv("QUERY_MAX_VM_STEPS", "200000000"))
+QUERY_STATS_TTL_S = float(os.getenv("QUERY_STATS_TTL_S", "300"))
+
+CHEAP_COST = 1e4
+DEFAULT_ROWS_PER_KEY = 10        # what SQLite assumes without ANALYZE
+DEFAULT_TABLE_ROWS = 1000        # a name the estimator cannot resolve
+
+LOOP_RE = re.compile(r"^(SCAN|SEARCH) (?:TABLE )?(.+?)(?: AS (\S+))?(?: USING (.*))?$")
+INDEX_RE = re.compile(r"INDEX (\S+)")
+ALIAS_RE = re.compile(r'("[^"]+"|\[[^\]]+\]|`[^`]+`|\w+)\s+(?:AS\s+)?(\w+)', re.IGNORECASE)
+AGGREGATE_RE = re.compile(r"\b(?:COUNT|SUM|AVG|MIN|MAX|TOTAL|GROUP_CONCAT)\s*\(|\bGROUP\s+BY\b", re.IGNORECASE)
+ORDER_RE = re.compile(r"\bORDER\s+BY\b", re.IGNORECASE)
+LIMIT_RE = re.compile(r"\bLIMIT\s+\d+(?:\s*(?:,|OFFSET)\s*\d+)?\s*;?\s*$", re.IGNORECASE)
+
+
+class GuardError(Exception):
+    """A statement the guard refused or stopped; the message says why."""
+
+
+class QueryRejected(GuardError):
+    pass
+
+
+class StepBudgetExceeded(GuardError):
+    pass
+
+
+class Checked:
+    """The statement to run (possibly rewritten) and what the guard thought of it."""
+
+    __slots__ = ("sql", "cost", "cost_class", "action", "plan")
+
+    def __init__(self, sql: str, cost: float = 0.0, cost_class: str = "unchecked", action: str = "run",
+                 plan: List[str] = ()):
+        self.sql = sql
+        self.cost = cost
+        self.cost_class = cost_class
+        self.action = action
+        self.plan = list(plan)
+
+
+# ---------------------------------------------------------------------------
+# Table statistics
+# ---------------------------------------------------------------------------
+
+class TableStats:
+    """Row counts per table and rows-per-key per index, names lower-cased."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.rows: Dict[str, float] = {}
+        self.rows_per_key: Dict[str, float] = {}
+        self.unique = set()
+        self.created = time.monotonic()
+
+        stat1 = {}
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'").fetchone():
+            for table, index, stat in conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1"):
+                numbers = [int(n) for n in (stat or "").split() if n.isdigit()]
+                if numbers:
+                    stat1[(table.lower(), (index or "").lower())] = numbers
+
+        tables = [row[0] for row in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+        for table in tables:
+            key = table.lower()
+            counted = [numbers[0] for (t, _), numbers in stat1.items() if t == key]
+            if counted:
+                self.rows[key] = float(max(counted))
+            else:
+                self.rows[key] = float(conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0])
+            for _, index, unique, *_ in conn.execute(f"PRAGMA index_list('{table}')"):
+                if unique:
+                    self.unique.add(index.lower())
+                numbers = stat1.get((key, index.lower()))
+                if numbers and len(numbers) > 1:
+                    self.rows_per_key[index.lower()] = float(numbers[1])
+
+
+_stats: Dict[Any, TableStats] = {}
+_stats_lock = threading.Lock()
+
+
+def table_stats(conn: sqlite3.Connection, key: Any) -> TableStats:
+    """Stats for the data version `key` (a snapshot), gathered once per key."""
+    stats = _stats.get(key)
+    if stats is not None and time.monotonic() - stats.created < QUERY_STATS_TTL_S:
+        return stats
+    stats = TableStats(conn)
+    with _stats_lock:
+        # Snapshots are immutable, so only the latest few are worth keeping
+        if len(_stats) >= 8:
+            _stats.pop(next(iter(_stats)))
+        _stats[key] = stats
+    return stats
+
+
+# ---------------------------------------------------------------------------
+# Estimate
+# ---------------------------------------------------------------------------
+
+def _unquote(name: str) -> str:
+    return name[1:-1] if name[:1] in ('"', "[", "`") else name
+
+
+def _aliases(query: str, stats: TableStats) -> Dict[str, str]:
+    """alias -> table for every `table alias` / `table AS alias` in the text."""
+    aliases = {}
+    for table, alias in ALIAS_RE.findall(query):
+        table = _unquote(table).lower()
+        if table in stats.rows:
+            aliases[alias.lower()] = table
+    return aliases
+
+
+def _loop_rows(match, stats: TableStats, aliases: Dict[str, str], derived: Dict[str, float]) -> Tuple[float, float]:
+    """(rows per iteration, one-off setup rows) of one SCAN/SEARCH plan line."""
+    kind, name, alias, using = match.groups()
+    name = (alias or name).lower()
+    table = name if name in stats.rows else aliases.get(name)
+    rows = stats.rows[table] if table else derived.get(name, DEFAULT_TABLE_ROWS)
+    if kind == "SCAN" or not using:
+        return rows, 0.0
+
+    condition = using[using.find("("):] if "(" in using else ""
+    setup = rows if "AUTOMATIC" in using else 0.0   # SQLite builds the index first
+    has_range = bool(re.search(r"[<>]", condition))
+    has_eq = bool(re.search(r"(?<![<>!])=\?", condition))
+    index = INDEX_RE.search(using)
+    index = index.group(1).lower() if index else None
+
+    if "rowid=?" in condition or (has_eq and not has_range and index in stats.unique):
+        per_key = 1.0
+    elif has_eq:
+        per_key = stats.rows_per_key.get(index, DEFAULT_ROWS_PER_KEY)
+        if has_range:
+            per_key /= 4
+    elif has_range:
+        per_key = rows / 4
+    else:
+        per_key = rows
+    return min(max(per_key, 1.0), max(rows, 1.0)), setup
+
+
+def _walk(parent: int, children: Dict[int, List[Tuple[int, str]]], stats: TableStats,
+          aliases: Dict[str, str], derived: Dict[str, float]) -> Tuple[float, float]:
+    """(rows visited, rows produced) of the plan lines under `parent`."""
+    running, total = 1.0, 0.0
+    for node, detail in children.get(parent, []):
+        loop = LOOP_RE.match(detail)
+        if loop:
+            rows, setup = _loop_rows(loop, stats, aliases, derived)
+            running *= rows
+            total += running + setup
+        elif detail.startswith(("MATERIALIZE ", "CO-ROUTINE ")):
+            cost, rows = _walk(node, children, stats, aliases, derived)
+            total += cost
+            derived[detail.split(" ", 1)[1].lower()] = rows
+        elif detail.startswith("MULTI-INDEX OR"):
+            cost, _ = _walk(node, children, stats, aliases, derived)
+            running *= max(cost, 1.0)
+            total += running
+        elif detail.startswith("CORRELATED"):
+            cost, _ = _walk(node, children, stats, aliases, derived)
+            total += running * cost
+        elif "TEMP B-TREE" in detail:
+            total += running
+        elif node in children:
+            # Non-correlated subqueries and compound SELECT members run once
+            cost, _ = _walk(node, children, stats, aliases, derived)
+            total += cost
+    return total, running
+
+
+def estimate_cost(query: str, conn: sqlite3.Connection, stats: TableStats) -> Tuple[float, List[str]]:
+    """Estimated rows visited by `query` and the plan lines it was read from."""
+    plan = conn.execute(f"EXPLAIN QUERY PLAN {query.strip().rstrip(';')}").fetchall()
+    children: Dict[int, List[Tuple[int, str]]] = {}
+    for node, parent, _, detail in plan:
+        children.setdefault(parent, []).append((node, detail))
+    cost, _ = _walk(0, children, stats, _aliases(query, stats), {})
+    return cost, [row[3] for row in plan]
+
+
+def classify(cost: float) -> str:
+    if cost >= QUERY_COST_MAX:
+        return "excessive"
+    if cost >= QUERY_COST_EXPENSIVE:
+        return "expensive"
+    return "cheap" if cost < CHEAP_COST else "moderate"
+
+
+def add_limit(query: str, limit: int) -> str:
+    # On its own line, so a trailing -- comment cannot swallow it
+    return f"{query.strip().rstrip(';').rstrip()}\nLIMIT {limit}"
+
+
+# ---------------------------------------------------------------------------
+# Policy
+# ---------------------------------------------------------------------------
+
+_checked: "OrderedDict[tuple, Checked]" = OrderedDict()
+_checked_lock = threading.Lock()
+_counters = {"checked": 0, "limited": 0, "rejected": 0, "budget_exceeded": 0}
+
+
+def _decide(query: str, cost: float) -> Tuple[str, str]:
+    cost_class = classify(cost)
+    if QUERY_GUARD != "enforce" or cost_class in ("cheap", "moderate"):
+        return cost_class, "run"
+    rows_out = not AGGREGATE_RE.search(query)
+    has_limit = bool(LIMIT_RE.search(query.strip()))
+    if cost_class == "expensive":
+        return cost_class, "limit" if rows_out and not has_limit else "run"
+    if rows_out and not ORDER_RE.search(query):
+        # SQLite stops scanning once LIMIT rows are out
+        return cost_class, "run" if has_limit else "limit"
+    return cost_class, "reject"
+
+
+def check(query: str, conn: sqlite3.Connection, stats_key: Any) -> Checked:
+    """
+    Prices a SELECT and applies the policy: returns the statement to run
+    (possibly with LIMIT added) or raises QueryRejected.
+    """
+    if QUERY_GUARD == "off" or not query.strip().upper().startswith("SELECT"):
+        return Checked(query)
+
+    memo_key = (stats_key, query)
+    checked = _checked.get(memo_key)
+    if checked is None:
+        stats = table_stats(conn, stats_key)
+        try:
+            cost, plan = estimate_cost(query, conn, stats)
+        except sqlite3.Error:
+            return Checked(query)   # let execution report the error itself
+        cost_class, action = _decide(query, cost)
+        sql = add_limit(query, QUERY_AUTO_LIMIT) if action == "limit" else query
+        checked = Checked(sql, cost, cost_class, action, plan)
+        with _checked_lock:
+            _checked[memo_key] = checked
+            if len(_checked) > 512:
+                _checked.popitem(last=False)
+
+    _counters["checked"] += 1
+    if checked.cost_class in ("expensive", "excessive"):
+        log.warning("Expensive query", extra={"cost": round(checked.cost), "class": checked.cost_class,
+                                              "action": checked.action, "sql": query.strip()[:200]})
+    if checked.action == "limit":
+        _counters["limited"] += 1
+    elif checked.action == "reject":
+        _counters["rejected"] += 1
+        raise QueryRejected(
+            f"QUERY_TOO_EXPENSIVE: the plan visits ~{checked.cost:,.0f} rows (limit {QUERY_COST_MAX:,.0f}): "
+            f"{'; '.join(checked.plan[:6])}. Join on keys and filter before aggregating."
+        )
+    return checked
+
+
+class StepBudget:
+    """
+    SQLite progress handler: aborts the statement when `cancel` is set or
+    after max_steps VM instructions since the last reset(). SQLite allows
+    one handler per connection, so both checks live here.
+    """
+
+    def __init__(self, cancel: Optional[threading.Event] = None, interval: int = 1000, max_steps: int = None):
+        self.cancel = cancel
+        self.interval = interval
+        self.max_steps = QUERY_MAX_VM_STEPS if max_steps is None else max_steps
+        self.steps = 0
+        self.exceeded = False
+
+    @property
+    def active(self) -> bool:
+        return self.cancel is not None or (QUERY_GUARD == "enforce" and self.max_steps > 0)
+
+    def __call__(self) -> int:
+        if self.cancel is not None and self.cancel.is_set():
+            return 1
+        self.steps += self.interval
+        if QUERY_GUARD == "enforce" and 0 < self.max_steps < self.steps:
+            self.exceeded = True
+            return 1
+        return 0
+
+    def reset(self):
+        self.steps = 0
+
+    def install(self, conn: sqlite3.Connection):
+        if self.active:
+            conn.set_progress_handler(self, self.interval)
+
+    def remove(self, conn: sqlite3.Connection):
+        if self.active:
+            conn.set_progress_handler(None, 0)
+
+    def error(self) -> StepBudgetExceeded:
+        _counters["budget_exceeded"] += 1
+        return StepBudgetExceeded(
+            f"QUERY_BUDGET_EXCEEDED: stopped after {self.steps:,} SQLite VM steps "
+            f"(limit {self.max_steps:,}). Narrow the query or join on keys."
+        )
+
+
+def stats() -> Dict[str, Any]:
+    return {"mode": QUERY_GUARD, **_counters, "max_vm_steps": QUERY_MAX_VM_STEPS}
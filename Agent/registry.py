@@ -0,0 +1,65 @@
+import threading
+from typing import Any, Callable, Dict
+
+# Lazily constructed shared resources (model clients, retriever index).
+#
+# Modules register a factory under a name; the object is built on the first
+# get() and reused afterwards. Nothing heavy happens at import time, so
+# importing Graph stays cheap for tools and workers that never call an LLM.
+#
+#   @registry.factory("router_model")
+#   def _build_router_model(): ...
+#
+#   registry.get("router_model").invoke(prompt)
+
+_factories: Dict[str, Callable[[], Any]] = {}
+_instances: Dict[str, Any] = {}
+_lock = threading.RLock()
+
+
+def factory(name: str):
+    """Decorator registering a zero-argument factory for `name`."""
+    def decorator(fn: Callable[[], Any]):
+        _factories[name] = fn
+        return fn
+    return decorator
+
+
+def get(name: str) -> Any:
+    """Returns the shared instance for `name`, building it on first use."""
+    try:
+        return _instances[name]
+    except KeyError:
+        pass
+
+    with _lock:
+        if name not in _instances:
+            if name not in _factories:
+                raise KeyError(f"No factory registered for '{name}'")
+            _instances[name] = _factories[name]()
+        return _instances[name]
+
+
+def override(name: str, instance: Any):
+    """Replaces the instance for `name` (stubs, tests, benchmarks)."""
+    with _lock:
+        _instances[name] = instance
+
+
+def reset(name: str = None):
+    """Drops built instances so the next get() rebuilds them."""
+    with _lock:
+        if name is None:
+            _instances.clear()
+        else:
+            _instances.pop(name, None)
+
+
+def warm(*names: str):
+    """Builds the named resources now, e.g. before forking workers."""
+    for name in names:
+        get(name)
+
+
+def built() -> Dict[str, bool]:
+    return {name: name in _instances for name in _factories}
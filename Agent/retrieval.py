@@ -1,6 +1,22 @@
+import json
 import os
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import pickle
+import registry
+from logger import get_logger
+from tracing import start_span
+
+log = get_logger("retrieval")
+
+# Lexical engine, chosen per deployment:
+#   tfidf   cosine over the TF-IDF matrix (the original retriever)
+#   bm25    BM25 over compact NumPy postings (bm25.py), no vocabulary cap
+#   hybrid  RETRIEVER_FUSION_ALPHA * BM25 + (1 - alpha) * TF-IDF, with BM25
+#           scaled to [0, 1] by the query's best score
+RETRIEVER_ENGINE = os.getenv("RETRIEVER_ENGINE", "tfidf").lower()
+RETRIEVER_FUSION_ALPHA = float(os.getenv("RETRIEVER_FUSION_ALPHA", "0.5"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.5"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+ENGINES = ("tfidf", "bm25", "hybrid")
 
 DOC_PATHS = [
     r"C:\Users\HP\Desktop\Retail-Agent\AI-Assignment-Project\docs\catalog.md",
@@ -22,7 +38,7 @@ def load_docs_from_paths(file_paths, chunk_size=250):
 
     for path in file_paths:
         if not os.path.exists(path):
-            print(f"[WARNING] File not found: {path}")
+            log.warning("File not found", extra={"path": path})
             continue
 
         try:
@@ -39,20 +55,30 @@ def load_docs_from_paths(file_paths, chunk_size=250):
                     "chunk_id": f"{file}::chunk{i}"
                 })
         except Exception as e:
-            print(f"Error reading {path}: {e}")
+            log.error("Error reading document", extra={"path": path, "error": str(e)})
 
     return documents, metadata
 
-def build_tfidf_index(docs):
-    vectorizer = TfidfVectorizer(stop_words="english", max_features=5000)
+# scikit-learn is imported inside the functions that need it; it is the
+# single most expensive import in the agent.
+
+def build_tfidf_index(docs, max_features=5000):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    vectorizer = TfidfVectorizer(stop_words="english", max_features=max_features)
     vectors = vectorizer.fit_transform(docs)
     return vectorizer, vectors
 
 def retrieve(query, top_k, vectorizer, doc_vectors, docs, metadata):
-    query_vec = vectorizer.transform([query])
-    scores = cosine_similarity(query_vec, doc_vectors)[0]
+    if not docs:
+        return []
 
-    top_ids = scores.argsort()[-top_k:][::-1]
+    from sklearn.metrics.pairwise import cosine_similarity
+    with start_span("retrieval.tfidf", **{"retrieval.top_k": top_k, "retrieval.corpus": len(docs)}) as span:
+        query_vec = vectorizer.transform([query])
+        scores = cosine_similarity(query_vec, doc_vectors)[0]
+
+        top_ids = scores.argsort()[-top_k:][::-1]
+        span.set_attribute("retrieval.results", len(top_ids))
 
     return [
         {
@@ -64,18 +90,148 @@ def retrieve(query, top_k, vectorizer, doc_vectors, docs, metadata):
         for i in top_ids
     ]
 
+def _results(hits, docs, metadata):
+    return [
+        {
+            "text": docs[i],
+            "score": score,
+            "source": metadata[i]["source"],
+            "chunk_id": metadata[i]["chunk_id"]
+        }
+        for i, score in hits
+    ]
+
+def build_bm25_index(docs, k1=None, b=None):
+    from bm25 import BM25Index
+    return BM25Index(docs, k1=BM25_K1 if k1 is None else k1, b=BM25_B if b is None else b)
+
+def retrieve_bm25(query, top_k, index, docs, metadata):
+    if not docs:
+        return []
+
+    from bm25 import top_indices
+    with start_span("retrieval.bm25", **{"retrieval.top_k": top_k, "retrieval.corpus": len(docs)}) as span:
+        hits = top_indices(index.scores(query), top_k)
+        span.set_attribute("retrieval.results", len(hits))
+    return _results(hits, docs, metadata)
+
+def retrieve_hybrid(query, top_k, vectorizer, doc_vectors, index, docs, metadata, alpha=None):
+    if not docs:
+        return []
+
+    from bm25 import top_indices
+    from sklearn.metrics.pairwise import cosine_similarity
+    alpha = RETRIEVER_FUSION_ALPHA if alpha is None else alpha
+    with start_span("retrieval.hybrid", **{"retrieval.top_k": top_k, "retrieval.corpus": len(docs),
+                                           "retrieval.alpha": alpha}) as span:
+        lexical = index.scores(query)
+        best = float(lexical.max()) if len(lexical) else 0.0
+        if best > 0:
+            lexical = lexical / best
+        cosine = cosine_similarity(vectorizer.transform([query]), doc_vectors)[0]
+        hits = top_indices(alpha * lexical + (1 - alpha) * cosine, top_k)
+        span.set_attribute("retrieval.results", len(hits))
+    return _results(hits, docs, metadata)
+
+def search(query, top_k=5, engine=None):
+    """Top chunks for `query` from the shared index, using RETRIEVER_ENGINE."""
+    engine = engine or RETRIEVER_ENGINE
+    if engine not in ENGINES:
+        raise ValueError(f"engine must be one of {ENGINES}, got '{engine}'")
+    docs, metadata, vectorizer, vectors = registry.get("retriever")
+    if engine != "bm25" and vectorizer is None and docs:
+        # A BM25 deployment asked for TF-IDF scores: fit it once, on demand
+        vectorizer, vectors = registry.get("tfidf_index")
+    if engine == "bm25":
+        return retrieve_bm25(query, top_k, registry.get("bm25_index"), docs, metadata)
+    if engine == "hybrid":
+        return retrieve_hybrid(query, top_k, vectorizer, vectors, registry.get("bm25_index"), docs, metadata)
+    return retrieve(query, top_k, vectorizer, vectors, docs, metadata)
+
+def save_index(directory, docs, metadata, vectorizer=None, vectors=None, bm25_index=None):
+    """
+    Writes the chunk store and its indexes to `directory` for load_index().
+    Matrices are stored as raw .npy arrays so they can be memory-mapped.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(os.path.join(directory, "chunks.jsonl"), "w", encoding="utf-8") as f:
+        for text, meta in zip(docs, metadata):
+            f.write(json.dumps({"text": text, **meta}) + "\n")
+    if vectorizer is not None:
+        with open(os.path.join(directory, "tfidf_vectorizer.pkl"), "wb") as f:
+            pickle.dump(vectorizer, f)
+        import numpy as np
+        for name in ("data", "indices", "indptr"):
+            np.save(os.path.join(directory, f"tfidf_{name}.npy"), getattr(vectors, name))
+        with open(os.path.join(directory, "tfidf.json"), "w", encoding="utf-8") as f:
+            json.dump({"shape": list(vectors.shape)}, f)
+    if bm25_index is not None:
+        bm25_index.save(directory)
+
+def load_index(directory, mmap=True):
+    """
+    (docs, metadata, vectorizer, vectors, bm25_index) from save_index();
+    missing indexes are None. With mmap the arrays are read-only maps of
+    the files, shared by every process that loads them.
+    """
+    docs, metadata = [], []
+    with open(os.path.join(directory, "chunks.jsonl"), "r", encoding="utf-8") as f:
+        for line in f:
+            entry = json.loads(line)
+            docs.append(entry.pop("text"))
+            metadata.append(entry)
+
+    vectorizer = vectors = None
+    if os.path.exists(os.path.join(directory, "tfidf_vectorizer.pkl")):
+        import numpy as np
+        from scipy.sparse import csr_matrix
+        with open(os.path.join(directory, "tfidf_vectorizer.pkl"), "rb") as f:
+            vectorizer = pickle.load(f)
+        with open(os.path.join(directory, "tfidf.json"), "r", encoding="utf-8") as f:
+            shape = tuple(json.load(f)["shape"])
+        mode = "r" if mmap else None
+        arrays = [np.load(os.path.join(directory, f"tfidf_{name}.npy"), mmap_mode=mode)
+                  for name in ("data", "indices", "indptr")]
+        vectors = csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+    bm25_index = None
+    if os.path.exists(os.path.join(directory, "bm25.json")):
+        from bm25 import BM25Index
+        bm25_index = BM25Index.load(directory, mmap=mmap)
+    return docs, metadata, vectorizer, vectors, bm25_index
+
 def init_retriever(chunk_size=250):
     docs, metadata = load_docs_from_paths(DOC_PATHS, chunk_size)
     if not docs:
-        print("WARNING: No documents loaded!")
-        # Create empty structures
-        vectorizer = TfidfVectorizer(stop_words="english")
-        vectors = vectorizer.fit_transform([""])
-        return [], [], vectorizer, vectors
-        
+        log.warning("No documents loaded!")
+        # Empty structures; retrieve() returns nothing for an empty corpus.
+        # (A TF-IDF vectorizer cannot be fitted on an empty vocabulary.)
+        return [], [], None, None
+
+    if RETRIEVER_ENGINE == "bm25":
+        # BM25-only deployments never fit (or import) TF-IDF
+        return docs, metadata, None, None
     vectorizer, vectors = build_tfidf_index(docs)
     return docs, metadata, vectorizer, vectors
 
+@registry.factory("retriever")
+def build_retriever():
+    """Shared (docs, metadata, vectorizer, vectors), built on first use."""
+    if RETRIEVER_ENGINE not in ENGINES:
+        raise ValueError(f"RETRIEVER_ENGINE must be one of {ENGINES}, got '{RETRIEVER_ENGINE}'")
+    return init_retriever()
+
+@registry.factory("tfidf_index")
+def build_tfidf():
+    """TF-IDF over the "retriever" chunks when RETRIEVER_ENGINE=bm25 skipped it."""
+    return build_tfidf_index(registry.get("retriever")[0])
+
+@registry.factory("bm25_index")
+def build_bm25():
+    """BM25 postings over the same chunks as the "retriever" entry."""
+    docs = registry.get("retriever")[0]
+    return build_bm25_index(docs) if docs else None
+
 if __name__ == "__main__":
     print("Building TF-IDF RAG Retriever...")
     docs, meta, vect, vecs = init_retriever()
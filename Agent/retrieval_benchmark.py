@@ -0,0 +1,247 @@
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+import time
+from typing import List, Dict, Any, Set, Optional
+
+from retrieval import (DOC_PATHS, ENGINES, RETRIEVER_FUSION_ALPHA, load_docs_from_paths, build_tfidf_index,
+                       build_bm25_index, retrieve, retrieve_bm25, retrieve_hybrid)
+
+# Retrieval quality-and-speed benchmark.
+#
+# Labels are JSONL: {"question": "...", "relevant": ["marketing_calendar.md::chunk0", ...]}
+# Chunk ids refer to --label-chunk-size. When the sweep uses another chunk
+# size, a chunk counts as relevant if its word span overlaps a labeled one,
+# so one label file serves every chunk size.
+#
+# --engines compares the TF-IDF retriever with BM25 and the hybrid fusion
+# on the same chunks (max_features only applies to the TF-IDF side).
+
+
+def load_labels(path: str) -> List[Dict[str, Any]]:
+    labels = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                entry = json.loads(line)
+                labels.append({"question": entry["question"], "relevant": set(entry["relevant"])})
+    return labels
+
+
+def _chunk_span(chunk_id: str, chunk_size: int):
+    """'file.md::chunk3' at chunk_size -> (file.md, first word, end word)."""
+    source, _, index = chunk_id.partition("::chunk")
+    start = int(index) * chunk_size
+    return source, start, start + chunk_size
+
+
+def relevant_ids(labeled: Set[str], label_chunk_size: int, metadata: List[Dict[str, str]],
+                 chunk_size: int) -> Set[str]:
+    """Maps labeled chunk ids onto the chunk ids of another chunk size."""
+    if chunk_size == label_chunk_size:
+        return set(labeled)
+
+    spans = [_chunk_span(cid, label_chunk_size) for cid in labeled]
+    mapped = set()
+    for meta in metadata:
+        if meta["source"] == SYNTHETIC_SOURCE:
+            continue
+        source, start, end = _chunk_span(meta["chunk_id"], chunk_size)
+        if any(s == source and start < e and b < end for s, b, e in spans):
+            mapped.add(meta["chunk_id"])
+    return mapped
+
+
+SYNTHETIC_SOURCE = "synthetic"
+
+
+def scale_corpus(docs: List[str], metadata: List[Dict[str, str]], factor: int, seed: int = 13):
+    """
+    Grows the corpus to factor x its size with distractor chunks whose words
+    are drawn from the real vocabulary, so IDF and sparsity behave like a
+    larger document set while labels stay valid.
+    """
+    if factor <= 1:
+        return list(docs), list(metadata)
+
+    rng = random.Random(seed)
+    pool = " ".join(docs).split()
+    lengths = [len(d.split()) for d in docs] or [1]
+
+    scaled_docs = list(docs)
+    scaled_meta = list(metadata)
+    for i in range(len(docs) * (factor - 1)):
+        length = lengths[i % len(lengths)]
+        scaled_docs.append(" ".join(rng.choice(pool) for _ in range(length)))
+        scaled_meta.append({"source": SYNTHETIC_SOURCE, "chunk_id": f"{SYNTHETIC_SOURCE}::chunk{i}"})
+    return scaled_docs, scaled_meta
+
+
+def index_memory_bytes(vectorizer, vectors) -> int:
+    """Approximate resident size of the TF-IDF index (matrix + vocabulary + idf)."""
+    total = vectors.data.nbytes + vectors.indices.nbytes + vectors.indptr.nbytes
+    total += sys.getsizeof(vectorizer.vocabulary_)
+    total += sum(sys.getsizeof(term) + sys.getsizeof(idx) for term, idx in vectorizer.vocabulary_.items())
+    total += vectorizer.idf_.nbytes
+    return total
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def evaluate_config(paths: List[str], labels: List[Dict[str, Any]], label_chunk_size: int,
+                    chunk_size: int, max_features: Optional[int], top_ks: List[int],
+                    scale: int, repeat: int, engine: str = "tfidf",
+                    alpha: float = RETRIEVER_FUSION_ALPHA) -> List[Dict[str, Any]]:
+    """
+    Builds one index and scores it at every top_k.
+    Returns one result row per top_k.
+    """
+    docs, metadata = load_docs_from_paths(paths, chunk_size)
+    docs, metadata = scale_corpus(docs, metadata, scale)
+
+    vectorizer = vectors = index = None
+    started = time.perf_counter()
+    if engine in ("tfidf", "hybrid"):
+        vectorizer, vectors = build_tfidf_index(docs, max_features=max_features)
+    if engine in ("bm25", "hybrid"):
+        index = build_bm25_index(docs)
+    build_ms = (time.perf_counter() - started) * 1000
+    memory = (index_memory_bytes(vectorizer, vectors) if vectorizer is not None else 0) \
+        + (index.memory_bytes() if index is not None else 0)
+    vocabulary = len(index.vocabulary) if index is not None else len(vectorizer.vocabulary_)
+
+    def run(question: str, k: int):
+        if engine == "bm25":
+            return retrieve_bm25(question, k, index, docs, metadata)
+        if engine == "hybrid":
+            return retrieve_hybrid(question, k, vectorizer, vectors, index, docs, metadata, alpha)
+        return retrieve(question, k, vectorizer, vectors, docs, metadata)
+
+    targets = [relevant_ids(l["relevant"], label_chunk_size, metadata, chunk_size) for l in labels]
+
+    rows = []
+    for k in top_ks:
+        recalls = []
+        reciprocal_ranks = []
+        latencies = []
+        for label, relevant in zip(labels, targets):
+            for _ in range(repeat):
+                started = time.perf_counter()
+                results = run(label["question"], k)
+                latencies.append((time.perf_counter() - started) * 1000)
+
+            if not relevant:
+                continue
+            ranked = [r["chunk_id"] for r in results]
+            recalls.append(len(relevant.intersection(ranked)) / len(relevant))
+            first = next((i for i, cid in enumerate(ranked, 1) if cid in relevant), None)
+            reciprocal_ranks.append(1.0 / first if first else 0.0)
+
+        rows.append({
+            "engine": engine,
+            "chunk_size": chunk_size,
+            "max_features": max_features,
+            "scale": scale,
+            "top_k": k,
+            "chunks": len(docs),
+            "vocabulary": vocabulary,
+            "recall_at_k": round(sum(recalls) / len(recalls), 4) if recalls else 0.0,
+            "mrr": round(sum(reciprocal_ranks) / len(reciprocal_ranks), 4) if reciprocal_ranks else 0.0,
+            "build_ms": round(build_ms, 3),
+            "index_kb": round(memory / 1024, 1),
+            "query_p50_ms": round(_percentile(latencies, 50), 4),
+            "query_p95_ms": round(_percentile(latencies, 95), 4),
+        })
+    return rows
+
+
+def run_sweep(args) -> List[Dict[str, Any]]:
+    paths = DOC_PATHS
+    if args.docs:
+        paths = [os.path.join(args.docs, n) for n in sorted(os.listdir(args.docs)) if n.endswith(".md")]
+    labels = load_labels(args.labels)
+
+    results = []
+    for scale in args.scales:
+        for chunk_size in args.chunk_sizes:
+            for engine in args.engines:
+                # BM25 has no vocabulary cap; one run covers every max_features
+                for max_features in ([None] if engine == "bm25" else args.max_features):
+                    rows = evaluate_config(paths, labels, args.label_chunk_size, chunk_size,
+                                           max_features, args.top_ks, scale, args.repeat,
+                                           engine, args.alpha)
+                    results.extend(rows)
+                    for row in rows:
+                        print_row(row)
+    return results
+
+
+COLUMNS = ["engine", "scale", "chunk_size", "max_features", "top_k", "chunks", "vocabulary",
+           "recall_at_k", "mrr", "build_ms", "index_kb", "query_p50_ms", "query_p95_ms"]
+
+
+def print_header():
+    print("".join(f"{c:>14}" for c in COLUMNS))
+
+
+def print_row(row: Dict[str, Any]):
+    print("".join(f"{str(row[c]):>14}" for c in COLUMNS))
+
+
+def _int_list(text: str) -> List[int]:
+    return [int(x) for x in text.split(",")]
+
+
+def _engine_list(text: str) -> List[str]:
+    engines = [x.strip().lower() for x in text.split(",")]
+    unknown = [e for e in engines if e not in ENGINES]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown engine(s) {unknown}, expected {list(ENGINES)}")
+    return engines
+
+
+def _features_list(text: str) -> List[Optional[int]]:
+    return [None if x.lower() in ("none", "all") else int(x) for x in text.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall@k / latency sweep for the lexical retrievers")
+    parser.add_argument("--labels", required=True, help="JSONL of question -> relevant chunk ids")
+    parser.add_argument("--label-chunk-size", type=int, default=250, help="Chunk size the label ids refer to")
+    parser.add_argument("--docs", default=None, help="Directory of .md docs (default: retrieval.DOC_PATHS)")
+    parser.add_argument("--engines", type=_engine_list, default=["tfidf"],
+                        help=f"Comma list of {', '.join(ENGINES)}")
+    parser.add_argument("--alpha", type=float, default=RETRIEVER_FUSION_ALPHA,
+                        help="BM25 weight in the hybrid fusion")
+    parser.add_argument("--chunk-sizes", type=_int_list, default=[100, 250, 500])
+    parser.add_argument("--max-features", type=_features_list, default=[1000, 5000, None],
+                        help="Comma list; 'none' means unlimited vocabulary")
+    parser.add_argument("--top-ks", type=_int_list, default=[1, 3, 5, 10])
+    parser.add_argument("--scales", type=_int_list, default=[1, 10, 100],
+                        help="Corpus multipliers using synthetic distractor chunks")
+    parser.add_argument("--repeat", type=int, default=5, help="Timed retrievals per question")
+    parser.add_argument("--json", default=None, help="Write all rows as JSON")
+    parser.add_argument("--csv", default=None, help="Write all rows as CSV (for recall vs latency plots)")
+    args = parser.parse_args()
+
+    print_header()
+    results = run_sweep(args)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.csv:
+        with open(args.csv, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=COLUMNS)
+            writer.writeheader()
+            writer.writerows({c: row[c] for c in COLUMNS} for row in results)
@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import JSONResponse, StreamingResponse
+from typing import Literal, Optional
+
+from pydantic import BaseModel, Field
+
+import admission
+import datasource
+import llm_usage
+import llm_resilience
+import prompts
+from Classifier_route import router_batcher
+from Graph import AgentError, inflight_runs, run_agent, stream_agent
+from planner import planner_batcher
+from Repair_loop import repair_memo
+import query_guard
+import sessions
+import sqlite_tool
+from logger import get_logger
+import registry
+import retrieval
+import tracing
+import warmup
+
+log = get_logger("server")
+
+# Build the compiled graph and retriever index at import. Under gunicorn
+# with preload_app=True this happens once in the master and every forked
+# worker shares the pages copy-on-write. Model clients stay lazy (they hold
+# per-process HTTP pools).
+registry.warm("graph", "retriever")
+if retrieval.RETRIEVER_ENGINE != "tfidf":
+    registry.warm("bm25_index")
+
+MAX_CONCURRENT = int(os.getenv("AGENT_MAX_CONCURRENT", "8"))
+MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUE", "32"))
+SHUTDOWN_GRACE_S = float(os.getenv("AGENT_SHUTDOWN_GRACE_S", "30"))
+AGENT_THREADS = int(os.getenv("AGENT_THREADS", "32"))
+# Replay the most frequent logged questions before reporting ready (warmup.py)
+AGENT_WARMUP = os.getenv("AGENT_WARMUP", "1") == "1"
+
+
+class AskRequest(BaseModel):
+    question: str = Field(min_length=1, description="User's natural language question")
+    lane: Literal["interactive", "batch"] = Field(
+        default="interactive", description="Scheduling lane; batch waits longer and yields to interactive"
+    )
+    session_id: Optional[str] = Field(
+        default=None, max_length=128, description="Conversation id; follow-ups in a session reuse the previous turn"
+    )
+
+
+class PageRequest(BaseModel):
+    cursor: str = Field(min_length=1, description="result_cursor from an answer or the previous page")
+    page_size: int = Field(default=0, ge=0, le=5000, description="Rows per page; 0 uses SQL_PAGE_SIZE")
+
+
+class RequestGate:
+    """
+    Bounds agent runs per worker: up to max_concurrent run and up to
+    max_queue wait, interactive requests ahead of batch ones. Waiting
+    spends the request's queue-time budget (admission.py); anything beyond
+    is shed with Overloaded. While draining no new requests are admitted.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int):
+        self._limiter = admission.StageLimiter("request", max_concurrent, max_queue)
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self.in_flight = 0
+        self.draining = False
+
+    async def acquire(self):
+        if self.draining:
+            raise admission.Overloaded("request", "shutting down", retry_after_s=5.0)
+        await self._limiter.acquire(admission.current_budget())
+        self.in_flight += 1
+        self._idle.clear()
+
+    def release(self):
+        self.in_flight -= 1
+        self._limiter.release()
+        if self.in_flight == 0:
+            self._idle.set()
+
+    async def drain(self, timeout_s: float):
+        """Stops admitting requests and waits for in-flight ones to finish."""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout_s)
+        except asyncio.TimeoutError:
+            log.warning("Shutdown grace period expired", extra={"in_flight": self.in_flight})
+
+    def stats(self):
+        return {**self._limiter.stats(), "in_flight": self.in_flight, "draining": self.draining}
+
+
+gate = RequestGate(MAX_CONCURRENT, MAX_QUEUE)
+
+
+class GatedStream(StreamingResponse):
+    """
+    A streaming response that holds a gate slot until it is done. The slot
+    is released when the response finishes, fails or is never iterated
+    (client gone before the first byte), not in the body generator, whose
+    finally only runs once it has started.
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            gate.release()
+
+
+warmup_state = {"status": "pending", "report": None}
+
+
+async def run_warmup():
+    """Per-worker warm-up; /readyz stays 503 until it has finished."""
+    warmup_state["status"] = "warming"
+    try:
+        warmup_state["report"] = await warmup.warm_up()
+    except Exception as e:
+        # A failed warm-up only means cold caches; the worker can still serve
+        log.exception("Warm-up failed")
+        warmup_state["report"] = {"error": str(e)}
+    warmup_state["status"] = "done"
+    log.info("Worker ready", extra={"pid": os.getpid()})
+
+
+@asynccontextmanager
+async def lifespan(_):
+    executor = ThreadPoolExecutor(max_workers=AGENT_THREADS, thread_name_prefix="agent")
+    asyncio.get_running_loop().set_default_executor(executor)
+    # In the background, so a long warm-up never trips gunicorn's worker timeout
+    warming = asyncio.create_task(run_warmup()) if AGENT_WARMUP else None
+    if warming is None:
+        warmup_state["status"] = "done"
+        log.info("Worker ready", extra={"pid": os.getpid()})
+    yield
+    log.info("Worker draining", extra={"pid": os.getpid(), "in_flight": gate.in_flight})
+    if warming is not None and not warming.done():
+        warming.cancel()
+        await asyncio.gather(warming, return_exceptions=True)
+    await gate.drain(SHUTDOWN_GRACE_S)
+    await sessions.close()
+    executor.shutdown(wait=False, cancel_futures=True)
+    tracing.flush()
+
+
+api = FastAPI(title="Retail Analytics Agent", lifespan=lifespan)
+
+
+def _overloaded(e: admission.Overloaded) -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail={"error": "overloaded", "stage": e.stage, "reason": e.reason},
+        headers={"Retry-After": str(max(1, round(e.retry_after_s)))},
+    )
+
+
+def _node_event(node: str, state: dict) -> dict:
+    """Small, JSON-safe summary of one graph step for streaming clients."""
+    event = {"node": node}
+    if node == "router":
+        event["route"] = state.get("route")
+    elif node == "retriever":
+        event["chunks"] = [d.get("chunk_id") for d in state.get("rag_docs") or []]
+    elif node == "planner" and state.get("planner") is not None:
+        event["planner"] = state["planner"].model_dump()
+    elif node in ("sql_gen", "repair"):
+        event["sql"] = state.get("sql")
+    elif node == "sql_exec":
+        result = state.get("sql_result") or {}
+        event["rows"] = len(result.get("rows") or [])
+        event["error"] = result.get("error")
+    return event
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+@api.get("/healthz")
+async def healthz():
+    return {"status": "draining" if gate.draining else "ok", "pid": os.getpid(), "in_flight": gate.in_flight,
+            "warmup": warmup_state["status"]}
+
+
+@api.get("/readyz")
+async def readyz():
+    """200 once the warm-up has finished; 503 while warming or draining."""
+    ready = warmup_state["status"] == "done" and not gate.draining
+    status = "ready" if ready else ("draining" if gate.draining else warmup_state["status"])
+    return JSONResponse({"status": status, "pid": os.getpid()}, status_code=200 if ready else 503)
+
+
+@api.get("/metrics")
+async def metrics():
+    """Queue depth, admissions and rejections per stage for this worker."""
+    return {
+        "pid": os.getpid(),
+        "request": gate.stats(),
+        "stages": admission.stats(),
+        "coalesced_runs": inflight_runs.stats(),
+        "llm_batches": {"router": router_batcher.stats(), "planner": planner_batcher.stats()},
+        "repair_memo": repair_memo.stats(),
+        "result_cursors": sqlite_tool.cursor_stats(),
+        "data": datasource.stats(),
+        "query_guard": query_guard.stats(),
+        "llm_usage": llm_usage.stats(),
+        "llm_resilience": llm_resilience.stats(),
+        "prompts": prompts.stats(),
+        "sessions": await sessions.stats(),
+        "warmup": {**warmup_state, "llm_cache": warmup.llm_cache_stats()},
+    }
+
+
+@api.post("/ask")
+async def ask(request: AskRequest):
+    with admission.request(request.lane):
+        try:
+            await gate.acquire()
+        except admission.Overloaded as e:
+            raise _overloaded(e)
+        try:
+            answer = await run_agent(request.question, request.session_id)
+            return answer.model_dump()
+        except admission.Overloaded as e:
+            raise _overloaded(e)
+        except AgentError as e:
+            raise HTTPException(status_code=500, detail={"error": "agent_failed", "detail": str(e)})
+        finally:
+            gate.release()
+
+
+@api.post("/ask/stream")
+async def ask_stream(request: AskRequest):
+    """
+    Server-sent events: one "node" event per graph step, then "answer".
+    """
+    with admission.request(request.lane):
+        try:
+            await gate.acquire()
+        except admission.Overloaded as e:
+            raise _overloaded(e)
+
+    async def events():
+        # The response body is iterated in its own task, with its own budget
+        try:
+            with admission.request(request.lane):
+                async for node, state in stream_agent(request.question, request.session_id):
+                    yield _sse("node", _node_event(node, state))
+                    if node == "synth" and state.get("final_answer") is not None:
+                        yield _sse("answer", state["final_answer"].model_dump())
+        except admission.Overloaded as e:
+            yield _sse("error", {"detail": str(e), "error": "overloaded", "stage": e.stage, "reason": e.reason})
+        except Exception as e:
+            log.exception("Streaming run failed")
+            yield _sse("error", {"detail": str(e)})
+
+    try:
+        return GatedStream(events(), media_type="text/event-stream")
+    except BaseException:
+        gate.release()
+        raise
+
+
+@api.delete("/sessions/{session_id}")
+async def end_session(session_id: str):
+    """Forgets a conversation's checkpoints."""
+    await sessions.end_session(session_id)
+    llm_usage.forget_session(session_id)
+    return {"session_id": session_id, "ended": True}
+
+
+@api.get("/sessions/{session_id}/usage")
+async def session_usage(session_id: str):
+    """LLM tokens, calls and time this worker spent on a conversation."""
+    usage = llm_usage.session_usage(session_id)
+    if usage is None:
+        raise HTTPException(status_code=404, detail="No usage recorded for this session on this worker")
+    return {"session_id": session_id, **usage}
+
+
+@api.post("/results/next")
+async def next_page(request: PageRequest):
+    """Next page of a paginated SQL result (see sqlite_tool.open_cursor)."""
+    try:
+        async with admission.stage("sql"):
+            page = await asyncio.to_thread(sqlite_tool.fetch_page, request.cursor, request.page_size or None)
+    except admission.Overloaded as e:
+        raise _overloaded(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except query_guard.GuardError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {**page, "rows": [list(row) for row in page["rows"]]}
+
+
+@api.post("/results/close")
+async def close_results(request: PageRequest):
+    try:
+        sqlite_tool.close_cursor(request.cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"closed": True}
+
+
+def serve(host: str, port: int, workers: int):
+    """
+    Runs the API under gunicorn with preloaded, forked uvicorn workers.
+    Falls back to uvicorn's own (spawned) workers where gunicorn is not
+    available, e.g. on Windows; each worker then builds its own index.
+    """
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        import uvicorn
+        uvicorn.run("server:api", host=host, port=port, workers=workers,
+                    timeout_graceful_shutdown=int(SHUTDOWN_GRACE_S))
+        return
+
+    class AgentServer(BaseApplication):
+        def __init__(self, options):
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                self.cfg.set(key, value)
+
+        def load(self):
+            return api
+
+    AgentServer({
+        "bind": f"{host}:{port}",
+        "workers": workers,
+        "worker_class": "uvicorn.workers.UvicornWorker",
+        "preload_app": True,
+        "graceful_timeout": int(SHUTDOWN_GRACE_S),
+        "timeout": 120,
+    }).run()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the agent over HTTP")
+    parser.add_argument("--host", default=os.getenv("AGENT_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("AGENT_PORT", "8000")))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("AGENT_WORKERS", "2")))
+    args = parser.parse_args()
+
+    serve(args.host, args.port, args.workers)
@@ -0,0 +1,143 @@
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional
+
+from logger import get_logger
+
+log = get_logger("sessions")
+
+# Conversation sessions. Each session is a LangGraph thread whose state is
+# checkpointed to a local SQLite file, so a follow-up question starts from
+# the previous turn's route, chunks, plan and schema (see Nodes.py).
+#
+# The store is bounded two ways:
+#   compaction  after every turn only the newest SESSION_KEEP_CHECKPOINTS
+#               checkpoints of the thread are kept (history is never read)
+#   TTL         threads idle for SESSION_TTL_S are deleted, checked at most
+#               every SESSION_PRUNE_EVERY_S
+#
+# The checkpointer is bound to the event loop that created it, so it is
+# built lazily inside each worker (never in the preloading master).
+
+SESSION_DB_PATH = os.getenv("SESSION_DB_PATH", "sessions.sqlite")
+SESSION_TTL_S = float(os.getenv("SESSION_TTL_S", "3600"))
+SESSION_KEEP_CHECKPOINTS = int(os.getenv("SESSION_KEEP_CHECKPOINTS", "1"))
+SESSION_PRUNE_EVERY_S = float(os.getenv("SESSION_PRUNE_EVERY_S", "60"))
+
+# Pydantic models stored in the graph state, allowed back out of checkpoints
+CHECKPOINT_TYPES = [
+    ("planner", "PlannerOutput"),
+    ("sql_gen", "SQLGenOutput"),
+    ("Synthesizer", "SynthOutput"),
+]
+
+_saver = None
+_saver_loop = None
+_init_lock: Optional[asyncio.Lock] = None
+_last_prune = 0.0
+
+
+async def get_checkpointer():
+    """This event loop's AsyncSqliteSaver, created (with its tables) on first use."""
+    global _saver, _saver_loop, _init_lock
+    loop = asyncio.get_running_loop()
+    if _saver is not None and _saver_loop is loop:
+        return _saver
+
+    if _init_lock is None or _saver_loop is not loop:
+        _init_lock = asyncio.Lock()
+        _saver_loop = loop
+        _saver = None
+    async with _init_lock:
+        if _saver is None:
+            import aiosqlite
+            from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+            from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+            conn = await aiosqlite.connect(SESSION_DB_PATH)
+            saver = AsyncSqliteSaver(conn, serde=JsonPlusSerializer(allowed_msgpack_modules=CHECKPOINT_TYPES))
+            await saver.setup()
+            await conn.execute(
+                "CREATE TABLE IF NOT EXISTS session_meta (thread_id TEXT PRIMARY KEY, last_used REAL NOT NULL)"
+            )
+            await conn.commit()
+            _saver = saver
+            log.info("Session store ready", extra={"path": SESSION_DB_PATH})
+    return _saver
+
+
+async def touch_and_compact(thread_id: str):
+    """Records activity for the thread and drops its older checkpoints."""
+    saver = await get_checkpointer()
+    async with saver.lock:
+        conn = saver.conn
+        await conn.execute(
+            "INSERT INTO session_meta (thread_id, last_used) VALUES (?, ?) "
+            "ON CONFLICT(thread_id) DO UPDATE SET last_used = excluded.last_used",
+            (thread_id, time.time()),
+        )
+        await conn.execute(
+            "DELETE FROM checkpoints WHERE thread_id = ? AND checkpoint_id NOT IN ("
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? ORDER BY checkpoint_id DESC LIMIT ?)",
+            (thread_id, thread_id, SESSION_KEEP_CHECKPOINTS),
+        )
+        await conn.execute(
+            "DELETE FROM writes WHERE thread_id = ? AND checkpoint_id NOT IN ("
+            "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ?)",
+            (thread_id, thread_id),
+        )
+        await conn.commit()
+
+    global _last_prune
+    if time.monotonic() - _last_prune >= SESSION_PRUNE_EVERY_S:
+        _last_prune = time.monotonic()
+        asyncio.get_running_loop().create_task(prune_expired())
+
+
+async def prune_expired() -> int:
+    """Deletes threads idle for longer than SESSION_TTL_S; returns how many."""
+    saver = await get_checkpointer()
+    cutoff = time.time() - SESSION_TTL_S
+    async with saver.conn.execute("SELECT thread_id FROM session_meta WHERE last_used < ?", (cutoff,)) as cursor:
+        expired = [row[0] for row in await cursor.fetchall()]
+
+    for thread_id in expired:
+        await saver.adelete_thread(thread_id)
+    if expired:
+        async with saver.lock:
+            await saver.conn.executemany("DELETE FROM session_meta WHERE thread_id = ?",
+                                         [(thread_id,) for thread_id in expired])
+            await saver.conn.commit()
+        log.info("Pruned idle sessions", extra={"sessions": len(expired)})
+    return len(expired)
+
+
+async def end_session(thread_id: str):
+    saver = await get_checkpointer()
+    await saver.adelete_thread(thread_id)
+    async with saver.lock:
+        await saver.conn.execute("DELETE FROM session_meta WHERE thread_id = ?", (thread_id,))
+        await saver.conn.commit()
+
+
+async def close():
+    """Closes this loop's session store (its connection thread blocks exit)."""
+    global _saver
+    if _saver is not None and _saver_loop is asyncio.get_running_loop():
+        await _saver.conn.close()
+    _saver = None
+
+
+async def stats() -> Dict[str, Any]:
+    if _saver is None or _saver_loop is not asyncio.get_running_loop():
+        return {"sessions": 0, "checkpoints": 0}
+    async with _saver.conn.execute(
+        "SELECT (SELECT COUNT(*) FROM session_meta), (SELECT COUNT(*) FROM checkpoints)"
+    ) as cursor:
+        sessions, checkpoints = await cursor.fetchone()
+    return {
+        "sessions": sessions,
+        "checkpoints": checkpoints,
+        "db_bytes": os.path.getsize(SESSION_DB_PATH) if os.path.exists(SESSION_DB_PATH) else 0,
+    }
@@ -1,60 +1,311 @@
 from pydantic import BaseModel, Field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 from dotenv import load_dotenv
+import asyncio
 import os
-from sqlite_tool import get_db_schema
+import threading
+from sqlite_tool import get_db_schema, execute_sql_query
+from planner import CATEGORIES, DATE_RE
 import re
 from caching import cache
 import json
+from logger import get_logger
+from tracing import set_attribute
+import admission
 
 load_dotenv()
+log = get_logger("sql_gen")
+
+# Candidate mode: several SQL statements are raced instead of one
+# statement followed by serial repair (see execute_candidates)
+SQL_CANDIDATES = os.getenv("SQL_CANDIDATES", "0") == "1"
+SQL_MAX_CANDIDATES = int(os.getenv("SQL_MAX_CANDIDATES", "6"))
+SQL_LLM_CANDIDATE = os.getenv("SQL_LLM_CANDIDATE", "0") == "1"
+SQL_RACE_TIMEOUT_S = float(os.getenv("SQL_RACE_TIMEOUT_S", "5"))
 
 class SQLGenOutput(BaseModel):
     sql: str = Field(description="A single safe read-only SQL statement")
     plan_explanation: Optional[str] = Field(description="Short explanation")
 
-def rule_based_sql_generator(question: str, planner: Dict[str, Any]) -> SQLGenOutput:
-    """Rule-based SQL generator as fallback"""
-    question_lower = question.lower()
-    
-    # Enhanced pattern matching
-    if any(pattern in question_lower for pattern in ["order", "10248"]):
-        sql = """
+# Keyword rules, checked in order; rule_based_sql_generator uses the first
+# match, the candidate generator uses every match.
+SQL_RULES = [
+    (
+        lambda q: any(pattern in q for pattern in ["order", "10248"]),
+        """
         SELECT o.OrderID, o.CustomerID, o.OrderDate, o.ShipName, o.ShipAddress, 
                od.ProductID, p.ProductName, od.Quantity, od.UnitPrice, od.Discount
         FROM Orders o
         JOIN "Order Details" od ON o.OrderID = od.OrderID
         JOIN Products p ON od.ProductID = p.ProductID
         WHERE o.OrderID = 10248
+        """,
+        "Retrieve order details for order ID 10248",
+    ),
+    (
+        lambda q: "customer" in q and "count" in q,
+        "SELECT COUNT(*) as total_customers FROM Customers",
+        "Count total customers",
+    ),
+    (
+        lambda q: "supplier" in q and "1" in q,
+        "SELECT * FROM Suppliers WHERE SupplierID = 1",
+        "Retrieve supplier details for ID 1",
+    ),
+    (
+        lambda q: "product" in q and "count" in q,
+        "SELECT COUNT(*) as total_products FROM Products",
+        "Count total products",
+    ),
+    (
+        lambda q: "revenue" in q,
         """
-        explanation = "Retrieve order details for order ID 10248"
-    
-    elif "customer" in question_lower and "count" in question_lower:
-        sql = "SELECT COUNT(*) as total_customers FROM Customers"
-        explanation = "Count total customers"
-    
-    elif "supplier" in question_lower and "1" in question_lower:
-        sql = "SELECT * FROM Suppliers WHERE SupplierID = 1"
-        explanation = "Retrieve supplier details for ID 1"
-    
-    elif "product" in question_lower and "count" in question_lower:
-        sql = "SELECT COUNT(*) as total_products FROM Products"
-        explanation = "Count total products"
-    
-    elif "revenue" in question_lower:
-        sql = """
         SELECT SUM(od.UnitPrice * od.Quantity * (1 - od.Discount)) as total_revenue
         FROM "Order Details" od
-        """
-        explanation = "Calculate total revenue"
-    
-    else:
-        # Default fallback
-        sql = "SELECT * FROM Customers LIMIT 5"
-        explanation = "Retrieve sample customer data"
-    
+        """,
+        "Calculate total revenue",
+    ),
+]
+
+DEFAULT_SQL = ("SELECT * FROM Customers LIMIT 5", "Retrieve sample customer data")
+
+def rule_based_sql_generator(question: str, planner: Dict[str, Any]) -> SQLGenOutput:
+    """Rule-based SQL generator as fallback"""
+    question_lower = question.lower()
+
+    for matches, sql, explanation in SQL_RULES:
+        if matches(question_lower):
+            return SQLGenOutput(sql=sql, plan_explanation=explanation)
+
+    # Default fallback
+    sql, explanation = DEFAULT_SQL
     return SQLGenOutput(sql=sql, plan_explanation=explanation)
 
+# KPI -> (SQL expression, column alias) over "Order Details" od / Orders o
+KPI_SQL = {
+    "revenue": ("SUM(od.UnitPrice * od.Quantity * (1 - od.Discount))", "total_revenue"),
+    "quantity": ("SUM(od.Quantity)", "total_quantity"),
+    "orders": ("COUNT(DISTINCT o.OrderID)", "order_count"),
+}
+
+def _planner_filters(planner: Dict[str, Any]) -> Tuple[Optional[str], Optional[Tuple[str, str]]]:
+    """
+    Category and date range from the planner, only if they are values we
+    can safely inline (a known category, ISO dates).
+    """
+    category = planner.get("category")
+    if category not in CATEGORIES:
+        category = None
+    start, end = planner.get("date_start"), planner.get("date_end")
+    dates = None
+    if start and end and DATE_RE.fullmatch(start) and DATE_RE.fullmatch(end):
+        dates = (start, end)
+    return category, dates
+
+def kpi_sql(kpi: str, category: Optional[str] = None, dates: Optional[Tuple[str, str]] = None,
+            group_by: Optional[str] = None) -> str:
+    """
+    Builds the SQL for one KPI with optional category/date filters.
+    group_by may be "category" or "product" (product is ordered by the KPI
+    and limited to the top 10).
+    """
+    expression, alias = KPI_SQL[kpi]
+    select = [f"{expression} AS {alias}"]
+    joins = ['FROM "Order Details" od', "JOIN Orders o ON o.OrderID = od.OrderID"]
+    where = []
+    group = ""
+
+    if category or group_by:
+        joins.append("JOIN Products p ON p.ProductID = od.ProductID")
+    if category or group_by == "category":
+        joins.append("JOIN Categories c ON c.CategoryID = p.CategoryID")
+    if category:
+        where.append(f"c.CategoryName = '{category}'")
+    if dates:
+        where.append(f"o.OrderDate >= '{dates[0]}' AND o.OrderDate < date('{dates[1]}', '+1 day')")
+    if group_by == "category":
+        select.insert(0, "c.CategoryName")
+        group = "GROUP BY c.CategoryName ORDER BY c.CategoryName"
+    elif group_by == "product":
+        select.insert(0, "p.ProductName")
+        group = f"GROUP BY p.ProductID ORDER BY {alias} DESC LIMIT 10"
+
+    sql = "SELECT " + ", ".join(select) + "\n" + "\n".join(joins)
+    if where:
+        sql += "\nWHERE " + " AND ".join(where)
+    if group:
+        sql += "\n" + group
+    return sql
+
+def _sql_literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+def kpi_grid_sql(kpi: str, categories: List[str], ranges: List[Tuple[str, str, str]]) -> str:
+    """
+    One grouped query for a KPI over every (date range, category) pair:
+    rows of (range label, CategoryName, KPI). `ranges` are (label, start,
+    end) with inclusive ISO dates and may overlap; an order counts in every
+    range it falls in. Same joins and date semantics as kpi_sql.
+    """
+    if not ranges:
+        raise ValueError("kpi_grid_sql needs at least one date range")
+    for _, start, end in ranges:
+        if not (DATE_RE.fullmatch(start) and DATE_RE.fullmatch(end)):
+            raise ValueError(f"Not an ISO date range: {start} .. {end}")
+    unknown = [c for c in categories if c not in CATEGORIES]
+    if unknown:
+        raise ValueError(f"Unknown categories: {unknown}")
+
+    expression, alias = KPI_SQL[kpi]
+    # A derived table rather than a CTE: only statements starting with
+    # SELECT pass sqlite_tool's read-only check
+    rows = "\n    UNION ALL ".join(f"SELECT {_sql_literal(label)} AS label, '{start}' AS date_start, "
+                                  f"'{end}' AS date_end" for label, start, end in ranges)
+    first, last = min(r[1] for r in ranges), max(r[2] for r in ranges)
+    where = [f"o.OrderDate >= '{first}' AND o.OrderDate < date('{last}', '+1 day')"]
+    if categories:
+        where.append("c.CategoryName IN (" + ", ".join(_sql_literal(c) for c in categories) + ")")
+    return "\n".join([
+        f"SELECT r.label, c.CategoryName, {expression} AS {alias}",
+        'FROM "Order Details" od',
+        "JOIN Orders o ON o.OrderID = od.OrderID",
+        "JOIN Products p ON p.ProductID = od.ProductID",
+        "JOIN Categories c ON c.CategoryID = p.CategoryID",
+        f"JOIN (\n    {rows}\n) r ON o.OrderDate >= r.date_start AND o.OrderDate < date(r.date_end, '+1 day')",
+        "WHERE " + " AND ".join(where),
+        "GROUP BY r.label, c.CategoryName",
+    ])
+
+def rule_based_candidates(question: str, planner: Dict[str, Any]) -> List[SQLGenOutput]:
+    """
+    Every rule SQL that fits the question, most specific first: planner
+    KPI templates (all filters, then relaxed), then matching keyword rules.
+    The generic fallback is only used when nothing else matches.
+    """
+    kpi = planner.get("kpi")
+    category, dates = _planner_filters(planner)
+    candidates = []
+
+    if kpi == "top_products":
+        for cat, rng in ((category, dates), (category, None), (None, None)):
+            candidates.append(SQLGenOutput(
+                sql=kpi_sql("revenue", cat, rng, group_by="product"),
+                plan_explanation=f"Top products by revenue (category={cat}, dates={rng})",
+            ))
+    elif kpi in KPI_SQL:
+        for cat, rng in ((category, dates), (category, None), (None, dates)):
+            if cat or rng:
+                candidates.append(SQLGenOutput(
+                    sql=kpi_sql(kpi, cat, rng),
+                    plan_explanation=f"{kpi} (category={cat}, dates={rng})",
+                ))
+
+    question_lower = question.lower()
+    for matches, sql, explanation in SQL_RULES:
+        if matches(question_lower):
+            candidates.append(SQLGenOutput(sql=sql, plan_explanation=explanation))
+
+    if not candidates:
+        sql, explanation = DEFAULT_SQL
+        candidates.append(SQLGenOutput(sql=sql, plan_explanation=explanation))
+
+    unique, seen = [], set()
+    for candidate in candidates:
+        key = " ".join(candidate.sql.split()).lower()
+        if key not in seen:
+            seen.add(key)
+            unique.append(candidate)
+    return unique[:SQL_MAX_CANDIDATES]
+
+async def execute_candidates(question: str, planner: Dict[str, Any],
+                             candidates: List[SQLGenOutput]) -> Tuple[SQLGenOutput, Dict[str, Any]]:
+    """
+    Executes candidates concurrently and returns (winner, sql_result).
+
+    The caller holds one "sql" admission slot, used by the first candidate.
+    Every other query takes a further slot only if one is free right now
+    (try_acquire) and is skipped otherwise, so a race never runs more
+    queries than AGENT_LIMIT_SQL allows.
+
+    Rank is list order, with the optional LLM candidate last. The winner is
+    the best-ranked candidate with rows, picked as soon as every better
+    ranked one has finished; the others are cancelled and their queries
+    interrupted. Without rows anywhere the best-ranked success wins; if all
+    fail, the first candidate and its error are returned for repair.
+    """
+    cancel = threading.Event()
+    limiter = admission.limiters["sql"]
+    skipped = 0
+
+    async def run(candidate: SQLGenOutput, primary: bool = False):
+        nonlocal skipped
+        if not primary and not limiter.try_acquire():
+            skipped += 1
+            return candidate, {"error": "Skipped: no free SQL slot", "has_data": False}
+        try:
+            columns, rows = await asyncio.to_thread(execute_sql_query, candidate.sql, cancel)
+            return candidate, {"columns": columns, "rows": rows, "error": None, "has_data": len(rows) > 0}
+        except Exception as e:
+            return candidate, {"error": str(e), "has_data": False}
+        finally:
+            if not primary:
+                limiter.release()
+
+    async def run_llm():
+        from Repair_loop import propose_sql_async
+        try:
+            sql = await propose_sql_async(question, planner)
+        except Exception as e:
+            # e.g. an unparseable model output; the rule candidates still count
+            log.warning("LLM SQL candidate failed", extra={"error": str(e)})
+            return None, {"error": f"LLM candidate failed: {e}", "has_data": False}
+        if not sql:
+            return None, {"error": "No LLM candidate", "has_data": False}
+        return await run(SQLGenOutput(sql=sql, plan_explanation="LLM candidate"))
+
+    jobs = [run(c, primary=i == 0) for i, c in enumerate(candidates)] + ([run_llm()] if SQL_LLM_CANDIDATE else [])
+    tasks = [asyncio.ensure_future(job) for job in jobs]
+    winner = None
+    try:
+        pending = set(tasks)
+        deadline = asyncio.get_running_loop().time() + SQL_RACE_TIMEOUT_S
+        while pending and winner is None:
+            timeout = deadline - asyncio.get_running_loop().time()
+            done, pending = await asyncio.wait(pending, timeout=max(0, timeout),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break  # race deadline
+            for index, task in enumerate(tasks):
+                if not task.done():
+                    break  # a better-ranked candidate is still running
+                if task.result()[1]["has_data"]:
+                    winner = index
+                    break
+    finally:
+        cancel.set()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+    finished = [(i, t.result()) for i, t in enumerate(tasks) if t.done() and not t.cancelled()]
+    if winner is None:
+        # Deadline hit, or nothing returned rows: best-ranked rows, then best-ranked success
+        with_rows = [i for i, (_, result) in finished if result["has_data"]]
+        succeeded = [i for i, (_, result) in finished if not result["error"]]
+        winner = (with_rows or succeeded or [0])[0]
+    chosen = dict(finished).get(winner)
+    if chosen is None or chosen[0] is None:
+        # Nothing usable finished: report the primary candidate's outcome
+        chosen = dict(finished).get(0) or (candidates[0], {"error": "SQL candidates timed out", "has_data": False})
+        winner = 0
+
+    set_attribute("sql.candidates", len(tasks))
+    set_attribute("sql.winner", winner)
+    set_attribute("sql.skipped", skipped)
+    log.info("SQL candidates raced", extra={"candidates": len(tasks), "winner": winner,
+                                              "finished": len(finished), "skipped": skipped})
+    return chosen
+
 async def generate_sql_async(question: str, planner: Dict[str, Any]) -> SQLGenOutput:
     """Generate SQL with fallback to rule-based approach"""
     if not planner.get("need_sql"):
@@ -63,11 +314,12 @@ async def generate_sql_async(question: str, planner: Dict[str, Any]) -> SQLGenOu
     # Try cache first
     cache_key = f"sql_{question}_{hash(str(planner))}"
     cached = cache.get(cache_key)
+    set_attribute("cache.hit", bool(cached))
     if cached:
         return SQLGenOutput(**cached)
     
     # Use rule-based SQL generator (more reliable)
-    print("Using rule-based SQL generator")
+    log.debug("Using rule-based SQL generator")
     result = rule_based_sql_generator(question, planner)
     
     # Cache the result
@@ -1,17 +1,74 @@
 import sqlite3
 import os
-from typing import List, Tuple, Any
+import base64
+import hashlib
+import hmac
+import json
+import secrets
+import threading
+import time
+from collections import deque, OrderedDict
+from typing import List, Tuple, Any, Dict, Iterator, Optional
+import datasource
+import query_guard
+from logger import get_logger
+from tracing import set_attribute, start_span
+
+log = get_logger("sqlite")
 
 Database_path = r"C:\Users\HP\Desktop\Retail-Agent\AI-Assignment-Project\data\northwind.db"
 
+# Executed SELECTs are kept for offline analysis (see index_advisor.py).
+# Set SQL_LOG_PATH to also append them to a JSONL file.
+SQL_LOG_PATH = os.getenv("SQL_LOG_PATH")
+executed_queries = deque(maxlen=1000)
+
+_local = threading.local()
+
+def current_snapshot() -> datasource.Snapshot:
+    """The data version queries run against (see datasource.py)."""
+    return datasource.current(Database_path)
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Returns this thread's connection to the current data source, opening it
+    on first use. Each worker thread keeps one connection, so the executor's
+    thread pool doubles as the connection pool. Connections are never shared
+    between threads and are reopened after fork(), a Database_path change
+    or a snapshot swap.
+    """
+    snapshot = current_snapshot()
+    key = (os.getpid(), snapshot.id, snapshot.paths)
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.key == key:
+        return conn
+    if conn is not None and _local.key[0] == os.getpid():
+        conn.close()
+
+    conn = datasource.connect(snapshot, read_only=False)
+    _local.conn = conn
+    _local.key = key
+    return conn
+
+def guard_query(query: str, conn: sqlite3.Connection, snapshot: datasource.Snapshot) -> str:
+    """
+    The statement to actually run after the cost guard (query_guard.py):
+    `query`, or `query` with a LIMIT. Raises query_guard.QueryRejected.
+    """
+    checked = query_guard.check(query, conn, (snapshot.id, snapshot.paths))
+    if checked.cost_class != "unchecked":
+        set_attribute("db.cost_estimate", round(checked.cost))
+        set_attribute("db.cost_class", checked.cost_class)
+        set_attribute("db.guard_action", checked.action)
+    return checked.sql
+
 def get_db_schema(tables: List[str] = None) -> str:
     """
     Retrieves the SQLite database schema for the given tables.
     """
-    conn = None
+    cursor = None
     try:
-        conn = sqlite3.connect(Database_path)
-        cursor = conn.cursor()
+        cursor = get_connection().cursor()
         
         if tables is None:
             tables = [
@@ -56,36 +113,315 @@ def get_db_schema(tables: List[str] = None) -> str:
     except Exception as e:
         return f"File Error: Could not connect to database. Check path: {Database_path}. Error: {e}"
     finally:
-        if conn:
-            conn.close()
+        if cursor:
+            cursor.close()
+
+def record_executed_query(query: str, elapsed_ms: float, row_count: int):
+    """
+    Remembers an executed query and appends it to SQL_LOG_PATH if configured.
+    """
+    entry = {
+        "sql": query.strip(),
+        "elapsed_ms": round(elapsed_ms, 3),
+        "rows": row_count,
+        "ts": time.time()
+    }
+    executed_queries.append(entry)
+
+    if SQL_LOG_PATH:
+        try:
+            with open(SQL_LOG_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+        except OSError as e:
+            log.warning("Could not write SQL log", extra={"path": SQL_LOG_PATH, "error": str(e)})
+
+def explain_query_plan(query: str, conn: sqlite3.Connection) -> List[Dict[str, Any]]:
+    """
+    Runs EXPLAIN QUERY PLAN for a query and returns the plan rows.
+    """
+    cursor = conn.execute(f"EXPLAIN QUERY PLAN {query.strip().rstrip(';')}")
+    return [
+        {"id": row[0], "parent": row[1], "detail": row[3]}
+        for row in cursor.fetchall()
+    ]
+
+def _check_read_only(query: str) -> str:
+    query_upper = query.strip().upper()
+    if not (query_upper.startswith("SELECT") or query_upper.startswith("PRAGMA") or query_upper.startswith("EXPLAIN")):
+        raise ValueError("Only read-only SQL (SELECT/PRAGMA/EXPLAIN) is allowed.")
+    return query_upper
 
-def execute_sql_query(query: str) -> Tuple[List[str], List[Any]]:
+# SQLite calls the progress handler (query_guard.StepBudget) every N
+# virtual machine instructions
+PROGRESS_INTERVAL = 1000
+
+def execute_sql_query(query: str, cancel: Optional[threading.Event] = None) -> Tuple[List[str], List[Any]]:
     """
     Executes a read-only SQL query and returns column names and results.
+    Setting `cancel` from another thread aborts the query ("interrupted").
+    The query passes the cost guard first and runs under its VM-step budget.
     """
+    with start_span("sqlite.query", **{"db.system": "sqlite", "db.statement": query.strip()[:500]}) as span:
+        columns, results = _execute_sql_query(query, cancel)
+        span.set_attribute("db.rows", len(results))
+    return columns, results
+
+def _execute_sql_query(query: str, cancel: Optional[threading.Event] = None) -> Tuple[List[str], List[Any]]:
+    cursor = None
     conn = None
+    budget = query_guard.StepBudget(cancel, PROGRESS_INTERVAL)
     try:
-        conn = sqlite3.connect(Database_path)
+        conn = get_connection()
+        query_upper = _check_read_only(query)
+        query = guard_query(query, conn, current_snapshot())
+
+        budget.install(conn)
         cursor = conn.cursor()
         
-        query_upper = query.strip().upper()
-        if not (query_upper.startswith("SELECT") or query_upper.startswith("PRAGMA") or query_upper.startswith("EXPLAIN")):
-            raise ValueError("Only read-only SQL (SELECT/PRAGMA/EXPLAIN) is allowed.")
-        
+        started = time.perf_counter()
         cursor.execute(query)
         
         columns = [description[0] for description in cursor.description]
         results = cursor.fetchall()
+
+        if query_upper.startswith("SELECT"):
+            record_executed_query(query, (time.perf_counter() - started) * 1000, len(results))
         
         return columns, results
 
+    except query_guard.GuardError:
+        raise
     except sqlite3.Error as e:
+        if budget.exceeded:
+            raise budget.error()
         raise Exception(f"SQLITE_ERROR: {e}")
     except Exception as e:
         raise Exception(f"PYTHON_ERROR: {e}")
     finally:
-        if conn:
-            conn.close()
+        if cursor:
+            cursor.close()
+        if conn is not None:
+            budget.remove(conn)
+
+# ---------------------------------------------------------------------------
+# Paginated results
+#
+# open_cursor() runs a query on its own read-only connection, returns the
+# first page and keeps the cursor open so later pages continue where the
+# last one stopped (SQLite streams rows, so a page costs the same wherever
+# it is). The cursor token is signed and carries the query and position:
+# if the session has expired, or the request lands on another worker, the
+# query is re-run and the delivered rows are skipped.
+# ---------------------------------------------------------------------------
+
+SQL_PAGE_SIZE = int(os.getenv("SQL_PAGE_SIZE", "200"))
+SQL_CURSOR_TTL_S = float(os.getenv("SQL_CURSOR_TTL_S", "300"))
+SQL_MAX_CURSORS = int(os.getenv("SQL_MAX_CURSORS", "64"))
+# Generated once in the parent and exported, so every worker accepts every
+# token: forked gunicorn workers inherit it in memory, and the workers
+# uvicorn spawns on re-import read it back from the environment
+if not os.getenv("SQL_CURSOR_SECRET"):
+    os.environ["SQL_CURSOR_SECRET"] = secrets.token_hex(32)
+_CURSOR_SECRET = os.environ["SQL_CURSOR_SECRET"].encode("utf-8")
+
+
+class _CursorSession:
+    __slots__ = ("id", "query", "snapshot", "conn", "cursor", "columns", "position", "lookahead", "last_used",
+                 "budget")
+
+    def __init__(self, query: str, snapshot: Optional[datasource.Snapshot] = None,
+                 cancel: Optional[threading.Event] = None):
+        _check_read_only(query)
+        self.id = secrets.token_hex(8)
+        # Later pages read the snapshot the first page came from
+        self.snapshot = snapshot or current_snapshot()
+        # Used by one request at a time, from whichever executor thread
+        self.conn = datasource.connect(self.snapshot, check_same_thread=False)
+        # The VM-step budget applies per fetch: a page, a chunk
+        self.budget = query_guard.StepBudget(cancel, PROGRESS_INTERVAL)
+        try:
+            # Tokens and re-derived pages carry the guarded statement
+            self.query = guard_query(query, self.conn, self.snapshot)
+            self.budget.install(self.conn)
+            self.cursor = self.conn.execute(self.query)
+        except sqlite3.Error:
+            self.conn.close()
+            if self.budget.exceeded:
+                raise self.budget.error()
+            raise
+        except query_guard.GuardError:
+            self.conn.close()
+            raise
+        self.columns = [description[0] for description in self.cursor.description]
+        self.position = 0
+        self.lookahead = []
+        self.last_used = time.monotonic()
+
+    def fetch(self, count: int) -> List[Any]:
+        self.budget.reset()
+        try:
+            return self.cursor.fetchmany(count)
+        except sqlite3.Error:
+            if self.budget.exceeded:
+                raise self.budget.error()
+            raise
+
+    def read(self, page_size: int) -> Tuple[List[Any], bool]:
+        """Next page of rows and whether more remain."""
+        rows = self.lookahead + self.fetch(page_size + 1 - len(self.lookahead))
+        self.lookahead = rows[page_size:]
+        rows = rows[:page_size]
+        self.position += len(rows)
+        self.last_used = time.monotonic()
+        return rows, bool(self.lookahead)
+
+    def skip(self, count: int):
+        while count > 0:
+            rows = self.fetch(min(count, 1000))
+            if not rows:
+                break
+            count -= len(rows)
+            self.position += len(rows)
+
+    def close(self):
+        try:
+            self.cursor.close()
+            self.conn.close()
+        except sqlite3.Error:
+            pass
+
+
+_sessions: "OrderedDict[str, _CursorSession]" = OrderedDict()
+_sessions_lock = threading.Lock()
+
+
+def _sign(payload: Dict[str, Any]) -> str:
+    body = base64.urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode("utf-8")).decode("ascii")
+    digest = hmac.new(_CURSOR_SECRET, body.encode("ascii"), hashlib.sha256).hexdigest()[:32]
+    return f"{body}.{digest}"
+
+
+def _unsign(token: str) -> Dict[str, Any]:
+    body, _, digest = token.rpartition(".")
+    expected = hmac.new(_CURSOR_SECRET, body.encode("ascii"), hashlib.sha256).hexdigest()[:32]
+    if not body or not hmac.compare_digest(digest, expected):
+        raise ValueError("Invalid result cursor")
+    return json.loads(base64.urlsafe_b64decode(body.encode("ascii")))
+
+
+def _park(session: _CursorSession):
+    """Keeps an open session for the next page, evicting expired/LRU ones."""
+    evicted = []
+    with _sessions_lock:
+        now = time.monotonic()
+        for key in [k for k, s in _sessions.items() if now - s.last_used > SQL_CURSOR_TTL_S]:
+            evicted.append(_sessions.pop(key))
+        while len(_sessions) >= SQL_MAX_CURSORS:
+            evicted.append(_sessions.popitem(last=False)[1])
+        _sessions[session.id] = session
+    for old in evicted:
+        old.close()
+
+
+def _page(session: _CursorSession, page_size: int) -> Dict[str, Any]:
+    rows, has_more = session.read(page_size)
+    token = None
+    if has_more:
+        token = _sign({"id": session.id, "sql": session.query, "pos": session.position,
+                       "snap": session.snapshot.id})
+        _park(session)
+    else:
+        session.close()
+    return {"columns": session.columns, "rows": rows, "has_more": has_more, "cursor": token, "sql": session.query}
+
+
+def open_cursor(query: str, page_size: int = None) -> Dict[str, Any]:
+    """
+    Runs a read-only query and returns its first page:
+    {"columns", "rows", "has_more", "cursor", "sql"}. Pass "cursor" to
+    fetch_page() for the next page; it is None once the result is exhausted.
+    "sql" is the statement that ran (the cost guard may have added a LIMIT).
+    """
+    page_size = page_size or SQL_PAGE_SIZE
+    with start_span("sqlite.query", **{"db.system": "sqlite", "db.statement": query.strip()[:500],
+                                        "db.page_size": page_size}) as span:
+        started = time.perf_counter()
+        try:
+            page = _page(_CursorSession(query), page_size)
+        except query_guard.GuardError:
+            raise
+        except sqlite3.Error as e:
+            raise Exception(f"SQLITE_ERROR: {e}")
+        except Exception as e:
+            raise Exception(f"PYTHON_ERROR: {e}")
+        span.set_attribute("db.rows", len(page["rows"]))
+        if query.strip().upper().startswith("SELECT"):
+            record_executed_query(page["sql"], (time.perf_counter() - started) * 1000, len(page["rows"]))
+    return page
+
+
+def fetch_page(token: str, page_size: int = None) -> Dict[str, Any]:
+    """Next page for a cursor token from open_cursor() or a previous page."""
+    page_size = page_size or SQL_PAGE_SIZE
+    payload = _unsign(token)
+    with _sessions_lock:
+        session = _sessions.pop(payload["id"], None)
+    if session is not None and session.position != payload["pos"]:
+        # A stale token for a session that has moved on; do not skip rows
+        session.close()
+        session = None
+
+    with start_span("sqlite.page", **{"db.system": "sqlite", "db.page_size": page_size}) as span:
+        try:
+            if session is None:
+                span.set_attribute("db.cursor_rederived", True)
+                # Same snapshot if it is still published, else the current one
+                session = _CursorSession(payload["sql"], datasource.find(payload.get("snap")))
+                session.skip(payload["pos"])
+            page = _page(session, page_size)
+        except sqlite3.Error as e:
+            raise Exception(f"SQLITE_ERROR: {e}")
+        span.set_attribute("db.rows", len(page["rows"]))
+    return page
+
+
+def close_cursor(token: str):
+    """Releases a cursor before it is exhausted or expires."""
+    payload = _unsign(token)
+    with _sessions_lock:
+        session = _sessions.pop(payload["id"], None)
+    if session is not None:
+        session.close()
+
+
+def cursor_stats() -> Dict[str, int]:
+    with _sessions_lock:
+        return {"open_cursors": len(_sessions), "max_cursors": SQL_MAX_CURSORS}
+
+
+def stream_query(query: str, chunk_rows: int = 10000,
+                 cancel: Optional[threading.Event] = None) -> Iterator[Tuple[List[str], List[Any]]]:
+    """
+    Yields (columns, rows) chunks of a read-only query from its own
+    connection, so at most chunk_rows rows are held at a time.
+    """
+    with start_span("sqlite.stream", **{"db.system": "sqlite", "db.statement": query.strip()[:500]}) as span:
+        try:
+            session = _CursorSession(query, cancel=cancel)
+        except sqlite3.Error as e:
+            raise Exception(f"SQLITE_ERROR: {e}")
+        try:
+            while True:
+                rows = session.fetch(chunk_rows)
+                if not rows:
+                    break
+                session.position += len(rows)
+                yield session.columns, rows
+        except sqlite3.Error as e:
+            raise Exception(f"SQLITE_ERROR: {e}")
+        finally:
+            span.set_attribute("db.rows", session.position)
+            session.close()
 
 if __name__ == "__main__":
     print("Testing Schema Introspection")
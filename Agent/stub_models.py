@@ -0,0 +1,178 @@
+import asyncio
+import hashlib
+import random
+import threading
+import time
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Callable, Any, List, Optional
+
+import registry
+from llm_resilience import ResilientModel
+from llm_usage import MeteredModel
+from Classifier_route import QueryClassify, rule_based_router
+from planner import PlannerOutput, rule_based_planner
+from Repair_loop import RepairOutput
+from sql_gen import rule_based_sql_generator
+
+
+class PrefixCache:
+    """
+    Local stand-in for provider prompt caching, done the way vLLM's
+    automatic prefix caching does it: the prompt is cut into fixed-size
+    blocks, each block hashed together with everything before it, and the
+    leading blocks already seen (LRU, max_blocks) are not prefilled again.
+    """
+
+    def __init__(self, block_chars: int = 256, max_blocks: int = 4096):
+        self.block_chars = block_chars
+        self.max_blocks = max_blocks
+        self._blocks: "OrderedDict[str, None]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prefill(self, prompt: str) -> int:
+        """Caches the prompt's blocks; returns how many leading chars were cached already."""
+        digest = hashlib.sha256()
+        cached, still_cached = 0, True
+        with self._lock:
+            for start in range(0, len(prompt) - self.block_chars + 1, self.block_chars):
+                digest.update(prompt[start:start + self.block_chars].encode("utf-8"))
+                key = digest.hexdigest()
+                if still_cached and key in self._blocks:
+                    self._blocks.move_to_end(key)
+                    cached += self.block_chars
+                    continue
+                still_cached = False
+                self._blocks[key] = None
+                while len(self._blocks) > self.max_blocks:
+                    self._blocks.popitem(last=False)
+        return cached
+
+
+class StubModel:
+    """
+    Deterministic local stand-in for a structured-output ChatGroq model.
+    Sleeps latency_ms (+/- a jitter derived from the prompt) and returns
+    respond(prompt), so identical prompts always behave identically.
+    With prefill_ms_per_1k, uncached prompt tokens add prefill time; with a
+    prefix_cache the reply carries usage with the cached token count, like
+    an include_raw=True client. stall_rate / error_rate make that share of
+    calls take stall_ms longer or raise, drawn per call, to play a degraded
+    provider.
+    """
+
+    def __init__(self, respond: Callable[[str], Any], latency_ms: float = 0.0, jitter_ms: float = 0.0,
+                 prefill_ms_per_1k: float = 0.0, prefix_cache: Optional[PrefixCache] = None,
+                 stall_rate: float = 0.0, stall_ms: float = 0.0, error_rate: float = 0.0):
+        self.respond = respond
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.prefill_ms_per_1k = prefill_ms_per_1k
+        self.prefix_cache = prefix_cache
+        self.stall_rate = stall_rate
+        self.stall_ms = stall_ms
+        self.error_rate = error_rate
+        self.calls = 0
+
+    def _delay(self, prompt: str, cached_chars: int = 0) -> float:
+        seed = int(hashlib.md5(str(prompt).encode("utf-8")).hexdigest()[:8], 16)
+        jitter = random.Random(seed).uniform(-self.jitter_ms, self.jitter_ms)
+        prefill = self.prefill_ms_per_1k * (len(prompt) - cached_chars) / 4 / 1000
+        return max(0.0, self.latency_ms + jitter + prefill) / 1000
+
+    def _call(self, prompt: str):
+        cached_chars = self.prefix_cache.prefill(prompt) if self.prefix_cache is not None else 0
+        delay = self._delay(prompt, cached_chars)
+        if self.stall_rate or self.error_rate:
+            draw = random.Random(f"{prompt}#{self.calls}").random()
+            if draw < self.error_rate:
+                raise ConnectionError("stub provider error")
+            if draw < self.error_rate + self.stall_rate:
+                delay += self.stall_ms / 1000
+        return delay, cached_chars
+
+    def _reply(self, prompt: str, cached_chars: int):
+        parsed = self.respond(prompt)
+        if self.prefix_cache is None:
+            return parsed
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(parsed.model_dump_json()) // 4,
+                 "input_token_details": {"cache_read": cached_chars // 4}}
+        return {"raw": SimpleNamespace(usage_metadata=usage), "parsed": parsed, "parsing_error": None}
+
+    def invoke(self, prompt, *args, **kwargs):
+        self.calls += 1
+        prompt = str(prompt)
+        delay, cached_chars = self._call(prompt)
+        time.sleep(delay)
+        return self._reply(prompt, cached_chars)
+
+    async def ainvoke(self, prompt, *args, **kwargs):
+        self.calls += 1
+        prompt = str(prompt)
+        delay, cached_chars = self._call(prompt)
+        await asyncio.sleep(delay)
+        return self._reply(prompt, cached_chars)
+
+    def batch(self, prompts: List[Any], *args, **kwargs):
+        return [self.invoke(p) for p in prompts]
+
+    async def abatch(self, prompts: List[Any], *args, return_exceptions: bool = False, **kwargs):
+        return await asyncio.gather(*(self.ainvoke(p) for p in prompts), return_exceptions=return_exceptions)
+
+
+def _prompt_section(prompt: str, header: str, next_header: str = None) -> str:
+    """Pulls one INPUT section back out of a formatted prompt."""
+    start = prompt.find(header)
+    if start == -1:
+        return ""
+    start += len(header)
+    end = prompt.find(next_header, start) if next_header else -1
+    return prompt[start:end if end != -1 else None].strip()
+
+
+def stub_router(prompt: str) -> QueryClassify:
+    question = _prompt_section(prompt, "User Question:")
+    return QueryClassify(route=rule_based_router(question))
+
+
+def stub_planner(prompt: str) -> PlannerOutput:
+    question = _prompt_section(prompt, "QUESTION:", "DOCUMENT CHUNKS:")
+    docs_text = _prompt_section(prompt, "DOCUMENT CHUNKS:")
+    return rule_based_planner(question, [{"text": docs_text}])
+
+
+def stub_repair(prompt: str) -> RepairOutput:
+    question = _prompt_section(prompt, "QUESTION:", "PLANNER:")
+    fixed = rule_based_sql_generator(question, {})
+    return RepairOutput(fixed_sql=" ".join(fixed.sql.split()), reason="Stub repair: regenerated from rules")
+
+
+def install_stub_models(latency_ms: float = 0.0, jitter_ms: float = 0.0, prefill_ms_per_1k: float = 0.0,
+                        prefix_cache: bool = False, stall_rate: float = 0.0, stall_ms: float = 0.0,
+                        error_rate: float = 0.0, resilient: bool = True):
+    """
+    Replaces the router, planner and repair models with local stubs,
+    metered (estimated tokens) and behind the deadline / hedge / breaker
+    layer like the real clients (resilient=False leaves that out).
+    prefix_cache gives each stub its own PrefixCache. Returns the stubs so
+    callers can inspect call counts.
+    """
+    def stub(respond):
+        return StubModel(respond, latency_ms, jitter_ms, prefill_ms_per_1k,
+                         PrefixCache() if prefix_cache else None, stall_rate, stall_ms, error_rate)
+
+    stubs = {"router": stub(stub_router), "planner": stub(stub_planner), "repair": stub(stub_repair)}
+    for name, stub in stubs.items():
+        model = MeteredModel(stub)
+        registry.override(f"{name}_model", ResilientModel(model, stage=name, provider="stub") if resilient else model)
+    return stubs
+
+
+if __name__ == "__main__":
+    install_stub_models(latency_ms=5)
+    from Classifier_route import classify_route
+    from planner import run_planner
+
+    print("ROUTE:", classify_route("Revenue for Beverages during Summer Spice Campaign"))
+    print(run_planner("Revenue for Beverages during Summer Spice Campaign",
+                      [{"text": "Summer Spice Campaign runs from 1997-06-01 to 1997-06-30."}]))
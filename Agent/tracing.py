@@ -0,0 +1,416 @@
+import atexit
+import contextvars
+import functools
+import json
+import os
+import queue
+import secrets
+import threading
+import time
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, List
+
+from logger import get_logger
+
+log = get_logger("tracing")
+
+# Lightweight span tracing for the agent pipeline.
+#
+# Every graph node and every external call (LLM, SQLite, retrieval) runs
+# inside a span. Finished spans are handed to a background thread, so the
+# hot path never does I/O. Export formats follow the OpenTelemetry OTLP/JSON
+# layout (one {"resourceSpans": [...]} object per line), which the OTel
+# Collector file receiver and most trace viewers can read.
+#
+#   TRACE_EXPORTER  none / memory / otlp-file (default memory)
+#   TRACE_FILE      output path for otlp-file (default traces.otlp.jsonl)
+
+SERVICE_NAME = "retail-analytics-agent"
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = (
+        "name", "trace_id", "span_id", "parent_id", "start_ns", "end_ns",
+        "attributes", "events", "status", "status_message"
+    )
+
+    def __init__(self, name: str, parent: Optional["Span"] = None, attributes: Dict[str, Any] = None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.status = "UNSET"
+        self.status_message = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes):
+        self.events.append((name, time.time_ns(), attributes))
+
+    def set_error(self, message: str):
+        self.status = "ERROR"
+        self.status_message = message
+
+    @property
+    def duration_ms(self) -> float:
+        end = self.end_ns or time.time_ns()
+        return (end - self.start_ns) / 1e6
+
+
+def current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+def set_attribute(key: str, value: Any):
+    """Sets an attribute on the active span; no-op outside a span."""
+    span = _current_span.get()
+    if span is not None:
+        span.set_attribute(key, value)
+
+
+@contextmanager
+def start_span(name: str, **attributes):
+    """
+    Opens a child of the active span (or a new trace) for the with-block.
+    """
+    span = Span(name, _current_span.get(), attributes)
+    token = _current_span.set(span)
+    try:
+        yield span
+    except BaseException as e:
+        span.set_error(f"{type(e).__name__}: {e}")
+        raise
+    finally:
+        _current_span.reset(token)
+        span.end_ns = time.time_ns()
+        if span.status == "UNSET":
+            span.status = "OK"
+        _processor.submit(span)
+
+
+def llm_span(stage: str, prompt: str, model: str = None):
+    """
+    Span for one LLM call. Structured-output clients do not surface usage,
+    so prompt tokens are estimated at ~4 characters per token.
+    """
+    attributes = {
+        "llm.stage": stage,
+        "llm.model": model,
+        "llm.prompt_chars": len(prompt),
+        "llm.prompt_tokens_est": len(prompt) // 4,
+    }
+    if getattr(prompt, "prefix_hash", None):
+        # prompts.Prompt: which cacheable prefix this call starts with
+        attributes["llm.prefix_hash"] = prompt.prefix_hash
+        attributes["llm.prefix_chars"] = prompt.prefix_len
+    return start_span(f"llm.{stage}", **attributes)
+
+
+def traced_node(name: str, node):
+    """
+    Wraps an async graph node in a "node.<name>" span and records the
+    fields the node returned that are useful for latency triage.
+    """
+    @functools.wraps(node)
+    async def wrapper(state):
+        with start_span(f"node.{name}", **{"agent.node": name}) as span:
+            result = await node(state)
+            _record_node_result(span, result)
+            return result
+    return wrapper
+
+
+def _record_node_result(span: Span, result: Any):
+    get = result.get if isinstance(result, dict) else lambda key: getattr(result, key, None)
+    route = get("route")
+    if route:
+        span.set_attribute("agent.route", route)
+    sql_result = get("sql_result")
+    if isinstance(sql_result, dict):
+        span.set_attribute("sql.rows", len(sql_result.get("rows") or []))
+        if sql_result.get("error"):
+            span.set_attribute("sql.error", str(sql_result["error"])[:200])
+    retries = get("retries")
+    if retries:
+        span.set_attribute("repair.retries", retries)
+
+
+# ---------------------------------------------------------------------------
+# Exporters
+# ---------------------------------------------------------------------------
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items() if v is not None]
+
+
+def to_otlp_json(spans: List[Span]) -> Dict[str, Any]:
+    """Encodes spans as an OTLP/JSON ExportTraceServiceRequest."""
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+            "scopeSpans": [{
+                "scope": {"name": "agent.tracing"},
+                "spans": [
+                    {
+                        "traceId": span.trace_id,
+                        "spanId": span.span_id,
+                        "parentSpanId": span.parent_id or "",
+                        "name": span.name,
+                        "kind": 1,
+                        "startTimeUnixNano": str(span.start_ns),
+                        "endTimeUnixNano": str(span.end_ns),
+                        "attributes": _otlp_attributes(span.attributes),
+                        "events": [
+                            {"name": name, "timeUnixNano": str(ts), "attributes": _otlp_attributes(attrs)}
+                            for name, ts, attrs in span.events
+                        ],
+                        "status": {"code": {"UNSET": 0, "OK": 1, "ERROR": 2}[span.status],
+                                   "message": span.status_message or ""},
+                    }
+                    for span in spans
+                ],
+            }],
+        }]
+    }
+
+
+class InMemoryExporter:
+    """Keeps the most recent spans for in-process reports."""
+
+    def __init__(self, maxlen: int = 10000):
+        self.spans = deque(maxlen=maxlen)
+
+    def export(self, spans: List[Span]):
+        self.spans.extend(spans)
+
+
+class OTLPFileExporter:
+    """Appends one OTLP/JSON document per batch to a local file."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: List[Span]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(to_otlp_json(spans)) + "\n")
+
+
+class BatchSpanProcessor:
+    """
+    Buffers finished spans and exports them from a daemon thread.
+    """
+
+    def __init__(self, exporters: List[Any], max_batch: int = 256, interval_s: float = 1.0):
+        self.exporters = exporters
+        self.max_batch = max_batch
+        self.interval_s = interval_s
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # Spans submitted but not yet exported, including the batch the
+        # export thread has taken off the queue; flush() waits for zero
+        self._pending = 0
+        self._exported = threading.Condition()
+
+    def submit(self, span: Span):
+        if not self.exporters:
+            return
+        if self._thread is None:
+            self._start()
+        with self._exported:
+            self._pending += 1
+        self._queue.put(span)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._drain(block=True)
+            if batch is None:
+                return
+            self._export(batch)
+
+    def _drain(self, block: bool) -> Optional[List[Span]]:
+        batch = []
+        deadline = time.monotonic() + self.interval_s
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if not block or timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                if batch:
+                    self._export(batch)
+                return None
+            batch.append(item)
+        return batch
+
+    def _export(self, batch: List[Span]):
+        if not batch:
+            return
+        for exporter in self.exporters:
+            try:
+                exporter.export(batch)
+            except Exception as e:
+                # Never let telemetry break the request path
+                log.warning("Span export failed", extra={"exporter": type(exporter).__name__, "error": str(e)})
+        with self._exported:
+            self._pending -= len(batch)
+            self._exported.notify_all()
+
+    def flush(self, timeout_s: float = 5.0):
+        """
+        Exports everything queued so far on the calling thread, then waits
+        for the batch the export thread may be holding.
+        """
+        batch = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        self._export(batch)
+        with self._exported:
+            self._exported.wait_for(lambda: self._pending <= 0, timeout_s)
+
+    def reset_after_fork(self):
+        # The export thread does not survive fork(); start fresh in the child
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._exported = threading.Condition()
+
+    def shutdown(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+
+memory_exporter = InMemoryExporter()
+
+
+def _build_processor() -> BatchSpanProcessor:
+    mode = os.getenv("TRACE_EXPORTER", "memory")
+    exporters = []
+    if mode in ("memory", "otlp-file"):
+        exporters.append(memory_exporter)
+    if mode == "otlp-file":
+        exporters.append(OTLPFileExporter(os.getenv("TRACE_FILE", "traces.otlp.jsonl")))
+    return BatchSpanProcessor(exporters)
+
+
+_processor = _build_processor()
+atexit.register(_processor.shutdown)
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_processor.reset_after_fork)
+
+
+def add_exporter(exporter):
+    """Attaches an extra exporter (anything with export(spans))."""
+    _processor.exporters.append(exporter)
+
+
+def flush():
+    _processor.flush()
+
+
+# ---------------------------------------------------------------------------
+# Reports
+# ---------------------------------------------------------------------------
+
+def _percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def latency_report(spans: List[Span] = None) -> Dict[str, Dict[str, float]]:
+    """
+    Per span name: count, p50/p95/max duration in ms and error count.
+    Defaults to the in-memory buffer.
+    """
+    if spans is None:
+        flush()
+        spans = list(memory_exporter.spans)
+
+    durations = defaultdict(list)
+    errors = defaultdict(int)
+    for span in spans:
+        durations[span.name].append(span.duration_ms)
+        if span.status == "ERROR":
+            errors[span.name] += 1
+
+    return {
+        name: {
+            "count": len(values),
+            "p50_ms": round(_percentile(values, 50), 3),
+            "p95_ms": round(_percentile(values, 95), 3),
+            "max_ms": round(max(values), 3),
+            "errors": errors[name],
+        }
+        for name, values in sorted(durations.items())
+    }
+
+
+def load_otlp_file(path: str) -> List[Span]:
+    """Reads spans back from an OTLPFileExporter file."""
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            for resource in json.loads(line)["resourceSpans"]:
+                for scope in resource["scopeSpans"]:
+                    for raw in scope["spans"]:
+                        span = Span(raw["name"])
+                        span.trace_id = raw["traceId"]
+                        span.span_id = raw["spanId"]
+                        span.parent_id = raw["parentSpanId"] or None
+                        span.start_ns = int(raw["startTimeUnixNano"])
+                        span.end_ns = int(raw["endTimeUnixNano"])
+                        span.status = {0: "UNSET", 1: "OK", 2: "ERROR"}[raw["status"]["code"]]
+                        spans.append(span)
+    return spans
+
+
+if __name__ == "__main__":
+    import sys
+
+    path = sys.argv[1] if len(sys.argv) > 1 else os.getenv("TRACE_FILE", "traces.otlp.jsonl")
+    report = latency_report(load_otlp_file(path))
+    print(f"{'span':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}{'errors':>8}")
+    for name, stats in report.items():
+        print(f"{name:<28}{stats['count']:>7}{stats['p50_ms']:>10}{stats['p95_ms']:>10}"
+              f"{stats['max_ms']:>10}{stats['errors']:>8}")
@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import warnings
+from collections import Counter
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from logger import get_logger
+
+log = get_logger("warmup")
+
+# Deploy-time warm-up.
+#
+# A fresh worker pays every cold path on its first requests: the retriever
+# index, the schema introspection, the SQLite connection, the SQL and
+# answer caches. warm_up() runs before the worker reports ready
+# (server.py /readyz): it builds the shared resources, then replays the
+# WARMUP_TOP_N most frequent questions from WARMUP_LOG_PATH through
+# run_agent, which fills the sql_gen and Synthesizer caches on the way.
+# Everything is bounded by WARMUP_BUDGET_S; questions that do not fit are
+# reported as skipped, a replay still running at the deadline is cancelled.
+#
+# The log is JSONL with a "question" field: the agent's own structured log
+# (LOG_FORMAT=json, the "Processing question" records) or a benchmark file.
+# Only the last WARMUP_LOG_MAX_BYTES are read. Follow-up turns ("and for
+# Condiments?") mean nothing outside their session and are not replayed.
+#
+# LLM_CACHE_PATH persists model responses (temperature 0) in SQLite across
+# deploys. During the replay LangChain serves router / planner / repair
+# calls from it and stores misses, so a deploy re-warms without re-paying
+# the LLM for questions the previous one already saw. LLM_CACHE_MODE=always
+# keeps the cache on for live traffic too; the default (warmup) detaches it
+# once the replay is done.
+
+WARMUP_LOG_PATH = os.getenv("WARMUP_LOG_PATH", os.getenv("LOG_FILE"))
+WARMUP_TOP_N = int(os.getenv("WARMUP_TOP_N", "20"))
+WARMUP_BUDGET_S = float(os.getenv("WARMUP_BUDGET_S", "30"))
+WARMUP_CONCURRENCY = int(os.getenv("WARMUP_CONCURRENCY", "4"))
+WARMUP_LOG_MAX_BYTES = int(os.getenv("WARMUP_LOG_MAX_BYTES", str(64 * 1024 * 1024)))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH")
+LLM_CACHE_MODE = os.getenv("LLM_CACHE_MODE", "warmup")   # warmup | always
+
+LOGGED_MESSAGE = "Processing question"
+
+
+# ---------------------------------------------------------------------------
+# Which questions
+# ---------------------------------------------------------------------------
+
+def _tail_lines(path: str, max_bytes: int):
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - max_bytes))
+        if size > max_bytes:
+            f.readline()  # partial first line
+        for raw in f:
+            yield raw.decode("utf-8", errors="replace")
+
+
+def top_questions(path: str, top_n: int, max_bytes: int = None) -> Tuple[List[Tuple[str, int]], int]:
+    """
+    The top_n most frequent questions in a JSONL log, most frequent first,
+    as (question, count); questions are counted by normalize_question and
+    reported in their latest spelling. Also returns how many entries were read.
+    """
+    from coalescing import normalize_question
+    from planner import is_follow_up
+
+    counts: Counter = Counter()
+    spelling: Dict[str, str] = {}
+    entries = 0
+    for line in _tail_lines(path, max_bytes or WARMUP_LOG_MAX_BYTES):
+        line = line.strip()
+        if not line.startswith("{"):
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        question = entry.get("question")
+        if not isinstance(question, str) or not question.strip():
+            continue
+        if "msg" in entry and entry["msg"] != LOGGED_MESSAGE:
+            continue  # other records that happen to carry the question
+        entries += 1
+        if entry.get("session_id") and is_follow_up(question):
+            continue
+        key = normalize_question(question)
+        counts[key] += 1
+        spelling[key] = question.strip()
+    return [(spelling[key], count) for key, count in counts.most_common(top_n)], entries
+
+
+# ---------------------------------------------------------------------------
+# Persisted LLM cache
+# ---------------------------------------------------------------------------
+
+_llm_cache = None
+
+
+def _build_llm_cache(path: str):
+    from langchain_core.caches import BaseCache
+    from langchain_core.load import dumps, loads
+
+    class SqliteLLMCache(BaseCache):
+        """LangChain LLM cache in one SQLite table, with hit/miss counters."""
+
+        def __init__(self, path: str):
+            self.path = path
+            self.hits = 0
+            self.misses = 0
+            self._lock = threading.Lock()
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (prompt TEXT, llm TEXT, value TEXT, "
+                "PRIMARY KEY (prompt, llm))"
+            )
+
+        def lookup(self, prompt: str, llm_string: str):
+            with self._lock:
+                row = self._conn.execute("SELECT value FROM llm_cache WHERE prompt = ? AND llm = ?",
+                                         (prompt, llm_string)).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self.hits += 1
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")  # loads() is marked beta
+                    return loads(row[0])
+            except Exception as e:
+                log.warning("Unreadable LLM cache entry, ignoring", extra={"error": str(e)})
+                return None
+
+        def update(self, prompt: str, llm_string: str, return_val):
+            value = dumps(return_val)
+            with self._lock:
+                self._conn.execute("INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?)",
+                                   (prompt, llm_string, value))
+                self._conn.commit()
+
+        def clear(self, **kwargs):
+            with self._lock:
+                self._conn.execute("DELETE FROM llm_cache")
+                self._conn.commit()
+
+        def stats(self) -> Dict[str, Any]:
+            with self._lock:
+                entries = self._conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+            return {"path": self.path, "entries": entries, "hits": self.hits, "misses": self.misses}
+
+    return SqliteLLMCache(path)
+
+
+def attach_llm_cache(path: str = None) -> Optional[Any]:
+    """Routes LangChain model calls through the persisted cache (if configured)."""
+    global _llm_cache
+    path = path or LLM_CACHE_PATH
+    if not path:
+        return None
+    from langchain_core.globals import set_llm_cache
+
+    if _llm_cache is None or _llm_cache.path != path:
+        _llm_cache = _build_llm_cache(path)
+    set_llm_cache(_llm_cache)
+    return _llm_cache
+
+
+def detach_llm_cache():
+    from langchain_core.globals import set_llm_cache
+    set_llm_cache(None)
+
+
+def llm_cache_stats() -> Optional[Dict[str, Any]]:
+    return _llm_cache.stats() if _llm_cache is not None else None
+
+
+# ---------------------------------------------------------------------------
+# Warm-up
+# ---------------------------------------------------------------------------
+
+def _timed(stages: Dict[str, float], name: str, fn, *args):
+    started = time.perf_counter()
+    try:
+        return fn(*args)
+    finally:
+        stages[name] = round((time.perf_counter() - started) * 1000, 1)
+
+
+def warm_resources(stages: Dict[str, float]):
+    """Builds what every first request needs regardless of the question."""
+    import registry
+    import retrieval
+    import sqlite_tool
+
+    _timed(stages, "retriever_ms", registry.warm, "retriever")
+    if retrieval.RETRIEVER_ENGINE != "tfidf":
+        _timed(stages, "bm25_index_ms", registry.warm, "bm25_index")
+    _timed(stages, "schema_ms", sqlite_tool.get_db_schema)
+
+
+async def _replay(question: str, count: int) -> Dict[str, Any]:
+    import admission
+    from Graph import AgentError, run_agent
+
+    started = time.perf_counter()
+    entry = {"question": question, "count": count}
+    try:
+        with admission.request("batch"):
+            answer = await run_agent(question)
+        entry.update(confidence=answer.confidence, sql=bool(answer.sql_used))
+    except admission.Overloaded as e:
+        entry["error"] = f"overloaded: {e.stage}"
+    except AgentError as e:
+        entry["error"] = f"failed: {e}"
+    entry["ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return entry
+
+
+async def warm_up(questions: Sequence[Tuple[str, int]] = None, budget_s: float = None,
+                  concurrency: int = None, log_path: str = None, top_n: int = None) -> Dict[str, Any]:
+    """
+    Warms shared resources, then replays `questions` ((question, count),
+    default: the top of the question log) until budget_s runs out.
+    Returns a report of what was warmed, skipped or cut off.
+    """
+    budget_s = WARMUP_BUDGET_S if budget_s is None else budget_s
+    concurrency = max(1, concurrency or WARMUP_CONCURRENCY)
+    log_path = log_path or WARMUP_LOG_PATH
+    top_n = WARMUP_TOP_N if top_n is None else top_n
+    started = time.perf_counter()
+    deadline = started + budget_s
+    report: Dict[str, Any] = {"budget_s": budget_s, "stages": {}, "warmed": [], "skipped": [],
+                              "cancelled": [], "log_path": None, "log_entries": 0}
+
+    await asyncio.to_thread(warm_resources, report["stages"])
+
+    if questions is None:
+        questions = []
+        if log_path and os.path.exists(log_path) and top_n > 0:
+            questions, report["log_entries"] = await asyncio.to_thread(top_questions, log_path, top_n)
+            report["log_path"] = log_path
+        elif log_path:
+            log.warning("Warm-up question log not found", extra={"path": log_path})
+
+    cache = attach_llm_cache()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    running = set()
+
+    async def one(question: str, count: int):
+        async with semaphore:
+            running.add(question)
+            return await _replay(question, count)
+
+    tasks = {asyncio.create_task(one(q, c)): (q, c) for q, c in questions}
+    try:
+        if tasks:
+            done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.perf_counter()))
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task, (question, count) in tasks.items():
+                if task in pending:
+                    # Still queued at the deadline: skipped; mid-replay: cancelled
+                    report["cancelled" if question in running else "skipped"].append(
+                        {"question": question, "count": count})
+                elif task.exception() is not None:
+                    report["warmed"].append({"question": question, "count": count,
+                                             "error": f"{type(task.exception()).__name__}: {task.exception()}"})
+                else:
+                    report["warmed"].append(task.result())
+    finally:
+        if cache is not None:
+            report["llm_cache"] = cache.stats()
+            if LLM_CACHE_MODE != "always":
+                detach_llm_cache()
+
+    report["elapsed_s"] = round(time.perf_counter() - started, 3)
+    report["summary"] = {
+        "questions": len(questions),
+        "warmed": sum(1 for entry in report["warmed"] if "error" not in entry),
+        "errors": sum(1 for entry in report["warmed"] if "error" in entry),
+        "skipped": len(report["skipped"]),
+        "cancelled": len(report["cancelled"]),
+        "log_share": round(sum(c for _, c in questions) / report["log_entries"], 3)
+        if report["log_entries"] else None,
+    }
+    log.info("Warm-up finished", extra={**report["summary"], "elapsed_s": report["elapsed_s"]})
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay the most frequent logged questions to warm the caches")
+    parser.add_argument("--log", default=WARMUP_LOG_PATH, required=WARMUP_LOG_PATH is None,
+                        help="JSONL question log (the agent's LOG_FORMAT=json log works)")
+    parser.add_argument("--top", type=int, default=WARMUP_TOP_N)
+    parser.add_argument("--budget-s", type=float, default=WARMUP_BUDGET_S)
+    parser.add_argument("--concurrency", type=int, default=WARMUP_CONCURRENCY)
+    parser.add_argument("--llm-cache", default=LLM_CACHE_PATH, help="SQLite file for persisted LLM responses")
+    parser.add_argument("--list", action="store_true", help="Only print the questions that would be replayed")
+    args = parser.parse_args()
+
+    if args.list:
+        ranked, entries = top_questions(args.log, args.top)
+        print(f"{entries} logged questions")
+        for question, count in ranked:
+            print(f"{count:6d}  {question}")
+    else:
+        LLM_CACHE_PATH = args.llm_cache
+        result = asyncio.run(warm_up(budget_s=args.budget_s, concurrency=args.concurrency,
+                                     log_path=args.log, top_n=args.top))
+        print(json.dumps(result, indent=2, default=str))